@@ -0,0 +1,115 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import gzip
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _range(self, size):
+        """Returns the requested (start, end), or None for the whole
+        file."""
+        rng = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if not rng or (if_range and if_range != self.server.etag):
+            return None
+
+        first, last = rng.split("=", 1)[1].split("-")
+        if self.server.wrong_range:
+            first = 0
+        return int(first), min(int(last), size - 1) if last else size - 1
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.answers is not None and \
+                len(server.requests) > server.answers:
+            self.close_connection = True
+            return
+
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        rng = self._range(len(data))
+        if self.server.gzip and \
+                "gzip" in self.headers.get("Accept-Encoding", ""):
+            data, rng = gzip.compress(data), None
+            self.send_response(200)
+            self.send_header("Content-Encoding", "gzip")
+            start, end = 0, len(data) - 1
+        elif rng:
+            start, end = rng
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{end}/{len(data)}"
+            )
+        else:
+            start, end = 0, len(data) - 1
+            self.send_response(200)
+
+        body = data[start:end + 1]
+        if server.etag:
+            self.send_header("ETag", server.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if server.drops:
+            server.drops -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
+
+class RangeServer(ThreadingHTTPServer):
+    """Serves files, a dictionary of paths to bytes, with single Range
+    requests. If etag is given, it is sent and a Range with another
+    If-Range is answered with the whole file. The first drops responses
+    are cut off halfway through the body. With answers, the connection is
+    closed without a response after that many requests. With gzip, files
+    are sent gzip-encoded to clients that accept that. With wrong_range,
+    every range is answered from the start of the file. The headers of all
+    requests are kept in requests."""
+    daemon_threads = True
+
+    def __init__(self, files, etag=None, drops=0, answers=None,
+                 gzip=False, wrong_range=False):
+        super().__init__(("127.0.0.1", 0), _RangeHandler)
+        self.files = files
+        self.etag = etag
+        self.drops = drops
+        self.answers = answers
+        self.gzip = gzip
+        self.wrong_range = wrong_range
+        self.requests = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+@pytest.fixture
+def http_server():
+    """Returns a function that starts a RangeServer with the given
+    arguments. The servers are stopped after the test."""
+    servers = []
+
+    def serve(files, **kwargs):
+        servers.append(RangeServer(files, **kwargs))
+        return servers[-1]
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
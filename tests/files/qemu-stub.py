@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+"""Stands in for qemu-system-x86_64 in 'vmcloak bench restore' tests. It
+answers the QMP commands of a restore and reads the memory snapshot with
+the command of an exec: migration. The commands are appended to the file
+in QEMU_STUB_LOG, if set."""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+
+def send(conn, msg):
+    conn.sendall(json.dumps(msg).encode() + b"\r\n")
+
+def main(args):
+    qmp = args[args.index("-qmp") + 1]
+    path = qmp[len("unix:"):].split(",")[0]
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    conn, _ = server.accept()
+    send(conn, {"QMP": {"version": {}, "capabilities": []}})
+    for line in conn.makefile("rb"):
+        msg = json.loads(line)
+        cmd = msg["execute"]
+        if os.environ.get("QEMU_STUB_LOG"):
+            with open(os.environ["QEMU_STUB_LOG"], "a") as fp:
+                fp.write(line.decode())
+        # QEMU may exit before it replies to quit.
+        if cmd == "quit":
+            break
+        ret = {}
+        if cmd == "migrate-incoming":
+            uri = msg["arguments"]["uri"]
+            if uri.startswith("exec:"):
+                subprocess.run(
+                    uri[len("exec:"):], shell=True, check=True,
+                    stdout=subprocess.DEVNULL
+                )
+        elif cmd == "query-migrate":
+            ret = {"status": "completed"}
+        send(conn, {"return": ret, "id": msg.get("id")})
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
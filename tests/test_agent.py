@@ -3,6 +3,10 @@
 # See the file 'docs/LICENSE.txt' for copying permission.
 
 from vmcloak.agent import Agent
+from vmcloak.bench import StandInAgent, bench_agent
+from vmcloak.dependencies.bootpolicy import BootPolicy
+from vmcloak.repository import Image
+from vmcloak.win10 import Windows10x64
 
 class TestAgent(object):
     def setup(self):
@@ -15,3 +19,92 @@ class TestAgent(object):
         self.a.postfile = none
         self.a.upload("/tmp/hello", "contents")
         self.a.upload("/tmp/hello", "contents")
+
+def test_pooled_session():
+    with StandInAgent() as server:
+        with Agent(server.ipaddr, server.port) as a:
+            for _ in range(20):
+                assert a.execute("echo")["exit_code"] == 0
+            assert a.environ("SYSTEMDRIVE") == "C:"
+
+        # All requests went over a single keep-alive connection.
+        assert server.connections == 1
+        assert a._session is None
+
+def test_close_rebuilds_pool():
+    with StandInAgent() as server:
+        a = Agent(server.ipaddr, server.port)
+        session = a.session
+        a.ping()
+        a.close()
+        a.ping()
+        assert a.session is not session
+        assert server.connections == 2
+        a.close()
+
+def test_bench_agent():
+    with StandInAgent() as server:
+        results = bench_agent(server.ipaddr, server.port, count=50)
+
+    assert results["pooled"]["rps"] > 0
+    assert results["unpooled"]["rps"] > 0
+
+class _FakeResponse(object):
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+def _fake_batch_agent(exit_codes):
+    """Return an Agent that answers the execute_many() script as if each
+    command printed its index and returned the given exit code."""
+    a = Agent("localhost", 8000)
+    a.scripts = []
+
+    def postfile(method, files, **kwargs):
+        a.scripts.append(files["file"].read().decode())
+
+    def post(method, **kwargs):
+        marker = a.scripts[-1].split("\r\n")[2].split()[1]
+        stdout, stderr = "", ""
+        for idx, exit_code in enumerate(exit_codes):
+            stdout += f"{marker} start {idx}\r\nout {idx}\r\n"
+            stdout += f"{marker} exit {idx} {exit_code}\r\n"
+            stderr += f"{marker} start {idx}\r\nerr {idx}"
+        return _FakeResponse({"stdout": stdout, "stderr": stderr})
+
+    a.postfile = postfile
+    a.post = post
+    return a
+
+def test_execute_many():
+    a = _fake_batch_agent([0, 1])
+    results = a.execute_many(["echo 100%", "reg add \"HKCU\\x\" /f"])
+
+    assert len(a.scripts) == 1
+    assert 'cmd /s /c "echo 100%%"' in a.scripts[0]
+    assert [r["exit_code"] for r in results] == [0, 1]
+    assert results[0]["stdout"] == "out 0\r\n"
+    assert results[1]["stderr"] == "err 1"
+
+def test_batch():
+    a = _fake_batch_agent([0, 0, 0])
+    with a.batch() as results:
+        for idx in range(3):
+            assert a.execute(f"echo {idx}") is None
+
+    assert len(a.scripts) == 1
+    assert [r["stdout"] for r in results] == ["out 0\r\n", "out 1\r\n",
+                                              "out 2\r\n"]
+
+def test_dependency_batch():
+    a = _fake_batch_agent([0] * 5)
+    d = BootPolicy(h=Windows10x64(), a=a, i=Image(osversion="win10x64"))
+    d.debug = "1"
+    d.run()
+
+    # One script upload and one /execute for all five commands.
+    assert len(a.scripts) == 1
+    assert a.scripts[0].count("cmd /s /c") == 5
+    assert "bootstatuspolicy ignoreallfailures" in a.scripts[0]
@@ -0,0 +1,122 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine
+
+from vmcloak import repository
+from vmcloak.batch import BatchJob, Scheduler, load_specs, status_table
+from vmcloak.exceptions import BatchError
+from vmcloak.main import _allocate_batch_ips, _init_defaults
+from vmcloak.repository import IPNet
+
+SPECS = """
+defaults:
+  adapter: br0
+  iso-file: /isos/win10.iso
+images:
+  - name: win10_1
+    os: win10x64
+    cpus: 2
+    ramsize: 4096
+  - name: win7_1
+    os: win7x64
+    iso-file: /isos/win7.iso
+"""
+
+def test_load_specs(tmp_path):
+    path = tmp_path / "batch.yaml"
+    path.write_text(SPECS)
+    specs = load_specs(str(path))
+    assert specs == [
+        {"name": "win10_1", "os": "win10x64", "cpus": 2, "ramsize": 4096,
+         "adapter": "br0", "iso_file": "/isos/win10.iso"},
+        {"name": "win7_1", "os": "win7x64", "adapter": "br0",
+         "iso_file": "/isos/win7.iso"},
+    ]
+
+    path = tmp_path / "batch.json"
+    path.write_text('[{"name": "a", "os": "win10x64", "hdd-size": 10}]')
+    with pytest.raises(BatchError, match="hdd_size"):
+        load_specs(str(path), known={"cpus": 1})
+
+    path.write_text('[{"name": "a", "os": "win10x64"}, {"name": "a"}]')
+    with pytest.raises(BatchError):
+        load_specs(str(path))
+
+def test_init_defaults():
+    defaults = _init_defaults()
+    assert "name" not in defaults and "vm" not in defaults
+    assert defaults["copy_iso"] is False and defaults["fast_build"] is False
+    assert defaults["ip"] is None and defaults["cpus"] == 1
+
+def _job(name, ramsize, cpus):
+    return BatchJob(name, {
+        "ramsize": ramsize, "cpus": cpus, "osversion": "win10x64",
+        "ip": "192.168.30.2",
+    })
+
+def test_scheduler():
+    jobs = [_job("a", 4096, 2), _job("b", 4096, 2), _job("c", 2048, 1),
+            _job("big", 16384, 8)]
+    lock = threading.Lock()
+    running, peaks = set(), []
+
+    def func(job):
+        with lock:
+            running.add(job.name)
+            peaks.append(sum(j.ramsize for j in jobs if j.name in running))
+        job.set_state("install")
+        time.sleep(0.05)
+        with lock:
+            running.discard(job.name)
+        if job.name == "c":
+            raise ValueError("boom")
+
+    Scheduler(max_ram=8192, max_cpus=4).run(jobs, func)
+    assert max(peaks) <= 16384
+    assert all(peak <= 8192 for peak in peaks[:-1])
+    assert [job.state for job in jobs] == ["done", "done", "failed", "done"]
+    assert jobs[2].error == "boom"
+
+    table = status_table(jobs).splitlines()
+    assert table[0].split() == ["NAME", "OS", "IP", "CPUS", "RAM", "STATE",
+                                "TIME"]
+    assert "failed: boom" in table[3]
+
+@pytest.fixture
+def repository_db(tmp_path):
+    """Point the repository at an empty database, not at the one in
+    ~/.vmcloak, which may have an older schema."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'repository.db'}")
+    repository.Base.metadata.create_all(engine)
+    repository.Session.configure(bind=engine)
+    yield engine
+    repository.Session.configure(bind=repository.engine)
+    engine.dispose()
+
+def test_allocate_batch_ips(repository_db):
+    attrs = [
+        {"network": "10.12.0.0/24", "gateway": "10.12.0.1", "adapter": None,
+         "ip": None},
+        {"network": "10.12.0.0/24", "gateway": "10.12.0.1", "adapter": None,
+         "ip": "10.12.0.2"},
+        {"network": "10.12.0.0/24", "gateway": "10.12.0.1", "adapter": None,
+         "ip": None},
+    ]
+    _allocate_batch_ips(None, attrs)
+    assert [attr["ip"] for attr in attrs] == [
+        "10.12.0.3", "10.12.0.2", "10.12.0.4"
+    ]
+    assert {attr["netmask"] for attr in attrs} == {"255.255.255.0"}
+
+def test_reserve_ip():
+    ipnet = IPNet("10.13.0.0/24", unique_ips=False)
+    ipnet.reserve_ip("10.13.0.1")
+    assert ipnet.get_ips(count=1) == ["10.13.0.2"]
+    with pytest.raises(KeyError):
+        ipnet.reserve_ip("10.13.0.2")
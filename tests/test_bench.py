@@ -0,0 +1,87 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import gzip
+import json
+import os
+import shutil
+
+import pytest
+
+from vmcloak.bench import StandInAgent, bench_restore, percentiles
+
+QEMU_STUB = os.path.join(os.path.dirname(__file__), "files", "qemu-stub.py")
+
+def test_percentiles():
+    stats = percentiles([float(i) for i in range(1, 101)])
+    assert stats["p50"] == 50
+    assert stats["p90"] == 90
+    assert stats["p99"] == 99
+    assert stats["max"] == 100
+    assert stats["mean"] == 50.5
+    assert percentiles([]) == {}
+
+def _snapshot_dir(tmp_path, agent, **fields):
+    machine = {
+        "name": "win10_1", "ip": agent.ipaddr, "agent_port": agent.port,
+        "disk": "disk.qcow2", "memory_snapshot": "memory.snapshot",
+        "start_args": [
+            "-m", "2048",
+            "-drive", "file=%DISPOSABLE_DISK_PATH%,format=qcow2,if=none,"
+                      "id=disk",
+        ],
+    }
+    machine.update(fields)
+    with open(tmp_path / "machineinfo.json", "w") as fp:
+        json.dump({"machinery": "qemu", "machinery_version": "6.2.0",
+                   "machine": machine}, fp)
+    return str(tmp_path)
+
+@pytest.mark.skipif(not shutil.which("gzip"), reason="gzip not installed")
+def test_bench_restore(tmp_path):
+    (tmp_path / "memory.snapshot").write_bytes(gzip.compress(b"m" * 4096))
+    with StandInAgent() as agent:
+        results = bench_restore(
+            _snapshot_dir(tmp_path, agent), count=3, qemu_binary=QEMU_STUB
+        )
+
+    assert results["failed"] == 0
+    assert results["codec"] == "gzip"
+    assert results["ramsize"] == "2048"
+    assert len(results["runs"]) == 3
+    for run in results["runs"]:
+        assert run["total"] >= run["spawn"] + run["ram_load"] + run["agent"]
+    assert results["summary"]["total"]["p50"] > 0
+
+def test_bench_restore_mapped_ram(tmp_path, monkeypatch):
+    (tmp_path / "memory.snapshot").write_bytes(b"m" * 4096)
+    log = tmp_path / "qmp.log"
+    monkeypatch.setenv("QEMU_STUB_LOG", str(log))
+    with StandInAgent() as agent:
+        vm_dir = _snapshot_dir(
+            tmp_path, agent, memory_snapshot_format="mapped-ram",
+            memory_snapshot_capabilities=["mapped-ram", "multifd"],
+            memory_snapshot_parameters={"multifd-channels": 4}
+        )
+        results = bench_restore(vm_dir, count=1, qemu_binary=QEMU_STUB)
+
+    assert results["failed"] == 0
+    calls = [
+        (call["execute"], call.get("arguments"))
+        for call in map(json.loads, log.read_text().splitlines())
+    ]
+    # Both are set before the memory snapshot is loaded.
+    incoming = [cmd for cmd, _ in calls].index("migrate-incoming")
+    assert ("migrate-set-capabilities", {"capabilities": [
+        {"capability": "mapped-ram", "state": True},
+        {"capability": "multifd", "state": True},
+    ]}) in calls[:incoming]
+    assert ("migrate-set-parameters", {"multifd-channels": 4}) in \
+        calls[:incoming]
+
+def test_bench_restore_failed(tmp_path):
+    with StandInAgent() as agent:
+        vm_dir = _snapshot_dir(tmp_path, agent)
+    with pytest.raises(ValueError, match="memory.snapshot"):
+        bench_restore(vm_dir, count=1, qemu_binary=QEMU_STUB)
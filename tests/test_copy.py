@@ -0,0 +1,54 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import os
+import stat
+
+from vmcloak import misc
+from vmcloak.misc import copytree, copytreeinto, copytreelower
+
+def _tree(root):
+    (root / "Sources" / "SXS").mkdir(parents=True)
+    (root / "Setup.EXE").write_bytes(b"setup")
+    (root / "Sources" / "Install.WIM").write_bytes(b"w" * 300000)
+    (root / "Sources" / "SXS" / "a.CAB").write_bytes(b"")
+    os.chmod(root / "Setup.EXE", 0o555)
+
+def test_copytreelower(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    _tree(src)
+    dst.mkdir()
+    copytreelower(str(src), str(dst))
+
+    assert (dst / "setup.exe").read_bytes() == b"setup"
+    assert (dst / "sources" / "install.wim").read_bytes() == b"w" * 300000
+    assert (dst / "sources" / "sxs" / "a.cab").exists()
+    assert stat.S_IMODE(os.stat(dst / "setup.exe").st_mode) == 0o600
+
+def test_copytreeinto(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    _tree(src)
+    (dst / "Sources").mkdir(parents=True)
+    (dst / "other").write_bytes(b"other")
+    copytreeinto(str(src), str(dst))
+
+    assert (dst / "Sources" / "Install.WIM").stat().st_size == 300000
+    assert (dst / "other").read_bytes() == b"other"
+    assert stat.S_IMODE(os.stat(dst / "Setup.EXE").st_mode) == 0o555
+
+def test_copy_fallback(tmp_path, monkeypatch):
+    def fail(*args):
+        raise OSError("not supported")
+
+    monkeypatch.setattr(misc.fcntl, "ioctl", fail)
+    monkeypatch.setattr(os, "copy_file_range", fail, raising=False)
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    _tree(src)
+    stats = copytree(str(src), str(dst), lower=True)
+
+    assert stats.files == 3
+    assert stats.bytes == 300005
+    assert stats.methods == {"copy": 3}
+    assert (dst / "sources" / "install.wim").read_bytes() == b"w" * 300000
+    assert "3 files" in str(stats)
@@ -0,0 +1,91 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import io
+import json
+import tarfile
+
+import pytest
+
+from vmcloak import depcache
+from vmcloak.depbundle import write_bundle, read_bundle
+from vmcloak.depcache import DepCache
+from vmcloak.exceptions import BundleError
+
+def test_roundtrip(tmp_path, monkeypatch):
+    src = DepCache(str(tmp_path / "src"))
+    (tmp_path / "src").mkdir()
+    for name in ("a.exe", "b.msu"):
+        (tmp_path / "src" / name).write_bytes(name.encode() * 1000)
+
+    buf = io.BytesIO()
+    manifest = write_bundle(
+        buf, [str(tmp_path / "src" / n) for n in ("a.exe", "b.msu")], src,
+        meta={"osversion": "win10x64"}
+    )
+    assert manifest["osversion"] == "win10x64"
+
+    # Importing hashes the files while unpacking, not by reading them again.
+    def hash_file(*args):
+        raise AssertionError("hashed")
+    monkeypatch.setattr(depcache, "hash_file", hash_file)
+
+    dst = DepCache(str(tmp_path / "dst"))
+    buf.seek(0)
+    _, written = read_bundle(buf, dst)
+    assert written == ["a.exe", "b.msu"]
+    assert (tmp_path / "dst" / "a.exe").read_bytes() == b"a.exe" * 1000
+    assert dst.sha1(str(tmp_path / "dst" / "b.msu")) == \
+        manifest["files"][1]["sha1"]
+
+    buf.seek(0)
+    assert read_bundle(buf, dst)[1] == []
+
+def test_not_a_bundle(tmp_path):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        info = tarfile.TarInfo("../evil")
+        tar.addfile(info, io.BytesIO())
+
+    buf.seek(0)
+    with pytest.raises(BundleError):
+        read_bundle(buf, DepCache(str(tmp_path)))
+
+def _bundle(manifest, members):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        data = json.dumps(manifest).encode()
+        info = tarfile.TarInfo("vmcloak-bundle.json")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    buf.seek(0)
+    return buf
+
+@pytest.mark.parametrize("name", [".index.json", "a.exe.part"])
+def test_reserved_names(tmp_path, name):
+    entry = {"name": name, "size": 2, "sha1": "0" * 40, "sha256": "0" * 64}
+    buf = _bundle({"version": 1, "files": [entry]}, [(name, b"{}")])
+    with pytest.raises(BundleError):
+        read_bundle(buf, DepCache(str(tmp_path)))
+    assert not (tmp_path / name).exists()
+
+def test_hash_mismatch(tmp_path):
+    src = DepCache(str(tmp_path / "src"))
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "a.exe").write_bytes(b"a" * 1000)
+    buf = io.BytesIO()
+    manifest = write_bundle(buf, [str(tmp_path / "src" / "a.exe")], src)
+
+    manifest["files"][0]["sha256"] = "0" * 64
+    buf = _bundle(manifest, [("a.exe", b"a" * 1000)])
+    dst = DepCache(str(tmp_path / "dst"))
+    with pytest.raises(BundleError):
+        read_bundle(buf, dst)
+    assert not (tmp_path / "dst" / "a.exe").exists()
+    assert not (tmp_path / "dst" / "a.exe.part").exists()
+    assert dst.load() == {}
@@ -0,0 +1,103 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import hashlib
+import os
+
+from vmcloak import depcache
+from vmcloak.depcache import DepCache
+
+def _counting_hash_file(monkeypatch):
+    calls = []
+
+    def hash_file(path, algorithms):
+        calls.append(path)
+        return orig(path, algorithms)
+
+    orig = depcache.hash_file
+    monkeypatch.setattr(depcache, "hash_file", hash_file)
+    return calls
+
+def test_hash_once(tmp_path, monkeypatch):
+    calls = _counting_hash_file(monkeypatch)
+    path = tmp_path / "a.exe"
+    path.write_bytes(b"a")
+
+    cache = DepCache(str(tmp_path))
+    assert cache.sha1(str(path)) == hashlib.sha1(b"a").hexdigest()
+    assert DepCache(str(tmp_path)).sha1(str(path)) == \
+        hashlib.sha1(b"a").hexdigest()
+    assert len(calls) == 1
+
+    path.write_bytes(b"bb")
+    assert cache.sha1(str(path)) == hashlib.sha1(b"bb").hexdigest()
+    assert cache.hashes(str(path))["sha256"] == \
+        hashlib.sha256(b"bb").hexdigest()
+    assert len(calls) == 2
+
+def test_verify(tmp_path):
+    path = tmp_path / "a.exe"
+    path.write_bytes(b"a")
+    (tmp_path / "b.exe").write_bytes(b"b")
+
+    cache = DepCache(str(tmp_path))
+    assert [s for _, s, _ in cache.verify()] == ["hashed", "hashed"]
+
+    # Change the contents without changing the stat signature.
+    st = os.stat(path)
+    path.write_bytes(b"c")
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.remove(tmp_path / "b.exe")
+
+    assert [s for _, s, _ in cache.verify()] == ["ok"]
+    assert [s for _, s, _ in cache.verify(full=True)] == ["corrupt"]
+    assert list(cache.load()) == ["a.exe"]
+    assert cache.sha1(str(path)) == hashlib.sha1(b"c").hexdigest()
+
+def test_verify_loads_once(tmp_path, monkeypatch):
+    for idx in range(20):
+        (tmp_path / f"{idx}.exe").write_bytes(b"x")
+    cache = DepCache(str(tmp_path))
+    list(cache.verify())
+
+    loads = []
+    load = cache.load
+    monkeypatch.setattr(cache, "load", lambda: loads.append(1) or load())
+    (tmp_path / "new.exe").write_bytes(b"y")
+    statuses = [s for _, s, _ in cache.verify()]
+    assert statuses.count("hashed") == 1 and statuses.count("ok") == 20
+    # The scan and the update.
+    assert len(loads) == 2
+    assert len(cache.load()) == 21
+
+def test_gc(tmp_path):
+    cache = DepCache(str(tmp_path))
+    for name, last_used in (("old.exe", 100), ("new.exe", 300),
+                            ("pinned.exe", 50), ("mid.exe", 200)):
+        path = tmp_path / name
+        path.write_bytes(b"x" * 10)
+        cache.record(str(path), sha1="0" * 40)
+        with cache.update() as files:
+            files[name]["last_used"] = last_used
+
+    removed, total = cache.gc(25, pinned={"pinned.exe"}, dry_run=True)
+    assert removed == [("old.exe", 10), ("mid.exe", 10)]
+    assert total == 20
+    assert (tmp_path / "old.exe").exists()
+
+    removed, total = cache.gc(25, pinned={"pinned.exe"})
+    assert [name for name, _ in removed] == ["old.exe", "mid.exe"]
+    assert sorted(os.listdir(tmp_path)) == [
+        ".index.json", ".index.lock", "new.exe", "pinned.exe"
+    ]
+    assert set(cache.load()) == {"new.exe", "pinned.exe"}
+
+    cache.touch(str(tmp_path / "new.exe"))
+    (tmp_path / "big.exe.part").write_bytes(b"x" * 100)
+    (tmp_path / "big.exe.part.json").write_text("{}")
+    removed, total = cache.gc(0, pinned={"pinned.exe"})
+    assert removed == [("new.exe", 10)]
+    assert total == 10
+    assert (tmp_path / "big.exe.part").exists()
+    assert (tmp_path / "big.exe.part.json").exists()
@@ -0,0 +1,78 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import hashlib
+import time
+
+import requests
+
+from vmcloak.abstract import Dependency
+from vmcloak.depcache import DepCache
+from vmcloak.depserver import DepServer
+from vmcloak.dependencies.vcredist import VcRedist
+from vmcloak.downloader import download
+
+BLOB = bytes(range(256)) * 1024
+SHA1 = hashlib.sha1(BLOB).hexdigest()
+
+def test_serve(tmp_path):
+    cache_path = tmp_path / "deps"
+    cache_path.mkdir()
+    (cache_path / "setup.exe").write_bytes(BLOB)
+
+    with DepServer(("127.0.0.1", 0), DepCache(str(cache_path))) as server:
+        url = f"{server.url}/sha1/{SHA1}"
+        assert requests.get(url).content == BLOB
+
+        resp = requests.get(url, headers={"Range": "bytes=10-19"})
+        assert resp.status_code == 206
+        assert resp.content == BLOB[10:20]
+
+        assert requests.get(f"{server.url}/sha1/{'0' * 40}").status_code \
+            == 404
+
+        # Files downloaded after the server started are in the index.
+        cache = DepCache(str(cache_path))
+        (cache_path / "other.exe").write_bytes(b"other")
+        cache.hashes(str(cache_path / "other.exe"))
+        other = hashlib.sha1(b"other").hexdigest()
+        server._loaded = 0
+        assert requests.get(f"{server.url}/sha1/{other}").content == b"other"
+
+        # Other new files are hashed by the scanner thread after a miss.
+        (cache_path / "copied.exe").write_bytes(b"copied")
+        copied = f"{server.url}/sha1/{hashlib.sha1(b'copied').hexdigest()}"
+        assert requests.get(copied).status_code == 404
+        for _ in range(100):
+            if server.find(hashlib.sha1(b"copied").hexdigest()):
+                break
+            time.sleep(0.05)
+        assert requests.get(copied).content == b"copied"
+
+        success, sha1 = download([url], str(tmp_path / "setup.exe"), SHA1)
+
+    assert success and sha1 == SHA1
+    assert (tmp_path / "setup.exe").read_bytes() == BLOB
+
+def test_missing_cached(tmp_path, monkeypatch):
+    server = DepServer(("127.0.0.1", 0), DepCache(str(tmp_path)))
+    try:
+        loads = []
+        monkeypatch.setattr(server, "rescan", lambda: 0)
+        monkeypatch.setattr(
+            server.cache, "load", lambda: loads.append(1) or {}
+        )
+        server._loaded = 0
+        assert server.find("0" * 40) is None
+        assert server.find("0" * 40) is None
+        assert server.find("1" * 40) is None
+        assert len(loads) == 1
+    finally:
+        server.server_close()
+
+def test_mirror_first(monkeypatch):
+    monkeypatch.setattr(Dependency, "mirror", "http://mirror:8080")
+    _, urls, sha1, _ = VcRedist.plan_downloads("win7x64", "amd64", "2005")[0]
+    assert urls[0] == f"http://mirror:8080/sha1/{sha1}"
+    assert urls[1].endswith("vcredist_x64.exe")
@@ -0,0 +1,69 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import hashlib
+
+from vmcloak.misc import download_file
+
+BLOB = bytes(range(256)) * 16384
+
+def test_resume_after_drops(tmp_path, http_server):
+    server = http_server({"/file.iso": BLOB}, etag='"v1"', drops=2)
+    target = tmp_path / "file.iso"
+    success, sha1 = download_file(
+        server.url("/file.iso"), str(target), retries=3
+    )
+
+    assert success
+    assert sha1 == hashlib.sha1(BLOB).hexdigest()
+    assert target.read_bytes() == BLOB
+    assert not (tmp_path / "file.iso.part").exists()
+    assert len(server.requests) == 3
+    assert "Range" not in server.requests[0]
+    assert server.requests[1]["Range"] == f"bytes={len(BLOB) // 2}-"
+    assert server.requests[2]["If-Range"] == '"v1"'
+
+def test_resume_next_call(tmp_path, http_server):
+    server = http_server({"/file.iso": BLOB}, etag='"v1"', drops=1)
+    url = server.url("/file.iso")
+    target = tmp_path / "file.iso"
+    assert download_file(url, str(target), retries=0) == (False, None)
+    assert (tmp_path / "file.iso.part").exists()
+
+    # The file changed on the server, the full file is sent again.
+    server.etag = '"v2"'
+    success, sha1 = download_file(url, str(target), retries=0)
+
+    assert success
+    assert sha1 == hashlib.sha1(BLOB).hexdigest()
+    assert target.read_bytes() == BLOB
+    assert server.requests[1]["If-Range"] == '"v1"'
+
+def test_encoded_response(tmp_path, http_server):
+    """Content-Length counts the encoded bytes, so the file is asked for
+    as it is."""
+    server = http_server({"/file.iso": BLOB}, gzip=True)
+    target = tmp_path / "file.iso"
+    success, sha1 = download_file(
+        server.url("/file.iso"), str(target), retries=0
+    )
+
+    assert success
+    assert sha1 == hashlib.sha1(BLOB).hexdigest()
+    assert server.requests[0]["Accept-Encoding"] == "identity"
+
+def test_resume_wrong_range(tmp_path, http_server):
+    server = http_server({"/file.iso": BLOB}, etag='"v1"', drops=1)
+    url = server.url("/file.iso")
+    target = tmp_path / "file.iso"
+    assert download_file(url, str(target), retries=0) == (False, None)
+
+    # A range that does not start at the end of the part is not appended.
+    server.wrong_range = True
+    success, sha1 = download_file(url, str(target), retries=1)
+
+    assert success
+    assert target.read_bytes() == BLOB
+    assert server.requests[1]["Range"] == f"bytes={len(BLOB) // 2}-"
+    assert "Range" not in server.requests[2]
@@ -0,0 +1,54 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import hashlib
+
+from vmcloak import downloader
+
+BLOB = bytes(range(256)) * 4096
+
+def test_segmented_download(tmp_path, monkeypatch, http_server):
+    monkeypatch.setattr(downloader, "SEGMENT_SIZE", 64 * 1024)
+    monkeypatch.setattr(downloader, "MIN_SEGMENTED_SIZE", 128 * 1024)
+
+    good = http_server({"/file.exe": BLOB})
+    # Only answers the probe request and drops the connection after that.
+    broken = http_server({"/file.exe": BLOB}, answers=1)
+    target = tmp_path / "file.exe"
+    success, sha1 = downloader.download(
+        ["http://127.0.0.1:1/file.exe", broken.url("/file.exe"),
+         good.url("/file.exe")],
+        str(target), hashlib.sha1(BLOB).hexdigest()
+    )
+
+    assert success
+    assert sha1 == hashlib.sha1(BLOB).hexdigest()
+    assert target.read_bytes() == BLOB
+    # Probe plus all segments.
+    assert len(good.requests) > len(BLOB) // (64 * 1024)
+    # The broken mirror was dropped after a few failed segments.
+    assert len(broken.requests) <= 1 + 2 * downloader.CONNECTIONS
+
+def test_sha1_mismatch(tmp_path, http_server):
+    server = http_server({"/file.exe": BLOB})
+    target = tmp_path / "file.exe"
+    assert downloader.download(
+        [server.url("/file.exe")], str(target), "0" * 40
+    ) == (False, None)
+    assert not target.exists()
+
+def test_encoding_server(tmp_path, monkeypatch, http_server):
+    monkeypatch.setattr(downloader, "SEGMENT_SIZE", 64 * 1024)
+    monkeypatch.setattr(downloader, "MIN_SEGMENTED_SIZE", 128 * 1024)
+
+    server = http_server({"/file.exe": BLOB}, gzip=True)
+    target = tmp_path / "file.exe"
+    assert downloader.download(
+        [server.url("/file.exe")], str(target), hashlib.sha1(BLOB).hexdigest()
+    ) == (True, hashlib.sha1(BLOB).hexdigest())
+    assert all(
+        headers["Accept-Encoding"] == "identity"
+        for headers in server.requests
+    )
+    assert len(server.requests) > len(BLOB) // (64 * 1024)
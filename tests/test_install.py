@@ -0,0 +1,45 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import hashlib
+import threading
+
+from vmcloak.dependencies.vcredist import VcRedist
+from vmcloak.install import prefetch_downloads
+
+def test_plan_downloads():
+    planned = VcRedist.plan_downloads("win7x64", "amd64", "2005")
+    assert len(planned) == 1
+    filepath, urls, sha1, _ = planned[0]
+    assert filepath.endswith("vcredist_x64.exe")
+    assert sha1 == "90a3d2a139c1a106bfccd98cbbd7c2c1d79f5ebe"
+
+def test_prefetch_downloads(tmp_path, http_server):
+    (tmp_path / "b.exe").write_bytes(b"B" * 1024)
+    server = http_server({"/a.exe": b"A" * 4096, "/b.exe": b"B" * 1024})
+    summary = prefetch_downloads([
+        (str(tmp_path / "a.exe"), [server.url("/a.exe")],
+         hashlib.sha1(b"A" * 4096).hexdigest(), None),
+        (str(tmp_path / "b.exe"), [server.url("/b.exe")],
+         hashlib.sha1(b"B" * 1024).hexdigest(), None),
+        (str(tmp_path / "c.exe"), [server.url("/c.exe")], None, None),
+    ], workers=2)
+
+    assert (tmp_path / "a.exe").read_bytes() == b"A" * 4096
+    assert summary["downloaded"] == 1
+    assert summary["bytes"] == 4096
+    assert summary["cached"] == 1
+    assert summary["failed"] == 1
+
+def test_prefetch_stopped(tmp_path, http_server):
+    server = http_server({"/a.exe": b"A"})
+    stop = threading.Event()
+    stop.set()
+    summary = prefetch_downloads([
+        (str(tmp_path / "a.exe"), [server.url("/a.exe")], None, None),
+    ], stop=stop)
+
+    assert summary["skipped"] == 1
+    assert not server.requests
+    assert not (tmp_path / "a.exe").exists()
@@ -0,0 +1,167 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import os
+
+from vmcloak import main
+from vmcloak.isocache import StaticISOCache, static_iso_key
+from vmcloak.isowriter import build_iso
+from vmcloak.misc import copyfileslower, graft_points
+from vmcloak.win10 import Windows10x64
+
+def _tree(root, files):
+    for relpath, data in files.items():
+        path = root / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+def test_graft_points(tmp_path):
+    mount, outdir = tmp_path / "mount", tmp_path / "out"
+    _tree(mount, {
+        "Setup.EXE": b"setup",
+        "Sources/Product.ini": b"[BuildInfo]",
+        "sources/install.wim": b"wim",
+        "odd=name.txt": b"",
+    })
+    (mount / "Empty").mkdir()
+    outdir.mkdir()
+    copyfileslower(
+        str(mount), str(outdir), [os.path.join("sources", "product.ini")]
+    )
+    assert (outdir / "sources" / "product.ini").read_bytes() == \
+        b"[BuildInfo]"
+    _tree(outdir, {"boot.img": b"boot", "autounattend.xml": b"xml"})
+
+    specs = graft_points(str(mount), str(outdir))
+    assert sorted(specs) == sorted([
+        f"setup.exe={mount}/Setup.EXE",
+        f"sources/install.wim={mount}/sources/install.wim",
+        f"odd\\=name.txt={mount}/odd\\=name.txt",
+        f"empty/={mount}/Empty",
+        f"/={outdir}",
+    ])
+
+class _FakeOS(object):
+    name = "win10"
+    arch = "amd64"
+    osdir = "sources/$oem$/$1"
+    genisoargs = []
+
+    def __init__(self, root):
+        self.path = str(root / "data")
+        self.bootstrap_path = str(root / "bootstrap")
+        _tree(root, {
+            "data/boot.img": b"boot", "bootstrap/bootstrap.bat": b"bat",
+            "bootstrap/agent/agent.exe": b"agent",
+        })
+        self.built = []
+
+    def find_agent_binary(self):
+        return os.path.join(self.bootstrap_path, "agent", "agent.exe"), ".exe"
+
+    def buildstatic(self, mount, newiso, bootstrap, tmp_dir, graft):
+        self.built.append(newiso)
+        with open(newiso, "wb") as fp:
+            fp.write(b"iso")
+        return "abcdefgh.exe"
+
+def test_static_iso_cache(tmp_path):
+    h = _FakeOS(tmp_path)
+    mount, extra = tmp_path / "mount", tmp_path / "extra"
+    _tree(mount, {"setup.exe": b"setup"})
+    _tree(extra, {"vmcloak/python.exe": b"python"})
+
+    key = static_iso_key(h, str(mount), str(extra))
+    assert static_iso_key(h, str(mount), str(extra)) == key
+    assert static_iso_key(h, str(mount), str(extra), graft=False) != key
+
+    cache = StaticISOCache(str(tmp_path / "iso"))
+    isopath, meta = cache.get(h, str(mount), str(extra))
+    assert meta["agent"] == "abcdefgh.exe"
+    assert open(isopath, "rb").read() == b"iso"
+    assert cache.get(h, str(mount), str(extra)) == (isopath, meta)
+    assert len(h.built) == 1
+
+    (extra / "vmcloak" / "python.exe").write_bytes(b"python 3.8")
+    assert static_iso_key(h, str(mount), str(extra)) != key
+    other, _ = cache.get(h, str(mount), str(extra))
+    assert other != isopath
+    assert len(h.built) == 2
+
+def test_build_iso():
+    data = build_iso({
+        "autounattend.xml": b"<unattend/>", "vmcloak/settings.bat": b"set A=1",
+    }, "VMCLOAK")
+    assert len(data) % 2048 == 0
+    assert data[16*2048:16*2048 + 6] == b"\x01CD001"
+    assert data[16*2048 + 40:16*2048 + 47] == b"VMCLOAK"
+    # Joliet supplementary volume descriptor and the terminator.
+    assert data[17*2048:17*2048 + 6] == b"\x02CD001"
+    assert data[17*2048 + 88:17*2048 + 91] == b"%/E"
+    assert data[18*2048:18*2048 + 6] == b"\xffCD001"
+    assert "autounattend.xml".encode("utf-16-be") in data
+    assert b"AUTOUNAT.XML;1" in data
+    assert data.index(b"<unattend/>") % 2048 == 0
+
+def test_buildconfig(tmp_path):
+    mount = tmp_path / "mount"
+    _tree(mount, {"Sources/PRODUCT.INI": b"[BuildInfo]\nstaged=home,pro\n"})
+
+    h = Windows10x64()
+    h.configure(tempdir=str(tmp_path), product=None)
+    h.set_serial_key(None)
+    env_vars = {
+        "GUEST_IP": "192.168.30.10", "GUEST_MASK": "255.255.255.0",
+        "GUEST_GATEWAY": "192.168.30.1",
+    }
+    files = h.configfiles(str(mount), env_vars=env_vars)
+    assert list(files) == ["autounattend.xml"]
+    xml = files["autounattend.xml"].decode()
+    assert "Windows 10 PRO" in xml and "192.168.30.10/24" in xml
+
+    iso = tmp_path / "config.iso"
+    assert h.buildconfig(str(mount), str(iso), "abc.exe", env_vars=env_vars)
+    data = iso.read_bytes()
+    assert b"set AGENT_SOURCE=abc.exe\n" in data
+    assert b"set GUEST_IP=192.168.30.10\n" in data
+    assert env_vars["AGENT_FILE"].endswith(".exe")
+
+class _FakePlatform(object):
+    disk_format = "qcow2"
+
+    def __init__(self):
+        self.isos = []
+
+    def create_new_image(self, name, _, iso_path, attr):
+        self.isos.append((iso_path, attr.get("config_iso")))
+        attr["mac"] = "52:54:00:00:00:01"
+
+    def remove_vm_data(self, name):
+        pass
+
+def test_build_image_single_iso(tmp_path, monkeypatch):
+    def create_iso(iso_path, attr):
+        open(iso_path, "wb").close()
+
+    def create_split_iso(name, attr):
+        config_iso = tmp_path / f"{name}-config.iso"
+        config_iso.write_bytes(b"")
+        return "static.iso", str(config_iso)
+
+    monkeypatch.setattr(main, "_create_iso", create_iso)
+    monkeypatch.setattr(main, "_create_split_iso", create_split_iso)
+
+    attr = main.init.make_context("init", ["a", "br0"]).params
+    attr.update(
+        win10x64=True, tempdir=str(tmp_path), ip="10.0.0.2",
+        netmask="255.255.255.0", gateway="10.0.0.1"
+    )
+    p = _FakePlatform()
+    assert main._build_image("a", "qemu", p, dict(attr))
+    assert main._build_image("b", "qemu", p, dict(attr, single_iso=True))
+    assert p.isos == [
+        ("static.iso", str(tmp_path / "a-config.iso")),
+        (str(tmp_path / "b.iso"), None),
+    ]
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,189 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import os
+import struct
+
+import pytest
+
+from vmcloak import isowriter
+from vmcloak.exceptions import ISOError
+from vmcloak.isoreader import ISOImage
+from vmcloak.isowriter import ISOWriter
+from vmcloak.win10 import Windows10x64
+
+PRODUCT_INI = b"[BuildInfo]\nstaged=home,pro\n"
+
+def _tag(tag):
+    return struct.pack("<H", tag).ljust(16, b"\x00")
+
+def _long_ad(length, lbn):
+    return struct.pack("<IIH", length, lbn, 0).ljust(16, b"\x00")
+
+def _fid(name, lbn, characteristics=0):
+    ident = b"\x08" + name.encode() if name else b""
+    fid = _tag(257) + struct.pack("<HBB", 1, characteristics, len(ident))
+    fid += _long_ad(2048, lbn) + struct.pack("<H", 0) + ident
+    return fid.ljust((len(fid) + 3) & ~3, b"\x00")
+
+def _file_entry(is_dir, size, adtype, ads, extended=False):
+    fe = bytearray(2048)
+    fe[0:16] = _tag(266 if extended else 261)
+    fe[16 + 11] = 4 if is_dir else 5
+    struct.pack_into("<H", fe, 16 + 18, adtype)
+    struct.pack_into("<Q", fe, 56, size)
+    start = 208 if extended else 168
+    struct.pack_into("<II", fe, start, 0, len(ads))
+    fe[start + 8:start + 8 + len(ads)] = ads
+    return bytes(fe)
+
+def _udf_image(path):
+    """A small UDF image the way Windows installer ISOs are made: an
+    ISO9660 tree with only a readme and the files in the UDF tree."""
+    sectors = [b""] * 300
+    partition = 270
+
+    writer = ISOWriter("WIN10")
+    writer.add_file("README.TXT", b"This disc contains a UDF file system")
+    iso9660 = writer.getvalue()
+    for number in range(len(iso9660) // 2048):
+        sectors[number] = iso9660[number * 2048:(number + 1) * 2048]
+
+    anchor = bytearray(2048)
+    anchor[0:16] = _tag(2)
+    struct.pack_into("<II", anchor, 16, 3 * 2048, 257)
+    sectors[256] = bytes(anchor)
+
+    pd = bytearray(2048)
+    pd[0:16] = _tag(5)
+    struct.pack_into("<H", pd, 22, 0)
+    struct.pack_into("<II", pd, 188, partition, 20)
+    sectors[257] = bytes(pd)
+
+    lvd = bytearray(2048)
+    lvd[0:16] = _tag(6)
+    lvd[84:84 + 6] = b"\x08WIN10"
+    lvd[84 + 127] = 6
+    struct.pack_into("<I", lvd, 212, 2048)
+    lvd[248:264] = _long_ad(2048, 0)
+    struct.pack_into("<II", lvd, 264, 6, 1)
+    lvd[440:446] = bytes((1, 6)) + struct.pack("<HH", 1, 0)
+    sectors[258] = bytes(lvd)
+    sectors[259] = _tag(8)
+
+    blocks = {}
+    fsd = bytearray(2048)
+    fsd[0:16] = _tag(256)
+    fsd[400:416] = _long_ad(2048, 1)
+    blocks[0] = bytes(fsd)
+
+    root = _fid("", 1, 8 | 2) + _fid("Sources", 3, 2) + _fid("setup.exe", 5)
+    blocks[1] = _file_entry(True, len(root), 0, struct.pack("<II", len(root), 2))
+    blocks[2] = root
+
+    sources = _fid("", 1, 8 | 2) + _fid("PRODUCT.INI", 6)
+    blocks[3] = _file_entry(
+        True, len(sources), 0, struct.pack("<II", len(sources), 4)
+    )
+    blocks[4] = sources
+
+    # Embedded data and, for product.ini, two extents.
+    blocks[5] = _file_entry(False, 5, 3, b"setup")
+    data = b";" * 2048 + b"\n" + PRODUCT_INI
+    blocks[6] = _file_entry(
+        False, len(data), 1,
+        _long_ad(2048, 7) + _long_ad(len(data) - 2048, 9), extended=True
+    )
+    blocks[7] = data[:2048]
+    blocks[9] = data[2048:]
+
+    for lbn, block in blocks.items():
+        sectors[partition + lbn] = block
+
+    with open(path, "wb") as fp:
+        for sector in sectors:
+            fp.write(sector.ljust(2048, b"\x00"))
+
+def test_udf(tmp_path):
+    path = str(tmp_path / "win10.iso")
+    _udf_image(path)
+
+    with ISOImage(path) as image:
+        assert image.filesystem == "udf"
+        assert image.volume_id == "WIN10"
+        assert [(p, e.is_dir) for p, e in image.walk()] == [
+            ("Sources", True), ("Sources/PRODUCT.INI", False),
+            ("setup.exe", False),
+        ]
+        assert image.read("setup.exe") == b"setup"
+        assert image.read("sources/product.ini").endswith(PRODUCT_INI)
+        assert image.read("sources/missing.ini") is None
+
+def test_joliet_multi_extent(tmp_path, monkeypatch):
+    monkeypatch.setattr(isowriter, "MAX_EXTENT", 4096)
+    writer = ISOWriter("TEST")
+    writer.add_file("Sources/install.wim", bytes(range(256)) * 50)
+    writer.add_directory("empty")
+    path = tmp_path / "test.iso"
+    path.write_bytes(writer.getvalue())
+
+    with ISOImage(str(path)) as image:
+        assert image.filesystem == "joliet"
+        entry = image.find("SOURCES/INSTALL.WIM")
+        assert len(entry.extents) == 4
+        assert entry.read() == bytes(range(256)) * 50
+        assert image.find("empty").is_dir
+
+def test_streamiso_large_file(tmp_path, monkeypatch):
+    """Windows Setup cannot read multi-extent files, so building from the
+    image is refused instead."""
+    path = str(tmp_path / "win10.iso")
+    _udf_image(path)
+    monkeypatch.setattr(isowriter, "MAX_EXTENT", 4)
+    newiso = tmp_path / "new.iso"
+    h = Windows10x64()
+    with ISOImage(path) as image:
+        assert h._streamiso(str(newiso), str(tmp_path), image) is False
+    assert not newiso.exists()
+
+def test_invalid(tmp_path):
+    path = tmp_path / "invalid.iso"
+    path.write_bytes(b"\x00" * 40000)
+    with pytest.raises(ISOError):
+        ISOImage(str(path))
+
+def test_buildstatic_from_image(tmp_path, monkeypatch):
+    path = str(tmp_path / "win10.iso")
+    _udf_image(path)
+    agent = tmp_path / "agent.exe"
+    agent.write_bytes(b"agent")
+    extra = tmp_path / "extra"
+    (extra / "vmcloak").mkdir(parents=True)
+    (extra / "vmcloak" / "python.exe").write_bytes(b"python")
+
+    h = Windows10x64()
+    h.configure(tempdir=str(tmp_path), product=None)
+    h.set_serial_key(None)
+    monkeypatch.setattr(h, "find_agent_binary", lambda: (str(agent), ".exe"))
+
+    newiso = str(tmp_path / "static.iso")
+    with ISOImage(path) as image:
+        agent_file = h.buildstatic(image, newiso, str(extra), str(tmp_path))
+        files = h.configfiles(image, env_vars={
+            "GUEST_IP": "192.168.30.10", "GUEST_MASK": "255.255.255.0",
+            "GUEST_GATEWAY": "192.168.30.1",
+        })
+    assert "Windows 10 PRO" in files["autounattend.xml"].decode()
+
+    with ISOImage(newiso) as image:
+        names = [p for p, e in image.walk() if not e.is_dir]
+        assert "setup.exe" in names and "boot.img" in names
+        assert image.read("sources/product.ini").endswith(PRODUCT_INI)
+        osdir = h.osdir.replace(os.sep, "/")
+        assert image.read(f"{osdir}/vmcloak/{agent_file}") == b"agent"
+        assert image.read(f"{osdir}/vmcloak/python.exe") == b"python"
+
+    with open(newiso, "rb") as fp:
+        fp.seek(17 * 2048)
+        assert fp.read(30)[7:30] == b"EL TORITO SPECIFICATION"
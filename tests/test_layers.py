@@ -0,0 +1,95 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import os
+import subprocess
+
+import pytest
+
+from vmcloak.layers import LayerStore, layer_item
+
+@pytest.fixture
+def qemu_img(monkeypatch):
+    """Overlays made by the fake qemu-img contain the path of their
+    backing file."""
+    def check_call(args, **kwargs):
+        backing = args[args.index("-b") + 1]
+        with open(args[-1], "w") as fp:
+            fp.write(backing)
+    monkeypatch.setattr(subprocess, "check_call", check_call)
+
+def _items(*deps):
+    return [layer_item(dep, None, {"ie11.lang": "en"}) for dep in deps]
+
+def test_layer_item():
+    settings = {"office.isopath": "/tmp/o.iso", "officex.a": "1"}
+    assert layer_item("office", "2010", settings) == [
+        "office", "2010", [["office.isopath", "/tmp/o.iso"]]
+    ]
+
+def test_capture_and_branch(tmp_path, qemu_img):
+    store = LayerStore(str(tmp_path / "layers"))
+    disk = tmp_path / "image.qcow2"
+    disk.write_bytes(b"windows")
+    base = store.disk_key(str(disk))
+
+    root = store.adopt(base, "win10x64", str(disk))
+    assert disk.read_text() == store.layer_path(root)
+    assert open(store.layer_path(root), "rb").read() == b"windows"
+
+    items = _items("ie11", "dotnet", "java")
+    disk.write_text("ie11 installed")
+    key = store.capture(
+        root, base, "win10x64", items[:1], str(disk),
+        installed={"ie11": ["11"]}
+    )
+    assert disk.read_text() == store.layer_path(key)
+    assert os.stat(store.layer_path(key)).st_mode & 0o777 == 0o444
+
+    # A copy of the same disk starts from the layer with ie11.
+    other = tmp_path / "other.qcow2"
+    other.write_bytes(b"windows")
+    assert store.find(store.disk_key(str(other)), "win10x64", items) == \
+        (1, key)
+    assert store.find(base, "win7x64", items) == (0, None)
+    assert store.find(base, "win10x64", _items("dotnet")) == (0, None)
+    meta = store.branch(key, str(other))
+    assert meta["installed"] == {"ie11": ["11"]}
+    assert other.read_text() == store.layer_path(key)
+
+    # Other settings for ie11 are another layer.
+    changed = [layer_item("ie11", None, {"ie11.lang": "nl"})]
+    assert store.find(base, "win10x64", changed) == (0, None)
+
+def test_prune(tmp_path, qemu_img):
+    store = LayerStore(str(tmp_path / "layers"))
+    disk = tmp_path / "image.qcow2"
+    disk.write_bytes(b"windows")
+    base = store.disk_key(str(disk))
+    root = store.adopt(base, "win10x64", str(disk))
+    items = _items("ie11", "dotnet", "java")
+    keys = [root]
+    for depth in range(1, 4):
+        keys.append(store.capture(
+            keys[-1], base, "win10x64", items[:depth], str(disk)
+        ))
+
+    # The disk uses the java layer, so the whole chain is in use.
+    chain = [store.layer_path(key) for key in keys]
+    assert store.prune(in_use=chain) == []
+
+    # Without users only pinned layers and their parents remain.
+    store.pin(keys[1])
+    removed = store.prune(dry_run=True)
+    assert [key for key, _ in removed] == [keys[3], keys[2]]
+    assert len(store.load()["layers"]) == 4
+
+    store.prune()
+    assert sorted(store.load()["layers"]) == sorted(keys[:2])
+    assert not os.path.exists(store.layer_path(keys[3]))
+    assert os.path.exists(store.layer_path(keys[0]))
+
+    assert store.resolve(keys[1][:8]) == keys[1]
+    with pytest.raises(KeyError):
+        store.resolve("zz")
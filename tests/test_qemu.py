@@ -0,0 +1,172 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import gzip
+import shutil
+import subprocess
+
+import pytest
+
+from vmcloak.platforms import qemu
+
+class FakeProc(object):
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+    def wait(self):
+        return self.returncode
+
+def _attr(tmp_path, **kwargs):
+    attr = {
+        "ramsize": 2048, "cpus": 2, "adapter": "br0",
+        "mac": "00:11:22:33:44:55", "path": str(tmp_path / "image.qcow2"),
+        "hddsize": 10,
+    }
+    attr.update(kwargs)
+    return attr
+
+CAPS = {
+    "version": "6.2.0", "options": ["-overcommit", "-accel"],
+    "machines": ["q35"], "devices": ["ide-hd", "intel-hda", "hda-duplex"],
+    "accels": ["kvm", "tcg"], "qmp_commands": [],
+    "migration_capabilities": [],
+}
+
+def _drive(args):
+    drives = [args[i + 1] for i, arg in enumerate(args) if arg == "-drive"]
+    return [d for d in drives if "id=disk" in d][0]
+
+def test_fast_build_args(tmp_path, monkeypatch):
+    monkeypatch.setattr(qemu, "capabilities", lambda: CAPS)
+    monkeypatch.setattr(qemu, "_io_uring", True)
+
+    assert "cache=" not in _drive(qemu._make_args(_attr(tmp_path)))
+    drive = _drive(qemu._make_args(_attr(tmp_path, fast_build=True)))
+    assert drive.endswith(",cache=unsafe,aio=io_uring")
+
+    monkeypatch.setattr(qemu, "_io_uring", False)
+    args = qemu._make_args(_attr(tmp_path, fast_build=True),
+                           disk="/dev/shm/overlay.qcow2")
+    assert _drive(args) == (
+        "file=/dev/shm/overlay.qcow2,format=qcow2,if=none,id=disk,"
+        "cache=unsafe,aio=threads"
+    )
+
+    # Snapshot VMs never get the build settings.
+    args = qemu._make_args(_attr(tmp_path, fast_build=True),
+                           disk_placeholder=True)
+    assert "cache=" not in _drive(args)
+
+def test_build_overlay(tmp_path, monkeypatch):
+    calls = []
+    def check_call(args, **kwargs):
+        calls.append(args)
+        if args[:2] == ["qemu-img", "create"]:
+            open(args[-1], "wb").close()
+    monkeypatch.setattr(subprocess, "check_call", check_call)
+
+    attr = _attr(tmp_path, build_overlay=str(tmp_path))
+    overlay = qemu._create_build_overlay("img", attr)
+    assert calls[0][-5:] == ["-b", attr["path"], "-F", "qcow2", overlay]
+    qemu._remove_build_overlay("img", FakeProc(0))
+    assert calls[1] == ["qemu-img", "commit", "-d", overlay]
+    assert not (tmp_path / "vmcloak-img.qcow2").exists()
+
+    # Changes of a VM that did not shut down cleanly are discarded.
+    overlay = qemu._create_build_overlay("img", attr)
+    qemu._remove_build_overlay("img", FakeProc(-9))
+    assert len(calls) == 3
+    assert "img" not in qemu.overlays
+
+def test_compact_disk(tmp_path, monkeypatch):
+    calls = []
+    def check_call(args, **kwargs):
+        calls.append(args)
+        with open(args[-1], "wb") as fp:
+            fp.write(b"q" * 10)
+    monkeypatch.setattr(subprocess, "check_call", check_call)
+
+    path = tmp_path / "image.qcow2"
+    path.write_bytes(b"q" * 100)
+    assert qemu.compact_disk(str(path), compress=True) == (100, 10)
+    assert calls[0][-3:] == ["-c", str(path), f"{path}.compact"]
+    assert path.stat().st_size == 10
+    assert not (tmp_path / "image.qcow2.compact").exists()
+
+    drive = qemu._disk_drive(_attr(tmp_path, compact=True))
+    assert drive.endswith(",discard=unmap,detect-zeroes=unmap")
+
+def test_snapshot_codec(monkeypatch):
+    installed = {"gzip": "/bin/gzip", "cat": "/bin/cat"}
+    monkeypatch.setattr(shutil, "which", installed.get)
+
+    assert qemu.find_snapshot_codec() == ("gzip", "/bin/gzip", 3)
+    assert qemu.find_snapshot_codec("none", 9) == ("none", "/bin/cat", None)
+    with pytest.raises(ValueError, match="not installed"):
+        qemu.find_snapshot_codec("zstd")
+
+    installed["pigz"] = "/bin/pigz"
+    codec = qemu.find_snapshot_codec("gzip", 1)
+    assert qemu._get_exec_args("/vm/memory.snapshot", codec) == (
+        "/bin/pigz -c -1 > /vm/memory.snapshot"
+    )
+    codec = qemu.find_snapshot_codec("none")
+    assert qemu._get_exec_args("/vm/memory.snapshot", codec) == (
+        "/bin/cat > /vm/memory.snapshot"
+    )
+
+def test_snapshot_format(monkeypatch):
+    caps = dict(
+        CAPS, version="9.1.0", qmp_commands=["migrate-set-capabilities"],
+        migration_capabilities=["multifd"]
+    )
+    monkeypatch.setattr(qemu, "capabilities", lambda: caps)
+    assert qemu.check_snapshot_format() == "stream"
+    with pytest.raises(ValueError, match="QEMU 9.0"):
+        qemu.check_snapshot_format("mapped-ram")
+
+    caps["migration_capabilities"] = ["mapped-ram", "multifd"]
+    assert qemu.check_snapshot_format("mapped-ram", "none") == "mapped-ram"
+    with pytest.raises(ValueError, match="cannot be compressed"):
+        qemu.check_snapshot_format("mapped-ram", "zstd")
+
+    # The version decides if QEMU could not be asked over QMP.
+    caps.update(qmp_commands=[], migration_capabilities=[])
+    assert qemu.check_snapshot_format("mapped-ram") == "mapped-ram"
+    caps["version"] = "8.2.0"
+    with pytest.raises(ValueError, match="QEMU 9.0"):
+        qemu.check_snapshot_format("mapped-ram")
+
+def test_restore_exec_args(tmp_path):
+    path = tmp_path / "memory.snapshot"
+    path.write_bytes(gzip.compress(b"memory"))
+    assert qemu.detect_snapshot_codec(str(path)) == "gzip"
+    path.write_bytes(b"memory")
+    assert qemu.detect_snapshot_codec(str(path)) == "none"
+    assert qemu.restore_exec_args(str(path), "none") == (
+        f"{shutil.which('cat')} < {path}"
+    )
+
+def test_machine_args(tmp_path):
+    args = qemu._machine_args(_attr(tmp_path), CAPS)
+    assert "-overcommit" in args
+    assert "ide-hd,bus=ahci.0,unit=0,drive=disk,bootindex=2" in args
+    assert args[-5:] == [
+        "-device", "intel-hda", "-device", "hda-duplex", "-enable-kvm"
+    ]
+
+    old = dict(CAPS, options=["-realtime", "-soundhw"], devices=["ide-drive"],
+               accels=[])
+    args = qemu._machine_args(_attr(tmp_path), old)
+    assert "-realtime" in args and "-overcommit" not in args
+    assert "ide-drive,bus=ahci.0,unit=0,drive=disk,bootindex=2" in args
+    assert args[-3:] == ["-soundhw", "hda", "-enable-kvm"]
+
+    # The binary could not be probed.
+    unknown = dict(CAPS, version="", options=[], devices=[], accels=[])
+    args = qemu._machine_args(_attr(tmp_path), unknown)
+    assert "-overcommit" in args
+    assert "ide-hd,bus=ahci.0,unit=0,drive=disk,bootindex=2" in args
+    old = dict(unknown, version="3.1.0")
+    assert "-realtime" in qemu._machine_args(_attr(tmp_path), old)
@@ -0,0 +1,93 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import os
+import sys
+
+from vmcloak import qemucaps
+
+# Answers like qemu-system-x86_64 6.2 and counts how often it runs.
+FAKE_QEMU = """#!%s
+import sys
+with open(%r, "a") as fp:
+    fp.write(" ".join(sys.argv[1:]) + "\\n")
+args = sys.argv[1:]
+if args == ["--version"]:
+    print("QEMU emulator version 6.2.0 (Debian 1:6.2+dfsg-2ubuntu6)")
+elif args == ["-help"]:
+    print("usage: qemu-system-x86_64 [options] [disk_image]")
+    print("-machine [type=]name[,prop[=value][,...]]")
+    print("-accel [accel=]accelerator[,prop[=value][,...]]")
+    print("-overcommit [mem-lock=on|off][cpu-pm=on|off]")
+elif args == ["-machine", "help"]:
+    print("Supported machines are:")
+    print("q35                  Standard PC (Q35 + ICH9, 2009) (alias of pc-q35-6.2)")
+    print("pc-q35-6.2           Standard PC (Q35 + ICH9, 2009)")
+elif args == ["-device", "help"]:
+    print("Storage devices:")
+    print('name "ide-cd", bus IDE, desc "virtual IDE CD-ROM"')
+    print('name "ide-hd", bus IDE, desc "virtual IDE disk"')
+elif args == ["-accel", "help"]:
+    print("Accelerators supported in QEMU binary:")
+    print("tcg")
+    print("kvm")
+elif "-qmp" in args:
+    sys.stdin.read()
+    print('{"QMP": {"version": {}, "capabilities": []}}')
+    print('{"return": {}}')
+    print('{"return": [{"name": "quit"}, {"name": "migrate-incoming"}]}')
+    print('{"return": [{"capability": "multifd", "state": false}, '
+          '{"capability": "mapped-ram", "state": false}]}')
+    print('{"return": {}}')
+"""
+
+def _fake_qemu(tmp_path):
+    binary = tmp_path / "qemu-system-x86_64"
+    calls = tmp_path / "calls"
+    binary.write_text(FAKE_QEMU % (sys.executable, str(calls)))
+    binary.chmod(0o755)
+    return str(binary), calls
+
+def test_probe(tmp_path):
+    binary, _ = _fake_qemu(tmp_path)
+    caps = qemucaps.probe(binary)
+    assert caps["version"] == "6.2.0"
+    assert caps["options"] == ["-accel", "-machine", "-overcommit"]
+    assert caps["machines"] == ["pc-q35-6.2", "q35"]
+    assert caps["devices"] == ["ide-cd", "ide-hd"]
+    assert caps["accels"] == ["tcg", "kvm"]
+    assert caps["qmp_commands"] == ["migrate-incoming", "quit"]
+    assert caps["migration_capabilities"] == ["mapped-ram", "multifd"]
+
+def test_capabilities_cached(tmp_path, monkeypatch):
+    binary, calls = _fake_qemu(tmp_path)
+    monkeypatch.setattr(qemucaps, "CACHE_PATH", str(tmp_path / "caps.json"))
+    monkeypatch.setattr(qemucaps, "_probed", {})
+
+    caps = qemucaps.capabilities(binary)
+    probes = len(calls.read_text().splitlines())
+    assert probes == 6
+    assert qemucaps.capabilities(binary) == caps
+
+    # Another process reads the stored results.
+    monkeypatch.setattr(qemucaps, "_probed", {})
+    assert qemucaps.capabilities(binary) == caps
+    assert len(calls.read_text().splitlines()) == probes
+
+    # A changed binary is probed again.
+    st = os.stat(binary)
+    os.utime(binary, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    qemucaps.capabilities(binary)
+    assert len(calls.read_text().splitlines()) == probes * 2
+
+def test_failed_probe_not_cached(tmp_path, monkeypatch):
+    binary = tmp_path / "qemu-system-x86_64"
+    binary.write_text("#!/bin/sh\nexit 1\n")
+    binary.chmod(0o755)
+    monkeypatch.setattr(qemucaps, "CACHE_PATH", str(tmp_path / "caps.json"))
+    monkeypatch.setattr(qemucaps, "_probed", {})
+
+    assert qemucaps.capabilities(str(binary))["options"] == []
+    assert not (tmp_path / "caps.json").exists()
+    assert not qemucaps._probed
@@ -0,0 +1,304 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+from vmcloak.exceptions import QMPError
+from vmcloak.qmp import InstallMonitor, QMPClient
+
+class FakeQMP(object):
+    """Answers QMP commands on a unix socket. Each query-blockstats reply
+    takes the next amount of written bytes and is followed by the events
+    queued for that step. Other commands are answered by the function for
+    them in replies, which returns the result and events to send after
+    it. With close_on_quit, quit closes the connection without a reply."""
+
+    def __init__(self, path, written=(0,), events=None, replies=None,
+                 close_on_quit=False):
+        self.written = list(written)
+        self.close_on_quit = close_on_quit
+        self.events = events or {}
+        self.replies = replies or {}
+        self.commands = []
+        self.arguments = {}
+        self.calls = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _send(self, conn, msg):
+        conn.sendall(json.dumps(msg).encode() + b"\r\n")
+
+    def _serve(self):
+        conn, _ = self.server.accept()
+        try:
+            self._handle(conn)
+        except OSError:
+            # The client went away.
+            pass
+
+    def _handle(self, conn):
+        self._send(conn, {"QMP": {"version": {}, "capabilities": []}})
+        step = 0
+        for line in conn.makefile("rb"):
+            msg = json.loads(line)
+            cmd = msg["execute"]
+            self.commands.append(cmd)
+            self.arguments[cmd] = msg.get("arguments", {})
+            self.calls.append((cmd, self.arguments[cmd]))
+            if cmd == "quit" and self.close_on_quit:
+                conn.close()
+                return
+            if cmd in self.replies:
+                result, events = self.replies[cmd](self.arguments[cmd])
+                self._send(conn, {"return": result, "id": msg["id"]})
+                for event in events:
+                    self._send(conn, event)
+                if cmd == "quit":
+                    conn.close()
+                    return
+                continue
+            if cmd != "query-blockstats":
+                self._send(conn, {"return": {}, "id": msg["id"]})
+                continue
+
+            written = self.written[min(step, len(self.written) - 1)]
+            self._send(conn, {"return": [
+                {"device": "disk", "stats": {"wr_bytes": written}},
+                {"device": "cdrom", "stats": {"wr_bytes": 0}},
+            ]})
+            for event in self.events.get(step, []):
+                self._send(conn, event)
+            step += 1
+
+class FakeProc(object):
+    """Exits with returncode after polls calls to poll()."""
+
+    def __init__(self, polls, returncode=0):
+        self.polls = polls
+        self.exit_code = returncode
+        self.returncode = None
+
+    def poll(self):
+        self.polls -= 1
+        if self.polls < 0:
+            self.returncode = self.exit_code
+        return self.returncode
+
+    def kill(self):
+        self.returncode = -9
+
+def test_client(tmp_path):
+    path = str(tmp_path / "qmp.sock")
+    server = FakeQMP(path, [100], events={0: [{"event": "RESET"}]})
+    client = QMPClient(path)
+    client.connect(timeout=5)
+    stats = client.execute("query-blockstats")
+    assert stats[0]["stats"]["wr_bytes"] == 100
+    assert client.events(timeout=1) == [{"event": "RESET"}]
+    assert server.commands == ["qmp_capabilities", "query-blockstats"]
+    client.close()
+
+def test_install_done(tmp_path):
+    path = str(tmp_path / "qmp.sock")
+    serial = tmp_path / "serial.log"
+    serial.write_bytes(
+        b"noise\r\nvmcloak: installing python\r\nvmcloak: shutting"
+    )
+    FakeQMP(path, [10, 10, 20], events={
+        0: [{"event": "RESET"}],
+        2: [{"event": "SHUTDOWN", "data": {"guest": True}}],
+    })
+    monitor = InstallMonitor(
+        FakeProc(4), path, str(serial), stall_timeout=60, interval=0.01
+    )
+    monitor.wait()
+    monitor.close()
+    assert monitor.resets == 1
+    assert monitor.written == 20
+    assert monitor.milestones == ["installing python"]
+
+def test_install_stalled(tmp_path):
+    path = str(tmp_path / "qmp.sock")
+    FakeQMP(path, [10])
+    proc = FakeProc(1000)
+    monitor = InstallMonitor(proc, path, stall_timeout=0.1, interval=0.01)
+    with pytest.raises(ValueError, match="stalled"):
+        monitor.wait()
+    assert proc.returncode == -9
+
+def test_install_io_error(tmp_path):
+    path = str(tmp_path / "qmp.sock")
+    FakeQMP(path, [10, 20], events={0: [{
+        "event": "BLOCK_IO_ERROR",
+        "data": {"device": "disk", "operation": "write", "nospace": True},
+    }]})
+    monitor = InstallMonitor(FakeProc(1000), path, interval=0.01)
+    with pytest.raises(ValueError, match="no space left"):
+        monitor.wait()
+
+def test_wait_event(tmp_path):
+    path = str(tmp_path / "qmp.sock")
+    FakeQMP(path, replies={"cont": lambda args: ({}, [
+        {"event": "RESUME"}, {"event": "SHUTDOWN", "data": {}},
+    ])})
+    client = QMPClient(path)
+    client.connect(timeout=5)
+    client.execute("cont")
+    assert client.wait_event(("SHUTDOWN",), timeout=5)["event"] == "SHUTDOWN"
+    assert client.wait_event(("SHUTDOWN",), timeout=0.1) is None
+    assert client.events() == [{"event": "RESUME"}]
+
+def _migration(states):
+    states = list(states)
+    def query_migrate(args):
+        state = states.pop(0) if len(states) > 1 else states[0]
+        return {"status": state, "error-desc": "disk full"}, [
+            {"event": "MIGRATION", "data": {"status": state}}
+        ]
+    return query_migrate
+
+def test_migrate(tmp_path):
+    path = str(tmp_path / "qmp.sock")
+    server = FakeQMP(path, replies={
+        "query-migrate": _migration(["active", "active", "completed"])
+    })
+    client = QMPClient(path)
+    client.connect(timeout=5)
+    assert client.migrate("exec:cat > /dev/null")["status"] == "completed"
+    assert server.commands.count("query-migrate") == 3
+    assert server.arguments["migrate"] == {"uri": "exec:cat > /dev/null"}
+
+    path = str(tmp_path / "qmp2.sock")
+    FakeQMP(path, replies={"query-migrate": _migration(["active", "failed"])})
+    client = QMPClient(path)
+    client.connect(timeout=5)
+    with pytest.raises(QMPError, match="failed: disk full"):
+        client.migrate("exec:cat > /dev/null")
+
+class QEMUProc(FakeProc):
+    """A QEMU process that exits when QMP quits."""
+
+    def __init__(self):
+        super().__init__(1000)
+
+    def wait(self, timeout=None):
+        self.returncode = self.exit_code
+        return self.returncode
+
+def _snapshot_vm(tmp_path, monkeypatch, codec, snapshot_format):
+    from vmcloak.machineconf import MachineConfDump
+    from vmcloak.platforms import qemu
+
+    def migrate(args):
+        (tmp_path / "memory.snapshot").write_bytes(b"z" * 100)
+        return {}, []
+    def query_migrate(args):
+        return {"status": "completed", "ram": {"transferred": 4096}}, []
+
+    path = str(tmp_path / "qmp.sock")
+    server = FakeQMP(path, replies={
+        "migrate": migrate, "query-migrate": query_migrate,
+        "quit": lambda args: ({}, [{"event": "SHUTDOWN", "data": {}}]),
+    })
+    monkeypatch.setattr(qemu, "_get_vm_dir", lambda name: str(tmp_path))
+    monkeypatch.setitem(qemu.machines, "snap", QEMUProc())
+    monkeypatch.setitem(qemu.qmp_paths, "snap", path)
+    monkeypatch.setitem(qemu.snapshot_codecs, "snap", codec)
+    monkeypatch.setitem(qemu.snapshot_formats, "snap", snapshot_format)
+    dump = MachineConfDump("snap", "192.168.30.10", 8000, "windows", "10",
+                           "amd64")
+    monkeypatch.setitem(qemu.confdumps, "snap", dump)
+    return server, dump
+
+def test_qemu_snapshot(tmp_path, monkeypatch):
+    from vmcloak.platforms import qemu
+
+    server, dump = _snapshot_vm(
+        tmp_path, monkeypatch, ("zstd", "/usr/bin/zstd", 3), "stream"
+    )
+    qemu.create_snapshot("snap")
+    assert server.commands[1:4] == [
+        "stop", "migrate-set-parameters", "migrate-set-capabilities"
+    ]
+    assert server.commands[-1] == "quit"
+    assert server.arguments["migrate"]["uri"] == (
+        f"exec:/usr/bin/zstd -q -T0 -3 -c > {tmp_path}/memory.snapshot"
+    )
+    assert dump.machine["memory_snapshot_format"] == "stream"
+    assert dump.machine["memory_snapshot_codec"] == "zstd"
+    assert dump.machine["memory_snapshot_size"] == 4096
+    assert dump.machine["memory_snapshot_compressed_size"] == 100
+    assert "snap" not in qemu.qmp_clients
+    assert not os.path.exists(str(tmp_path / "qmp.sock"))
+
+def test_qemu_snapshot_quit_closed(tmp_path, monkeypatch):
+    """QEMU may exit before it replies to quit."""
+    from vmcloak.platforms import qemu
+
+    server, dump = _snapshot_vm(
+        tmp_path, monkeypatch, ("none", "/bin/cat", None), "stream"
+    )
+    server.close_on_quit = True
+    qemu.create_snapshot("snap")
+    assert server.commands[-1] == "quit"
+    assert qemu.machines["snap"].returncode == 0
+    assert dump.machine["memory_snapshot_size"] == 4096
+
+def test_qemu_snapshot_mapped_ram(tmp_path, monkeypatch):
+    from vmcloak.platforms import qemu
+
+    server, dump = _snapshot_vm(
+        tmp_path, monkeypatch, ("none", "/bin/cat", None), "mapped-ram"
+    )
+    monkeypatch.setattr(os, "cpu_count", lambda: 32)
+    qemu.create_snapshot("snap")
+    assert ("migrate-set-capabilities", {"capabilities": [
+        {"capability": "mapped-ram", "state": True},
+        {"capability": "multifd", "state": True},
+    ]}) in server.calls
+    assert ("migrate-set-parameters", {"multifd-channels": 8}) in \
+        server.calls
+    assert server.arguments["migrate"]["uri"] == (
+        f"file:{tmp_path}/memory.snapshot"
+    )
+    assert dump.machine["memory_snapshot_format"] == "mapped-ram"
+    assert dump.machine["memory_snapshot_capabilities"] == [
+        "mapped-ram", "multifd"
+    ]
+    assert dump.machine["memory_snapshot_parameters"] == {
+        "multifd-channels": 8
+    }
+
+def test_qemu_iso_and_shutdown(tmp_path, monkeypatch):
+    from vmcloak.platforms import qemu
+
+    path = str(tmp_path / "qmp.sock")
+    server = FakeQMP(path, replies={
+        "eject": lambda args: ({}, [{"event": "DEVICE_TRAY_MOVED"}]),
+        "system_powerdown": lambda args: ({}, [
+            {"event": "SHUTDOWN", "data": {"guest": True}}
+        ]),
+    })
+    monkeypatch.setitem(qemu.machines, "img", QEMUProc())
+    monkeypatch.setitem(qemu.qmp_paths, "img", path)
+
+    vm = qemu.VM("img")
+    vm.attach_iso("/tmp/office.iso")
+    assert server.arguments["blockdev-change-medium"] == {
+        "device": "cdrom", "filename": "/tmp/office.iso", "format": "raw"
+    }
+    vm.detach_iso()
+    assert server.arguments["eject"] == {"device": "cdrom", "force": True}
+
+    qemu._qmp("img").execute("system_powerdown")
+    assert qemu.wait_for_shutdown("img", timeout=5)
+    qemu._close_qmp("img")
@@ -0,0 +1,84 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import pytest
+
+from vmcloak.dependencies.ps1logging import PS1Logging
+from vmcloak.exceptions import DependencyError
+from vmcloak.registry import RegistryTweaks
+from vmcloak.repository import Image
+from vmcloak.win10 import Windows10x64
+
+def test_render():
+    t = RegistryTweaks([
+        ("HKLM", "Software\\Test", "Dword", "REG_DWORD", 0xAA0),
+        ("HKEY_CURRENT_USER", "Software\\Test", None, "REG_SZ", "a\\b\"c"),
+        ("HKLM", "software\\test\\", "Binary", "REG_BINARY", "2C00FF"),
+        ("HKLM", "Software\\Test", "Gone", None, None),
+        ("HKLM", "Software\\Test", "Multi", "REG_MULTI_SZ", ["a", "b"]),
+        ("HKLM", "Software\\Test", "Expand", "REG_EXPAND_SZ", "%x%"),
+        ("HKLM", "Software\\Test", "Qword", "REG_QWORD", "0x1"),
+    ])
+
+    assert t.render().split("\r\n") == [
+        "Windows Registry Editor Version 5.00",
+        "",
+        "[HKEY_LOCAL_MACHINE\\Software\\Test]",
+        "\"Dword\"=dword:00000aa0",
+        "\"Binary\"=hex:2c,00,ff",
+        "\"Gone\"=-",
+        "\"Multi\"=hex(7):61,00,00,00,62,00,00,00,00,00",
+        "\"Expand\"=hex(2):25,00,78,00,25,00,00,00",
+        "\"Qword\"=hex(b):01,00,00,00,00,00,00,00",
+        "",
+        "[HKEY_CURRENT_USER\\Software\\Test]",
+        "@=\"a\\\\b\\\"c\"",
+        "",
+        "",
+    ]
+
+def test_dedup():
+    t = RegistryTweaks()
+    t.add("HKCU", "Software\\Test", "Value", "REG_DWORD", 1)
+    t.add("hkcu", "SOFTWARE\\TEST", "value", "REG_DWORD", 2)
+    t.add("HKCU", "Software\\Test", "Other", "REG_SZ", "x")
+
+    assert len(t) == 2
+    assert t.key_count == 1
+    assert list(t)[0] == (
+        "HKEY_CURRENT_USER", "Software\\Test", "value", "REG_DWORD", 2
+    )
+    assert t.encode().startswith(b"\xff\xfeW\x00i\x00")
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        RegistryTweaks([("HKXX", "Software", "a", "REG_SZ", "")])
+    with pytest.raises(ValueError):
+        RegistryTweaks([("HKLM", "Software", "a", "REG_NONE", "")])
+    with pytest.raises(ValueError):
+        RegistryTweaks([("HKLM", "Software", "a", "REG_DWORD", "abc")])
+
+class _DeniedAgent(object):
+    """reg import fails, as it does when one of the keys is denied."""
+
+    def __init__(self):
+        self.commands = []
+
+    def upload(self, filepath, contents):
+        pass
+
+    def execute(self, command):
+        self.commands.append(command)
+        return {"exit_code": 1, "stdout": "", "stderr": "Access denied"}
+
+def test_apply_registry_denied():
+    agent = _DeniedAgent()
+    d = PS1Logging(
+        h=Windows10x64(), a=agent, i=Image(osversion="win10x64")
+    )
+    d.apply_registry()
+    assert len(agent.commands) == 1
+
+    with pytest.raises(DependencyError):
+        d.apply_registry(strict=True)
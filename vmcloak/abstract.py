@@ -3,6 +3,7 @@
 # This file is part of VMCloak - http://www.vmcloak.org/.
 # See the file 'docs/LICENSE.txt' for copying permission.
 
+import io
 import logging
 import os.path
 import re
@@ -13,12 +14,18 @@ import time
 from ipaddress import ip_network
 
 from vmcloak.constants import VMCLOAK_ROOT
-from vmcloak.exceptions import DependencyError
+from vmcloak.depcache import DepCache
+from vmcloak.downloader import download
+from vmcloak.exceptions import DependencyError, ISOError
+from vmcloak.isoreader import ISOImage
+from vmcloak import isowriter
+from vmcloak.isowriter import build_iso, FileSource, ISOWriter
 from vmcloak.misc import (
-    copytreelower, copytreeinto, sha1_file, ini_read, filename_from_url,
-    download_file
+    copyfileslower, copytreelower, copytreeinto, find_lower, graft_points,
+    ini_parse, ini_read, filename_from_url
 )
 from vmcloak.paths import get_path
+from vmcloak.registry import RegistryTweaks
 from vmcloak.repository import deps_path
 from vmcloak.verify import valid_serial_key
 from vmcloak.rand import random_string
@@ -33,6 +40,38 @@ GENISOIMAGE_WARNINGS = [
     b"add Rock Ridge",
 ]
 
+# Volume label of the medium with the per-image values.
+CONFIG_VOLUME_ID = "VMCLOAK"
+
+def _read_isofile(mount, relpath):
+    """Returns the contents of relpath (case-insensitive) of the installer,
+    a mounted directory or an ISOImage, or None if it has no such file."""
+    if isinstance(mount, ISOImage):
+        return mount.read(relpath)
+
+    path = find_lower(mount, relpath)
+    if not path:
+        return None
+    with open(path, "rb") as fp:
+        return fp.read()
+
+def _copy_isofiles(mount, outdir, relpaths):
+    """Copy the given files of the installer to outdir with lowercase
+    paths."""
+    if not isinstance(mount, ISOImage):
+        copyfileslower(mount, outdir, relpaths)
+        return
+
+    for relpath in relpaths:
+        data = mount.read(relpath)
+        if data is None:
+            continue
+
+        path = os.path.join(outdir, relpath.lower())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fp:
+            fp.write(data)
+
 class OperatingSystem(object):
     # Short name for this OS.
     name = None
@@ -65,6 +104,14 @@ class OperatingSystem(object):
     # Additional arguments for genisoimage.
     genisoargs = []
 
+    # Files of the original ISO that isofiles() reads or changes. Only these
+    # are copied when the other files are grafted into the new ISO.
+    isofiles_copy = []
+
+    # Whether Setup finds the files of configfiles() on a second CD-ROM, see
+    # buildconfig(). If not, init builds an installer ISO for every image.
+    config_medium = True
+
     def __init__(self):
         self.data_path = os.path.join(VMCLOAK_ROOT, "data")
         self.path = os.path.join(self.data_path, self.name)
@@ -104,6 +151,30 @@ class OperatingSystem(object):
         """Abstract method for writing additional files to the newly created
         ISO file."""
 
+    def configfiles(self, mount, tmp_dir=None, env_vars={}):
+        """Returns the files that isofiles() adds or changes as a dictionary
+        of paths to bytes, for the per-image config medium."""
+        outdir = tempfile.mkdtemp(dir=tmp_dir)
+        try:
+            _copy_isofiles(mount, outdir, self.isofiles_copy)
+            self.isofiles(outdir, tmp_dir, env_vars=env_vars)
+
+            files = {}
+            for dirpath, _, filenames in os.walk(outdir):
+                for fname in filenames:
+                    path = os.path.join(dirpath, fname)
+                    with open(path, "rb") as fp:
+                        data = fp.read()
+
+                    # Unchanged files of the mount are on the static ISO.
+                    relpath = os.path.relpath(path, outdir)
+                    if _read_isofile(mount, relpath) == data:
+                        continue
+                    files[relpath] = data
+            return files
+        finally:
+            shutil.rmtree(outdir)
+
     def set_serial_key(self, serial_key):
         """Abstract method for checking a serial key if provided and otherwise
         use a default serial key if available."""
@@ -121,24 +192,13 @@ class OperatingSystem(object):
             if mount and os.path.isdir(mount) and os.listdir(mount):
                 return mount
 
-    def buildiso(self, mount, newiso, bootstrap, tmp_dir=None, env_vars={}):
-        """Builds an ISO file containing all our modifications."""
-        isocreate = get_path("genisoimage")
-        if not isocreate:
-            log.error("Either genisoimage or mkisofs is required!")
-            return False
-
-        outdir = tempfile.mkdtemp(dir=tmp_dir)
-        # Copy all files to our temporary directory as mounted iso files are
-        # read-only and we need lowercase (aka case-insensitive) filepaths.
-        copytreelower(mount, outdir)
-
+    def _stage_static(self, outdir, bootstrap, agent_name):
+        """Write the files that do not differ between images to outdir: the
+        boot image, the bootstrap files, the agent, and the contents of the
+        bootstrap directory. Returns the file name of the agent."""
         # Copy the boot image.
         shutil.copy(os.path.join(self.path, "boot.img"), outdir)
 
-        # Allow the OS handler to write additional files.
-        self.isofiles(outdir, tmp_dir, env_vars=env_vars)
-
         bootstrap_copy = os.path.join(outdir, self.osdir, "vmcloak")
         os.makedirs(bootstrap_copy)
         for fname in os.listdir(self.bootstrap_path):
@@ -148,50 +208,214 @@ class OperatingSystem(object):
 
             shutil.copy(filepath, os.path.join(bootstrap_copy, fname))
 
-        # Find the correct agent binary for the current OS and architecture.
-        try:
-            agent_path, file_ext = self.find_agent_binary()
-        except FileNotFoundError as e:
-            log.error(
-                f"Failed to find agent file for OS {self.os_name} with "
-                f"architecture: {self.arch}. {e}"
-            )
-            shutil.rmtree(outdir)
-            return False
-
-        # Copy the agent binary to the tmp bootstrap folder with the extension
-        # it should have, but using a normalized name.
-        agent_name = f"{random_string(8, 16)}{file_ext}"
-        shutil.copy(agent_path, os.path.join(bootstrap_copy, agent_name))
-        env_vars["AGENT_FILE"] = agent_name
-        env_vars["AGENT_RUNKEY"] = random_string(8, 16)
-
-        # Write the configuration values for bootstrap.bat.
-        with open(os.path.join(bootstrap_copy, "settings.bat"), "wb") as f:
-            for key, value in env_vars.items():
-                f.write(f"set {key}={value}\n".encode())
+        # Find the correct agent binary for the current OS and architecture
+        # and copy it with the extension it should have, but using a
+        # normalized name.
+        agent_path, file_ext = self.find_agent_binary()
+        agent_file = f"{agent_name}{file_ext}"
+        shutil.copy(agent_path, os.path.join(bootstrap_copy, agent_file))
 
         copytreeinto(bootstrap, os.path.join(outdir, self.osdir))
+        return agent_file
+
+    def _settings_bat(self, env_vars):
+        """Returns the configuration values for bootstrap.bat."""
+        return "".join(
+            f"set {key}={value}\n" for key, value in env_vars.items()
+        ).encode()
+
+    def _write_settings(self, dirpath, env_vars):
+        os.makedirs(dirpath, exist_ok=True)
+        with open(os.path.join(dirpath, "settings.bat"), "wb") as f:
+            f.write(self._settings_bat(env_vars))
+
+    def _mkisofs(self, newiso, outdir, mount=None, tmp_dir=None):
+        """Run genisoimage to create newiso from outdir. If mount is given,
+        its files are grafted into the ISO as well, see graft_points()."""
+        isocreate = get_path("genisoimage")
+        if not isocreate:
+            log.error("Either genisoimage or mkisofs is required!")
+            return False
 
         args = [
             isocreate, "-quiet", "-b", "boot.img", "-o", newiso,
-        ] + self.genisoargs + [outdir]
+        ] + self.genisoargs
+
+        pathlist = None
+        if mount:
+            # The path list is kept outside of outdir so it does not end up
+            # on the ISO itself.
+            fd, pathlist = tempfile.mkstemp(suffix=".graft", dir=tmp_dir)
+            with os.fdopen(fd, "w") as fp:
+                for spec in graft_points(mount, outdir):
+                    fp.write(f"{spec}\n")
+            args += ["-graft-points", "-path-list", pathlist]
+        else:
+            args.append(outdir)
 
         log.debug("Executing genisoimage: %s", " ".join(args))
-        p = subprocess.Popen(
-            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        out, err = p.communicate()
+        try:
+            p = subprocess.Popen(
+                args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            out, err = p.communicate()
+        finally:
+            if pathlist:
+                os.remove(pathlist)
+
         warning = re.sub(b"[\\s]+", b" ", err).strip()
-        if p.wait() or out or warning not in GENISOIMAGE_WARNINGS:
+        if p.wait() or out or \
+                (warning and warning not in GENISOIMAGE_WARNINGS):
             log.error(
                 "Error creating ISO file (err=%d): %s %s",
                 p.wait(), out, err
             )
-            shutil.rmtree(outdir)
             return False
 
-        shutil.rmtree(outdir)
+        return True
+
+    def _streamiso(self, newiso, outdir, image):
+        """Write newiso with the files of outdir and of the ISOImage, with
+        lowercase paths as copytreelower() would. The files of the image
+        are copied straight from its memory map."""
+        writer = ISOWriter(image.volume_id or "CDROM", boot="boot.img")
+        overrides = set()
+        for dirpath, dirnames, filenames in os.walk(outdir):
+            reldir = os.path.relpath(dirpath, outdir)
+            if not dirnames and not filenames:
+                writer.add_directory(reldir)
+            for fname in filenames:
+                relpath = os.path.normpath(os.path.join(reldir, fname))
+                writer.add_file(
+                    relpath, FileSource(os.path.join(dirpath, fname))
+                )
+                overrides.add(relpath.lower())
+
+        for relpath, entry in image.walk():
+            relpath = relpath.lower()
+            if entry.is_dir:
+                writer.add_directory(relpath)
+                continue
+            if relpath in overrides:
+                continue
+
+            # Larger files need more than one extent, which the ISO9660
+            # driver of Windows Setup cannot read. genisoimage puts them in
+            # a UDF tree instead.
+            if entry.size > isowriter.MAX_EXTENT:
+                log.error(
+                    f"{image.path}: {relpath} is larger than 4 GB, which "
+                    f"only works with --iso-mount. Mount the ISO and use "
+                    f"--iso-mount instead of --iso-file."
+                )
+                return False
+            writer.add_file(relpath, entry)
+
+        log.debug(f"Writing {newiso} from {image.path}")
+        try:
+            with open(newiso, "wb") as fp:
+                writer.write(fp)
+        except (OSError, ISOError) as e:
+            log.error(f"Error creating ISO file {newiso}: {e}")
+            return False
+        return True
+
+    def _writeiso(self, newiso, outdir, mount, graft, tmp_dir):
+        """Create newiso from outdir and the installer, which is either a
+        mounted directory or an ISOImage."""
+        if isinstance(mount, ISOImage):
+            return self._streamiso(newiso, outdir, mount)
+        return self._mkisofs(newiso, outdir, mount if graft else None, tmp_dir)
+
+    def buildiso(self, mount, newiso, bootstrap, tmp_dir=None, env_vars={},
+                 graft=True):
+        """Builds an ISO file containing all our modifications. With graft,
+        only the added and changed files are written to a temporary
+        directory and the other files of the mounted ISO are passed to
+        genisoimage as graft points. Otherwise all files are copied. If
+        mount is an ISOImage, the new ISO is written without genisoimage,
+        see _streamiso()."""
+        outdir = tempfile.mkdtemp(dir=tmp_dir)
+        try:
+            if graft or isinstance(mount, ISOImage):
+                _copy_isofiles(mount, outdir, self.isofiles_copy)
+            else:
+                # Copy all files to our temporary directory as mounted iso
+                # files are read-only and we need lowercase (aka
+                # case-insensitive) filepaths.
+                copytreelower(mount, outdir)
+
+            # Allow the OS handler to write additional files.
+            self.isofiles(outdir, tmp_dir, env_vars=env_vars)
+
+            try:
+                agent_file = self._stage_static(
+                    outdir, bootstrap, random_string(8, 16)
+                )
+            except FileNotFoundError as e:
+                log.error(
+                    f"Failed to find agent file for OS {self.os_name} with "
+                    f"architecture: {self.arch}. {e}"
+                )
+                return False
+
+            env_vars["AGENT_SOURCE"] = agent_file
+            env_vars["AGENT_FILE"] = agent_file
+            env_vars["AGENT_RUNKEY"] = random_string(8, 16)
+            self._write_settings(
+                os.path.join(outdir, self.osdir, "vmcloak"), env_vars
+            )
+
+            return self._writeiso(newiso, outdir, mount, graft, tmp_dir)
+        finally:
+            shutil.rmtree(outdir)
+
+    def buildstatic(self, mount, newiso, bootstrap, tmp_dir=None,
+                    graft=True):
+        """Builds the part of the ISO that is the same for every image: the
+        installer, boot image, bootstrap files, and agent. The image
+        specific values are put on a separate medium by buildconfig().
+        Returns the file name of the agent on the ISO, or None if the ISO
+        could not be built."""
+        outdir = tempfile.mkdtemp(dir=tmp_dir)
+        try:
+            if not graft and not isinstance(mount, ISOImage):
+                copytreelower(mount, outdir)
+
+            try:
+                agent_file = self._stage_static(
+                    outdir, bootstrap, random_string(8, 16)
+                )
+            except FileNotFoundError as e:
+                log.error(
+                    f"Failed to find agent file for OS {self.os_name} with "
+                    f"architecture: {self.arch}. {e}"
+                )
+                return None
+
+            if not self._writeiso(newiso, outdir, mount, graft, tmp_dir):
+                return None
+            return agent_file
+        finally:
+            shutil.rmtree(outdir)
+
+    def buildconfig(self, mount, newiso, agent_source, tmp_dir=None,
+                    env_vars={}):
+        """Builds the small medium with the values that differ per image,
+        for use next to an ISO made by buildstatic(). It holds the files
+        of configfiles() and vmcloak/settings.bat, which bootstrap.bat
+        copies from the first drive that has it. The ISO is generated in
+        memory."""
+        files = self.configfiles(mount, tmp_dir, env_vars=env_vars)
+
+        env_vars["AGENT_SOURCE"] = agent_source
+        env_vars["AGENT_FILE"] = \
+            random_string(8, 16) + os.path.splitext(agent_source)[1]
+        env_vars["AGENT_RUNKEY"] = random_string(8, 16)
+        files["vmcloak/settings.bat"] = self._settings_bat(env_vars)
+
+        with open(newiso, "wb") as fp:
+            fp.write(build_iso(files, CONFIG_VOLUME_ID))
         return True
 
 class WindowsAutounattended(OperatingSystem):
@@ -206,6 +430,7 @@ class WindowsAutounattended(OperatingSystem):
         "-no-emul-boot", "-iso-level", "2", "-udf", "-J", "-l", "-D", "-N",
         "-joliet-long", "-relaxed-filenames", "-allow-limited-size",
     ]
+    isofiles_copy = [os.path.join("sources", "product.ini")]
 
     def _autounattend_xml(self, product, ipaddress, gateway):
         values = {
@@ -226,12 +451,11 @@ class WindowsAutounattended(OperatingSystem):
 
         return buf
 
-    def isofiles(self, outdir, tmp_dir=None, env_vars={}):
+    def _unattend(self, conf, env_vars):
+        """Returns autounattend.xml for the product of the installer, given
+        the parsed product.ini."""
         products = []
 
-        product_ini = os.path.join(outdir, "sources", "product.ini")
-        mode, conf = ini_read(product_ini)
-
         for line in conf.get("BuildInfo", []):
             if "=" not in line:
                 continue
@@ -267,14 +491,26 @@ class WindowsAutounattended(OperatingSystem):
             strict=False
         )
 
-        unattend_xml = self._autounattend_xml(
+        return self._autounattend_xml(
             self.product or product,
             ipaddress=f"{env_vars['GUEST_IP']}/{ipnet.prefixlen}",
             gateway=env_vars["GUEST_GATEWAY"]
         )
+
+    def isofiles(self, outdir, tmp_dir=None, env_vars={}):
+        mode, conf = ini_read(os.path.join(outdir, "sources", "product.ini"))
+        unattend_xml = self._unattend(conf, env_vars)
         with open(os.path.join(outdir, "autounattend.xml"), "w") as f:
             f.write(unattend_xml)
 
+    def configfiles(self, mount, tmp_dir=None, env_vars={}):
+        product_ini = _read_isofile(
+            mount, os.path.join("sources", "product.ini")
+        )
+        mode, conf = ini_parse(product_ini or b"")
+        unattend_xml = self._unattend(conf, env_vars)
+        return {"autounattend.xml": unattend_xml.encode()}
+
     def set_serial_key(self, serial_key):
         if serial_key and not valid_serial_key(serial_key):
             log.error("The provided serial key has an incorrect encoding.")
@@ -300,6 +536,9 @@ class Dependency(object):
     exes = []
     tags = []
     files = []
+    # Registry values to set, as (hive, key, value, type, data) tuples. See
+    # registry_tweaks() and apply_registry().
+    registry = []
 
     # OS versions in this list do not need an exe/installer etc.
     # If they are here and exes is not empty, do not stop the install.
@@ -307,6 +546,9 @@ class Dependency(object):
 
     data_path = os.path.join(VMCLOAK_ROOT, "data")
     deps_path = deps_path
+    depcache = DepCache(deps_path)
+    # URL of a 'vmcloak deps serve' mirror that is tried before the urls.
+    mirror = None
 
     def __init__(self, h=None, m=None, a=None, i=None, installer=None,
                  version=None, settings={}):
@@ -330,28 +572,15 @@ class Dependency(object):
                 setattr(self, key, value)
 
         # Locate the matching installer.
-        for exe in self.exes:
-            if "target" in exe and exe["target"] != i.osversion:
-                continue
-
-            if "arch" in exe and exe["arch"] != self.arch:
-                continue
-
-            if "version" in exe and self.version and \
-                    exe["version"] != self.version:
-                continue
-
-            self.exe = exe
-            break
-        else:
-            if self.exes and self.i.osversion not in self.no_exe:
-                log.error(
-                    f"Could not find the correct installer"
-                    f" {self.name} ({self.version or ''}) for "
-                    f"'{i.osversion}' with "
-                    f"architecture: '{self.arch}'"
-                )
-                raise DependencyError
+        self.exe = self.find_exe(i.osversion, self.arch, self.version)
+        if not self.exe and self.exes and self.i.osversion not in self.no_exe:
+            log.error(
+                f"Could not find the correct installer"
+                f" {self.name} ({self.version or ''}) for "
+                f"'{i.osversion}' with "
+                f"architecture: '{self.arch}'"
+            )
+            raise DependencyError
 
         # Download the executable/installer or required files if there
         # are any.
@@ -376,25 +605,64 @@ class Dependency(object):
 
             return deps
 
-    def _do_downloads(self, filepaths_urllist_sha1_v):
+    @classmethod
+    def find_exe(cls, osversion, arch, version=None):
+        """Returns the exes entry for the given OS version, architecture, and
+        version of this dependency. None if there is no such entry."""
+        for exe in cls.exes:
+            if "target" in exe and exe["target"] != osversion:
+                continue
+
+            if "arch" in exe and exe["arch"] != arch:
+                continue
+
+            if "version" in exe and version and exe["version"] != version:
+                continue
+
+            return exe
+
+        return None
+
+    @classmethod
+    def plan_downloads(cls, osversion, arch, version=None):
+        """Returns the downloadable (filepath, urls, sha1, version) tuples
+        that an instance for the given OS version, architecture, and version
+        would download."""
+        entries = list(cls.files)
+        exe = cls.find_exe(osversion, arch, version or cls.default)
+        if exe:
+            entries.insert(0, exe)
+
+        try:
+            return cls._find_downloadable_files(entries)
+        except KeyError as e:
+            raise DependencyError(f"Unable to get resource. {e}")
+
+    @classmethod
+    def is_downloaded(cls, downloadable):
+        """Returns True if the downloadable file exists and has the expected
+        hash, or if there is no expected hash."""
+        filepath, _, expected_sha1sum, version = downloadable
+        # We need the latest version. We cannot know what the download file
+        # version is since we never know the hash of the latest version.
+        if version == "latest":
+            return False
+
+        if not os.path.exists(filepath):
+            return False
+
+        if expected_sha1sum and \
+                expected_sha1sum != cls.depcache.sha1(filepath):
+            return False
+
+        return True
+
+    @classmethod
+    def _do_downloads(cls, filepaths_urllist_sha1_v):
         for filepath, urllist, expected_sha1, _, in filepaths_urllist_sha1_v:
-            for url in urllist:
-                success, sha1hash = download_file(url, filepath)
-                if not success:
-                    log.warning(f"Failed to download file from: {url}")
-                    continue
-
-                if expected_sha1 and sha1hash != expected_sha1:
-                    log.warning(
-                        f"Calculated sha1 hash '{sha1hash}' of downloaded "
-                        f"file {filepath} did not match expected hash "
-                        f"'{expected_sha1}'. File source: {url}"
-                    )
-                    os.remove(filepath)
-                    continue
-
-                # No issues with the download, do not download more.
-                break
+            success, sha1hash = download(urllist, filepath, expected_sha1)
+            if success:
+                cls.depcache.record(filepath, sha1=sha1hash)
 
             if not os.path.isfile(filepath) or os.path.getsize(filepath) == 0:
                 raise DependencyError(
@@ -402,7 +670,8 @@ class Dependency(object):
                     f"{', '.join(urllist)}"
                 )
 
-    def _find_downloadable_files(self, download_dictlist):
+    @classmethod
+    def _find_downloadable_files(cls, download_dictlist):
         downloadables = []
         for downloadable_file in download_dictlist:
             all_urls = []
@@ -428,9 +697,13 @@ class Dependency(object):
                     f"No filename in files/exes entry: {downloadable_file}"
                 )
 
+            sha1 = downloadable_file.get("sha1")
+            if cls.mirror and sha1:
+                all_urls.insert(0, f"{cls.mirror}/sha1/{sha1}")
+
             downloadables.append(
                 (os.path.join(deps_path, filename),
-                 all_urls, downloadable_file.get("sha1"),
+                 all_urls, sha1,
                  downloadable_file.get("version")),
             )
 
@@ -452,24 +725,12 @@ class Dependency(object):
         except KeyError as e:
             raise DependencyError(f"Unable to get resource. {e}")
 
-        # Check which of the downloadable files already exist.
-        for downloadable in downloadables[:]:
-            filepath, _, expected_sha1sum, version = downloadable
-            # Skip check if we need the latest version. We cannot know what
-            # the download file version is since we never know the hash of the
-            # latest version.
-            if version == "latest":
-                continue
-
-            if not os.path.exists(filepath):
-                continue
-
-            if expected_sha1sum and expected_sha1sum != sha1_file(filepath):
-                continue
-
-            # Remove downloadable file from download list because it exists
-            # and it is the expected hash or there was no expected hash.
-            downloadables.remove(downloadable)
+        # Remove the downloadable files that already exist and have the
+        # expected hash or have no expected hash.
+        cached = [d for d in downloadables if self.is_downloaded(d)]
+        for filepath, _, _, _ in cached:
+            self.depcache.touch(filepath)
+        downloadables = [d for d in downloadables if d not in cached]
 
         if downloadables:
             log.debug(
@@ -490,15 +751,64 @@ class Dependency(object):
 
     def disable_autorun(self):
         """Disables AutoRun under Windows XP and Windows 7."""
-        if self.h.name == "winxp":
-            self.a.execute("reg add HKEY_LOCAL_MACHINE\\Software\\Microsoft\\"
-                           "Windows\\CurrentVersion\\Policies\\Explorer "
-                           "/v NoDriveTypeAutoRun /t REG_DWORD /d 177 /f")
-
-        if self.h.name == "win7":
-            self.a.execute("reg add HKEY_LOCAL_MACHINE\\Software\\Microsoft\\"
-                           "Windows\\CurrentVersion\\Policies\\Explorer "
-                           "/v NoDriveTypeAutoRun /t REG_DWORD /d 255 /f")
+        value = {"winxp": 177, "win7": 255}.get(self.h.name)
+        if value is not None:
+            self.apply_registry([
+                ("HKLM", "Software\\Microsoft\\Windows\\CurrentVersion\\"
+                 "Policies\\Explorer", "NoDriveTypeAutoRun", "REG_DWORD",
+                 value),
+            ])
+
+    def registry_tweaks(self):
+        """Returns the registry entries of this dependency. Defaults to the
+        registry class attribute, override to make them depend on the
+        version, OS, or settings."""
+        return self.registry
+
+    def apply_registry(self, entries=None, view=None, strict=False):
+        """Write all registry entries (default: registry_tweaks()) to the
+        VM as one .reg file and import it with a single reg import. A view
+        of 32 or 64 selects the registry view to import into. reg import
+        fails when any one key is denied, while the others are still
+        written. That is only logged, unless strict is True, which raises a
+        DependencyError instead."""
+        tweaks = RegistryTweaks(
+            self.registry_tweaks() if entries is None else entries
+        )
+        if not tweaks:
+            return
+
+        regfile = f"C:\\{random_string(8, 16)}.reg"
+        command = f"reg import {regfile}"
+        if view:
+            command += f" /reg:{view}"
+
+        start = time.monotonic()
+        self.a.upload(regfile, io.BytesIO(tweaks.encode()))
+        res = self.a.execute(
+            f"cmd /c \"{command} && del {regfile} || "
+            f"(del {regfile} & exit /b 1)\""
+        )
+        log.info(
+            "Imported %d registry values in %d keys for '%s' in %.2fs",
+            len(tweaks), tweaks.key_count, self.name,
+            time.monotonic() - start
+        )
+
+        # Within a batch() the import is queued and has no result yet.
+        if res is None or not res["exit_code"]:
+            return
+
+        error = f"Failed to import registry values for '{self.name}': " \
+            f"{res['stderr'] or res['stdout']}"
+        if strict:
+            raise DependencyError(error)
+        log.warning(error)
+
+    def batch(self, stop_on_error=False):
+        """Collect the commands executed within this context and send them
+        to the Agent together. See Agent.batch()."""
+        return self.a.batch(stop_on_error=stop_on_error)
 
     def upload_file(self, filepath, to_machine_filepath):
         """Upload the specified filepath to the specified machine filepath"""
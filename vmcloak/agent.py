@@ -2,42 +2,76 @@
 # This file is part of VMCloak - http://www.vmcloak.org/.
 # See the file 'docs/LICENSE.txt' for copying permission.
 
+import contextlib
 import io
 import logging
 import requests
+import requests.adapters
 
 from vmcloak.misc import wait_for_agent
+from vmcloak.rand import random_string
 
 log = logging.getLogger(__name__)
 
 class Agent(object):
-    def __init__(self, ipaddr, port):
+    def __init__(self, ipaddr, port, pool_size=4, timeout=None):
         self.ipaddr = ipaddr
         self.port = port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+        self._batch = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def session(self):
+        """The keep-alive connection pool to this Agent. It is created on
+        first use and rebuilt after close()."""
+        if self._session is None:
+            session = requests.Session()
+            session.trust_env = False
+            session.proxies = None
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.pool_size
+            )
+            session.mount("http://", adapter)
+            self._session = session
+
+        return self._session
+
+    def close(self):
+        """Close all pooled connections to the Agent."""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _url(self, method):
+        return "http://%s:%s%s" % (self.ipaddr, self.port, method)
 
     def get(self, method, *args, **kwargs):
         """Wrapper around GET requests."""
-        url = "http://%s:%s%s" % (self.ipaddr, self.port, method)
-        session = requests.Session()
-        session.trust_env = False
-        session.proxies = None
-        return session.get(url, *args, **kwargs)
-
-    def post(self, method, **kwargs):
-        """Wrapper around POST requests."""
-        url = "http://%s:%s%s" % (self.ipaddr, self.port, method)
-        session = requests.Session()
-        session.trust_env = False
-        session.proxies = None
-        return session.post(url, data=kwargs)
-
-    def postfile(self, method, files, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(self._url(method), *args, **kwargs)
+
+    def post(self, method, request_timeout=None, **kwargs):
+        """Wrapper around POST requests. The keyword arguments are the form
+        fields."""
+        return self.session.post(
+            self._url(method), data=kwargs,
+            timeout=request_timeout or self.timeout
+        )
+
+    def postfile(self, method, files, request_timeout=None, **kwargs):
         """Wrapper around POST requests with attached files."""
-        url = "http://%s:%s%s" % (self.ipaddr, self.port, method)
-        session = requests.Session()
-        session.trust_env = False
-        session.proxies = None
-        return session.post(url, files=files, data=kwargs)
+        return self.session.post(
+            self._url(method), files=files, data=kwargs,
+            timeout=request_timeout or self.timeout
+        )
 
     def ping(self):
         """Ping the machine."""
@@ -49,7 +83,13 @@ class Agent(object):
         return environ if value is None else environ.get(value, default)
 
     def execute(self, command, cucksync=False):
-        """Execute a command."""
+        """Execute a command. Within a batch() context the command is queued
+        instead and None is returned."""
+        if self._batch is not None and not cucksync:
+            log.debug("Queueing command for VM: %s", command)
+            self._batch.append(command)
+            return None
+
         log.debug("Executing command in VM: %s", command)
         if cucksync:
             return self.post("/execute", command=command, cucksync="true")
@@ -60,6 +100,107 @@ class Agent(object):
                 "stdout": resp.get("stdout"), "stderr": resp.get("stderr")
             }
 
+    def execute_many(self, commands, stop_on_error=False):
+        """Execute a list of commands using a single uploaded batch script
+        and a single /execute call. Returns a list with an execute()-style
+        result for each command. With stop_on_error, the commands following
+        the first failing command are not executed and have no exit code."""
+        if not commands:
+            return []
+
+        marker = "##%s##" % random_string(16)
+        lines = ["@echo off", "setlocal"]
+        for idx, command in enumerate(commands):
+            if "\n" in command or "\r" in command:
+                raise ValueError(
+                    f"Commands can not contain newlines: {command!r}"
+                )
+
+            # The markers split the combined output per command. The
+            # percent signs are escaped so the command is not expanded
+            # differently than it would be through execute().
+            lines.append(f"echo {marker} start {idx}")
+            lines.append(f">&2 echo {marker} start {idx}")
+            lines.append('cmd /s /c "%s"' % command.replace("%", "%%"))
+            lines.append("set VMCLOAK_RC=%ERRORLEVEL%")
+            lines.append(f"echo {marker} exit {idx} %VMCLOAK_RC%")
+            if stop_on_error:
+                lines.append(
+                    'if not "%VMCLOAK_RC%"=="0" goto vmcloak_end'
+                )
+
+        # Let the script delete itself so no extra request is needed.
+        lines.append(":vmcloak_end")
+        lines.append('(goto) 2>nul & del "%~f0"')
+
+        script_winpath = f"C:\\{random_string(6, 10)}.bat"
+        self.upload(script_winpath, "\r\n".join(lines) + "\r\n")
+        log.debug(
+            "Executing %d commands in VM through %s",
+            len(commands), script_winpath
+        )
+        resp = self.execute(f"cmd /c {script_winpath}")
+        if resp is None:
+            raise RuntimeError("execute_many() can not be used in a batch")
+
+        results = [{
+            "exit_code": None, "error": resp.get("error"),
+            "stdout": "", "stderr": ""
+        } for _ in commands]
+
+        for stream in ("stdout", "stderr"):
+            current = None
+            for line in (resp.get(stream) or "").splitlines(keepends=True):
+                # Output without a trailing newline puts the marker at the
+                # end of the last output line.
+                offset = line.find(marker)
+                if offset < 0:
+                    offset = len(line)
+
+                if offset and current is not None:
+                    results[current][stream] += line[:offset]
+
+                if offset == len(line):
+                    continue
+
+                fields = line[offset:].split()
+                if fields[1] == "start":
+                    current = int(fields[2])
+                elif fields[1] == "exit":
+                    current = None
+                    try:
+                        results[int(fields[2])]["exit_code"] = int(fields[3])
+                    except (IndexError, ValueError):
+                        pass
+
+        return results
+
+    @contextlib.contextmanager
+    def batch(self, stop_on_error=False):
+        """Collect the execute() calls made within this context and run them
+        together through execute_many() when the context exits. The yielded
+        list is filled with the results afterwards."""
+        if self._batch is not None:
+            # Nested batches simply join the outer batch.
+            yield []
+            return
+
+        self._batch = []
+        results = []
+        try:
+            yield results
+            commands = self._batch
+        finally:
+            self._batch = None
+
+        results.extend(self.execute_many(commands, stop_on_error))
+        for command, result in zip(commands, results):
+            if result["exit_code"] != 0:
+                log.debug(
+                    "Batched command failed (exit_code=%s): %s. Stderr=%s",
+                    result["exit_code"], command, result["stderr"]
+                )
+
     def execpy(self, filepath, cucksync=False):
         """Execute a Python file."""
         if cucksync:
@@ -115,17 +256,14 @@ class Agent(object):
         ) % (interface, ipaddr, netmask, gateway)
         log.debug("Executing command in VM: %s", command)
         try:
-            session = requests.Session()
-            session.trust_env = False
-            session.proxies = None
-            session.post(
-                "http://%s:%s/execute" % (self.ipaddr, self.port),
-                data={"command": command}, timeout=5
-            )
+            self.post("/execute", request_timeout=5, command=command)
         except requests.exceptions.ConnectionError:
             pass
 
-        # Now wait until the Agent is reachable on the new IP address.
+        # The pooled connections point to the old address, so start over
+        # with a fresh pool and wait until the Agent is reachable on the new
+        # IP address.
+        self.close()
         self.ipaddr = ipaddr
         log.debug(
             f"Waiting for agent to be reachable on: {self.ipaddr}:{self.port}"
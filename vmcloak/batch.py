@@ -0,0 +1,206 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import json
+import logging
+import os
+import threading
+import time
+
+import yaml
+from psutil import virtual_memory
+
+from vmcloak.exceptions import BatchError
+
+log = logging.getLogger(__name__)
+
+OS_VERSIONS = ("win7x64", "win81x64", "win10x64")
+
+# Memory in MB that is kept free for the host itself.
+HOST_RESERVE_RAM = 2048
+
+def _normalize(spec, where):
+    if not isinstance(spec, dict):
+        raise BatchError(f"{where} should be a dictionary")
+    return {str(k).replace("-", "_"): v for k, v in spec.items()}
+
+def load_specs(path, known=None):
+    """Reads the image specs of a YAML or JSON file. The file is either a
+    list of specs or a dictionary with 'images' and optional 'defaults'
+    that apply to all images. Each spec has at least a name and an os,
+    such as win10x64. Option names may be written with - or _. Returns a
+    list of dictionaries with _ keys. If known is given, other keys are an
+    error."""
+    try:
+        with open(path, "r") as fp:
+            if path.endswith(".json"):
+                cfg = json.load(fp)
+            else:
+                cfg = yaml.safe_load(fp)
+    except (OSError, ValueError, yaml.YAMLError) as e:
+        raise BatchError(f"Cannot read {path}: {e}")
+
+    defaults = {}
+    if isinstance(cfg, dict):
+        defaults = _normalize(cfg.get("defaults") or {}, "defaults")
+        cfg = cfg.get("images")
+    if not isinstance(cfg, list) or not cfg:
+        raise BatchError(f"{path} does not have a list of images")
+
+    specs, names = [], set()
+    for number, spec in enumerate(cfg):
+        spec = dict(defaults, **_normalize(spec, f"Image {number + 1}"))
+        name = spec.get("name")
+        if not name:
+            raise BatchError(f"Image {number + 1} has no name")
+        if name in names:
+            raise BatchError(f"Image {name} is specified more than once")
+        if spec.get("os") not in OS_VERSIONS:
+            raise BatchError(
+                f"Image {name} needs an os, one of: {', '.join(OS_VERSIONS)}"
+            )
+        if known is not None:
+            unknown = set(spec) - set(known) - {"name", "os"}
+            if unknown:
+                raise BatchError(
+                    f"Unknown settings for image {name}: "
+                    f"{', '.join(sorted(unknown))}"
+                )
+
+        names.add(name)
+        specs.append(spec)
+    return specs
+
+def host_capacity(reserve_ram=HOST_RESERVE_RAM):
+    """Returns the memory in MB and the number of cores the VMs of a batch
+    may use together."""
+    ram = virtual_memory().total // (1024 * 1024) - reserve_ram
+    return max(ram, 1024), os.cpu_count() or 1
+
+class BatchJob(object):
+    """One image of a batch. The state is one of queued, iso, install,
+    done or failed."""
+
+    def __init__(self, name, attr):
+        self.name = name
+        self.attr = attr
+        self.state = "queued"
+        self.error = None
+        self.started = None
+        self.ended = None
+        self._notify = None
+
+    @property
+    def ramsize(self):
+        return self.attr["ramsize"]
+
+    @property
+    def cpus(self):
+        return self.attr["cpus"]
+
+    @property
+    def elapsed(self):
+        if not self.started:
+            return 0
+        return (self.ended or time.monotonic()) - self.started
+
+    def set_state(self, state):
+        self.state = state
+        if self._notify:
+            self._notify()
+
+class Scheduler(object):
+    """Runs the jobs in threads while the memory and CPUs of the running
+    jobs fit within max_ram and max_cpus. Queued jobs are started in order
+    as soon as they fit. A job that is larger than the limits runs when
+    nothing else does."""
+
+    def __init__(self, max_ram, max_cpus, max_jobs=None):
+        self.max_ram = max_ram
+        self.max_cpus = max_cpus
+        self.max_jobs = max_jobs
+
+    def fits(self, job, running):
+        if not running:
+            return True
+        if self.max_jobs and len(running) >= self.max_jobs:
+            return False
+        ram = sum(j.ramsize for j in running) + job.ramsize
+        cpus = sum(j.cpus for j in running) + job.cpus
+        return ram <= self.max_ram and cpus <= self.max_cpus
+
+    def run(self, jobs, func, on_change=None):
+        """Calls func(job) for all jobs. func may call job.set_state() to
+        report progress. A job fails if func raises, also on SystemExit.
+        on_change(jobs) is called from this thread after each change."""
+        cond = threading.Condition()
+        queued, running = list(jobs), []
+        changed = [False]
+
+        def notify():
+            with cond:
+                changed[0] = True
+                cond.notify()
+
+        def worker(job):
+            try:
+                func(job)
+                job.state = "done"
+            except BaseException as e:
+                # The init helpers log the reason before calling exit().
+                if isinstance(e, (SystemExit, BatchError)):
+                    log.error(f"Failed to create image {job.name}")
+                else:
+                    log.exception(f"Failed to create image {job.name}")
+                job.state = "failed"
+                job.error = str(e) or e.__class__.__name__
+            finally:
+                job.ended = time.monotonic()
+                with cond:
+                    running.remove(job)
+                    changed[0] = True
+                    cond.notify()
+
+        with cond:
+            while queued or running:
+                for job in list(queued):
+                    if not self.fits(job, running):
+                        continue
+                    queued.remove(job)
+                    running.append(job)
+                    job._notify = notify
+                    job.started = time.monotonic()
+                    job.state = "iso"
+                    changed[0] = True
+                    threading.Thread(
+                        target=worker, args=(job,), daemon=True
+                    ).start()
+
+                if changed[0] and on_change:
+                    changed[0] = False
+                    on_change(jobs)
+                cond.wait(timeout=60)
+
+        if on_change:
+            on_change(jobs)
+        return jobs
+
+def status_table(jobs):
+    """Returns the state of all jobs as a text table."""
+    rows = [("NAME", "OS", "IP", "CPUS", "RAM", "STATE", "TIME")]
+    for job in jobs:
+        minutes, seconds = divmod(int(job.elapsed), 60)
+        state = job.state
+        if job.error:
+            state = f"{state}: {job.error}"
+        rows.append((
+            job.name, job.attr["osversion"], job.attr["ip"], str(job.cpus),
+            str(job.ramsize), state, f"{minutes}:{seconds:02d}"
+        ))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(col.ljust(width) for col, width in zip(row, widths)).rstrip()
+        for row in rows
+    )
@@ -0,0 +1,355 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import json
+import logging
+import math
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pkg_resources import parse_version
+
+from vmcloak.agent import Agent
+from vmcloak.exceptions import QMPError
+from vmcloak.install import (
+    DependencyInstaller, parse_dependencies_list, resolve_dependencies,
+    plan_downloads, prefetch_downloads
+)
+from vmcloak.machineconf import MachineConfDump
+from vmcloak.platforms import qemu
+from vmcloak.qmp import QMPClient
+
+log = logging.getLogger(__name__)
+
+class _StandInAgentHandler(BaseHTTPRequestHandler):
+    """Answers the subset of the Agent API that VMCloak uses with canned
+    responses, so the host side can be measured without a guest."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body):
+        buf = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(buf)))
+        self.end_headers()
+        self.wfile.write(buf)
+
+    def do_GET(self):
+        if self.path == "/environ":
+            self._reply({"message": "Environment variables",
+                         "environ": {"SYSTEMDRIVE": "C:"}})
+        else:
+            self._reply({"message": "Cuckoo Agent!", "version": "stand-in"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        self._reply({"message": "Successfully executed command",
+                     "exit_code": 0, "stdout": "", "stderr": ""})
+
+class StandInAgent(ThreadingHTTPServer):
+    """A local HTTP server that looks like an Agent. Use as a context manager
+    to run it in a background thread."""
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0),
+                 handler=_StandInAgentHandler):
+        super().__init__(address, handler)
+        self.connections = 0
+        self._thread = None
+
+    def get_request(self):
+        sock, addr = super().get_request()
+        # Headers and body are written separately, do not let Nagle delay
+        # the body on kept-alive connections.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections += 1
+        return sock, addr
+
+    @property
+    def ipaddr(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+def _run_requests(func, count, concurrency):
+    start = time.monotonic()
+    if concurrency <= 1:
+        for _ in range(count):
+            func()
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for future in [pool.submit(func) for _ in range(count)]:
+                future.result()
+    return time.monotonic() - start
+
+def bench_agent(ipaddr, port, count=1000, concurrency=1):
+    """Measure how many /execute requests per second a single Agent handles,
+    once over a pooled keep-alive session and once with a new session for
+    each request (the old behaviour). Returns a dict with the results."""
+    results = {"requests": count, "concurrency": concurrency}
+
+    with Agent(ipaddr, port, pool_size=max(concurrency, 1)) as a:
+        elapsed = _run_requests(lambda: a.execute("echo"), count, concurrency)
+    results["pooled"] = {"seconds": elapsed, "rps": count / elapsed}
+
+    def unpooled():
+        with Agent(ipaddr, port) as a:
+            a.execute("echo")
+
+    elapsed = _run_requests(unpooled, count, concurrency)
+    results["unpooled"] = {"seconds": elapsed, "rps": count / elapsed}
+    return results
+
+class _BenchInstaller(DependencyInstaller):
+    """Does not record the installed dependencies, as they are installed
+    on a throw-away overlay of the image."""
+
+    def _update_installed_image(self):
+        pass
+
+def bench_install(image, dependencies, profiles):
+    """Install the dependencies on a throw-away overlay of the image once
+    for each profile, a (name, attributes) tuple of the VM settings to
+    compare, such as the fast-build ones. The image itself is not changed.
+    Returns a dict with the seconds and success of each profile."""
+    # Download everything first, so the first run does not also measure
+    # the downloads.
+    deps_versions, _ = parse_dependencies_list(dependencies)
+    deps_versions = resolve_dependencies(image.osversion, deps_versions)
+    prefetch_downloads(plan_downloads(image.osversion, deps_versions))
+
+    original = image.path
+    workdir = tempfile.mkdtemp(
+        prefix="vmcloak-bench", dir=os.path.dirname(original)
+    )
+    results = {}
+    try:
+        for name, attrs in profiles:
+            disk = os.path.join(workdir, f"{name}.qcow2")
+            subprocess.check_call([
+                "qemu-img", "create", "-f", "qcow2", "-o", "cluster_size=2M",
+                "-b", original, "-F", "qcow2", disk
+            ])
+            image.path = disk
+
+            log.info(f"Installing {', '.join(dependencies)} with {name}")
+            start = time.monotonic()
+            installer = _BenchInstaller(image, dependencies, dict(attrs))
+            success = False
+            try:
+                installer.prepare()
+                success = installer.install_all(skip_installed=False)
+            finally:
+                installer.finish()
+            results[name] = {
+                "seconds": time.monotonic() - start, "success": success
+            }
+            os.remove(disk)
+    finally:
+        image.path = original
+        shutil.rmtree(workdir)
+
+    return results
+
+RESTORE_PHASES = ("spawn", "ram_load", "agent", "total")
+
+def percentiles(values):
+    """The min, max, mean and nearest-rank p50, p90 and p99 of values."""
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def rank(pct):
+        return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+    return {
+        "min": values[0], "p50": rank(50), "p90": rank(90),
+        "p99": rank(99), "max": values[-1],
+        "mean": sum(values) / len(values),
+    }
+
+def _load_machineinfo(vm_dir):
+    path = os.path.join(vm_dir, MachineConfDump.DEFAULT_NAME)
+    try:
+        with open(path, "r") as fp:
+            dump = json.load(fp)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Cannot read {path}: {e}")
+
+    machine = dump.get("machine", {})
+    for key in ("start_args", "memory_snapshot", "disk", "ip", "agent_port"):
+        if key not in machine:
+            raise ValueError(f"{path} has no {key}, not a QEMU snapshot?")
+
+    snapshot = os.path.join(vm_dir, machine["memory_snapshot"])
+    if not os.path.exists(snapshot):
+        raise ValueError(f"{snapshot} does not exist")
+    return dump, machine
+
+def _restore_args(qemu_binary, dump, machine, vm_dir, qmp_path):
+    """The QEMU command line that waits for the memory snapshot on QMP.
+    Disk writes go to a temporary file, so the snapshot is not changed."""
+    disk = os.path.join(vm_dir, machine["disk"])
+    args = [qemu_binary] + [
+        arg.replace("%DISPOSABLE_DISK_PATH%", disk)
+        for arg in machine["start_args"]
+    ]
+    qmp = f"unix:{qmp_path},server=on,wait=off"
+    if parse_version(dump.get("machinery_version") or "0") < \
+            parse_version("6.0"):
+        qmp = f"unix:{qmp_path},server,nowait"
+    return args + ["-snapshot", "-qmp", qmp, "-incoming", "defer"]
+
+def _restore_uri(machine, vm_dir):
+    """Returns the migration URI to load the memory snapshot from and its
+    codec."""
+    path = os.path.join(vm_dir, machine["memory_snapshot"])
+    if machine.get("memory_snapshot_format", "stream") != "stream":
+        return f"file:{path}", "none"
+
+    codec = machine.get("memory_snapshot_codec") or \
+        qemu.detect_snapshot_codec(path)
+    return f"exec:{qemu.restore_exec_args(path, codec)}", codec
+
+def _restore_parameters(machine):
+    """The migration parameters the memory snapshot was written with.
+    Snapshots made before they were stored get the ones create_snapshot()
+    used."""
+    parameters = machine.get("memory_snapshot_parameters")
+    if parameters is None:
+        parameters = qemu.snapshot_parameters(
+            machine.get("memory_snapshot_format", "stream")
+        )
+    return parameters
+
+def _wait_for_ping(agent, timeout):
+    end = time.monotonic() + timeout
+    while True:
+        try:
+            agent.ping()
+            return
+        except OSError:
+            if time.monotonic() > end:
+                raise
+            time.sleep(0.05)
+
+def _restore_once(args, qmp_path, machine, uri, agent_timeout):
+    """Restore the snapshot once. Returns the seconds of each phase."""
+    times = {}
+    start = time.monotonic()
+    proc = subprocess.Popen(
+        args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL
+    )
+    client = QMPClient(qmp_path)
+    try:
+        client.connect(proc=proc, retry_interval=0.005)
+        times["spawn"] = time.monotonic() - start
+
+        mark = time.monotonic()
+        capabilities = machine.get("memory_snapshot_capabilities") or []
+        if capabilities:
+            client.execute("migrate-set-capabilities", capabilities=[
+                {"capability": cap, "state": True} for cap in capabilities
+            ])
+        parameters = _restore_parameters(machine)
+        if parameters:
+            client.execute("migrate-set-parameters", **parameters)
+        client.migrate(uri, timeout=agent_timeout, interval=0.05,
+                       incoming=True)
+        times["ram_load"] = time.monotonic() - mark
+
+        mark = time.monotonic()
+        client.execute("cont")
+        with Agent(machine["ip"], machine["agent_port"]) as agent:
+            _wait_for_ping(agent, agent_timeout)
+        times["agent"] = time.monotonic() - mark
+        times["total"] = time.monotonic() - start
+
+        client.quit()
+    finally:
+        client.close()
+        if proc.poll() is None:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        if os.path.exists(qmp_path):
+            os.remove(qmp_path)
+
+    return times
+
+def bench_restore(vm_dir, count=20, qemu_binary="qemu-system-x86_64",
+                  agent_timeout=60):
+    """Restore the snapshot in vm_dir count times and measure how long
+    starting QEMU, loading the memory snapshot and the first Agent ping
+    take. Returns a dict with each run and percentiles of each phase."""
+    dump, machine = _load_machineinfo(vm_dir)
+    uri, codec = _restore_uri(machine, vm_dir)
+    workdir = tempfile.mkdtemp(prefix="vmcloak-bench")
+    qmp_path = os.path.join(workdir, "qmp.sock")
+    args = _restore_args(qemu_binary, dump, machine, vm_dir, qmp_path)
+    log.debug("Restoring with: %s", " ".join(args))
+
+    runs = []
+    failed = 0
+    try:
+        for i in range(count):
+            try:
+                times = _restore_once(
+                    args, qmp_path, machine, uri, agent_timeout
+                )
+            except (QMPError, OSError) as e:
+                log.warning(f"Restore {i + 1} of {count} failed: {e}")
+                failed += 1
+                continue
+
+            log.info(
+                f"Restore {i + 1} of {count}: " + ", ".join(
+                    f"{phase} {times[phase]:.3f}s" for phase in RESTORE_PHASES
+                )
+            )
+            runs.append(times)
+    finally:
+        shutil.rmtree(workdir)
+
+    start_args = machine["start_args"]
+    return {
+        "snapshot": machine["name"],
+        "format": machine.get("memory_snapshot_format", "stream"),
+        "codec": codec,
+        "ramsize": start_args[start_args.index("-m") + 1]
+        if "-m" in start_args else None,
+        "memory_snapshot_size": machine.get("memory_snapshot_size"),
+        "count": count,
+        "failed": failed,
+        "runs": runs,
+        "summary": {
+            phase: percentiles([run[phase] for run in runs])
+            for phase in RESTORE_PHASES
+        },
+    }
@@ -1,5 +1,16 @@
+rem The settings are on a separate drive when the installer ISO is shared
+rem between images.
+if not exist C:\vmcloak\settings.bat (
+    for %%d in (D E F G H I J K L M N O P Q R S T U V W X Y Z) do (
+        if exist %%d:\vmcloak\settings.bat copy %%d:\vmcloak\settings.bat C:\vmcloak\settings.bat
+    )
+)
 call C:\vmcloak\settings.bat
 
+rem Report progress on the serial port, the host logs lines starting with
+rem "vmcloak:" as installation milestones.
+echo vmcloak: bootstrap started >COM1 2>nul
+
 echo Setting static IPv4 address.
 netsh interface ip set address name="%INTERFACE%" ^
     static %GUEST_IP% %GUEST_MASK% %GUEST_GATEWAY% 1
@@ -18,11 +29,15 @@ reg add "HKEY_LOCAL_MACHINE\SOFTWARE\Microsoft\Wind4ws\CurrentVersion\WindowsUpd
 sc config wuauserv start= disabled
 net stop wuauserv
 
+echo vmcloak: installing python >COM1 2>nul
 echo Installing Python
 start /w C:\vmcloak\%PYTHONINSTALLER% PrependPath=1 TargetDir=%PYTHONPATH% /passive
 
-echo Copying agent file to c:\windows\system32\%AGENT_FILE%
-copy c:\vmcloak\%AGENT_FILE% c:\windows\system32\%AGENT_FILE%
+echo vmcloak: installing agent >COM1 2>nul
+rem The name on the installer ISO may be shared with other images, so no
+rem copy is left under that name.
+echo Moving agent file to c:\windows\system32\%AGENT_FILE%
+move c:\vmcloak\%AGENT_SOURCE% c:\windows\system32\%AGENT_FILE%
 
 echo Setting the resolution.
 %PYTHONPATH%\python.exe C:\vmcloak\resolution.py %RESO_WIDTH% %RESO_HEIGHT%
@@ -33,7 +48,9 @@ reg add "HKEY_LOCAL_MACHINE\SOFTWARE\Microsoft\Windows\CurrentVersion\Policies\S
 echo Adding agent autorun key. Agent port: %AGENT_PORT%
 reg add HKLM\Software\Microsoft\Windows\CurrentVersion\Run /v %AGENT_RUNKEY% /t REG_SZ /d "c:\windows\system32\%AGENT_FILE% -host 0.0.0.0 -port %AGENT_PORT%" /f
 
+echo vmcloak: applying settings >COM1 2>nul
 powershell -ExecutionPolicy bypass -File c:\vmcloak\genericsettings.ps1
 
+echo vmcloak: shutting down >COM1 2>nul
 echo Shutting down.
 shutdown -s -t 0
@@ -0,0 +1,30 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+"""Add precompact_size and compact_size columns
+
+Revision ID: 8e1f0b3c27a4
+Revises: d6c5bf858df1
+Create Date: 2021-12-06 14:21:09.512311
+
+"""
+
+# Revision identifiers, used by Alembic.
+revision = '8e1f0b3c27a4'
+down_revision = 'd6c5bf858df1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column(
+        'image', sa.Column('precompact_size', sa.Integer(), nullable=True)
+    )
+    op.add_column(
+        'image', sa.Column('compact_size', sa.Integer(), nullable=True)
+    )
+
+def downgrade():
+    pass
@@ -0,0 +1,123 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import hashlib
+import io
+import json
+import logging
+import os
+import tarfile
+import time
+
+from vmcloak.depcache import DepCache
+from vmcloak.exceptions import BundleError
+from vmcloak.misc import PART_SUFFIX
+
+log = logging.getLogger(__name__)
+
+MANIFEST_NAME = "vmcloak-bundle.json"
+BUNDLE_VERSION = 1
+
+def write_bundle(fileobj, filepaths, cache=None, meta={}):
+    """Write the given files of the dependency cache to fileobj as a tar
+    stream. The first member is a manifest with the name, size, and hashes
+    of each file. Returns the manifest."""
+    cache = cache or DepCache()
+    files = []
+    for filepath in filepaths:
+        entry = cache.hashes(filepath)
+        files.append({
+            "name": os.path.basename(filepath), "size": entry["size"],
+            "sha1": entry["sha1"], "sha256": entry["sha256"],
+        })
+
+    manifest = dict(meta, version=BUNDLE_VERSION, created=int(time.time()),
+                    files=files)
+    buf = json.dumps(manifest, indent=2).encode()
+
+    with tarfile.open(fileobj=fileobj, mode="w|") as tar:
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(buf)
+        info.mtime = manifest["created"]
+        tar.addfile(info, io.BytesIO(buf))
+
+        for filepath, entry in zip(filepaths, files):
+            info = tar.gettarinfo(filepath, arcname=entry["name"])
+            info.uid = info.gid = 0
+            info.uname = info.gname = ""
+            with open(filepath, "rb") as fp:
+                tar.addfile(info, fp)
+
+    return manifest
+
+def read_bundle(fileobj, cache=None):
+    """Unpack a tar stream written by write_bundle() into the dependency
+    cache. Files are hashed while they are unpacked and must match the
+    hashes of the manifest, which are then stored in the hash index. Files
+    the cache already has with the same sha1 are skipped. Returns a tuple of
+    the manifest and the names of the files that were written."""
+    cache = cache or DepCache()
+    os.makedirs(cache.path, exist_ok=True)
+
+    written = []
+    with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+        member = tar.next()
+        if member is None or member.name != MANIFEST_NAME:
+            raise BundleError("Not a VMCloak bundle, manifest missing")
+
+        manifest = json.load(tar.extractfile(member))
+        if manifest.get("version") != BUNDLE_VERSION:
+            raise BundleError(
+                f"Unsupported bundle version {manifest.get('version')}"
+            )
+
+        files = {f["name"]: f for f in manifest["files"]}
+        while True:
+            member = tar.next()
+            if member is None:
+                break
+
+            # Names of the index and of unfinished downloads are not files
+            # of the cache.
+            entry = files.get(member.name)
+            if not entry or not member.isfile() or \
+                    os.path.basename(member.name) != member.name or \
+                    member.name.startswith(".") or \
+                    member.name.endswith((PART_SUFFIX, f"{PART_SUFFIX}.json")):
+                raise BundleError(f"Unexpected bundle member {member.name}")
+
+            if member.size != entry["size"]:
+                raise BundleError(
+                    f"Size of {member.name} does not match the manifest"
+                )
+
+            filepath = os.path.join(cache.path, member.name)
+            existing = cache.lookup(filepath)
+            if existing and existing.get("sha1") == entry["sha1"]:
+                log.debug(f"Already have {member.name}, skipping")
+                continue
+
+            partpath = filepath + PART_SUFFIX
+            hashes = {"sha1": hashlib.sha1(), "sha256": hashlib.sha256()}
+            src = tar.extractfile(member)
+            with open(partpath, "wb") as fp:
+                while True:
+                    buf = src.read(1024*1024)
+                    if not buf:
+                        break
+                    fp.write(buf)
+                    for h in hashes.values():
+                        h.update(buf)
+
+            for name, h in hashes.items():
+                if h.hexdigest() != entry[name]:
+                    os.remove(partpath)
+                    raise BundleError(
+                        f"{name} of {member.name} does not match the manifest"
+                    )
+            os.replace(partpath, filepath)
+            cache.record(filepath, sha1=entry["sha1"], sha256=entry["sha256"])
+            written.append(member.name)
+
+    return manifest, written
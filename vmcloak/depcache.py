@@ -0,0 +1,272 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+
+from vmcloak.misc import hash_file, PART_SUFFIX
+from vmcloak.repository import deps_path
+
+log = logging.getLogger(__name__)
+
+INDEX_NAME = ".index.json"
+LOCK_NAME = ".index.lock"
+INDEX_VERSION = 1
+
+HASHES = ("sha1", "sha256")
+
+def _signature(st):
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns,
+            "inode": st.st_ino}
+
+class DepCache(object):
+    """Index of the files in the dependency cache directory. For each file
+    it remembers the hashes together with the size, mtime, and inode the
+    file had when it was hashed. A file is only hashed again when one of
+    these has changed. The index is a JSON file that is replaced atomically
+    while holding a lock, so multiple VMCloak processes can use it."""
+
+    def __init__(self, path=None):
+        self.path = path or deps_path
+        self.index_path = os.path.join(self.path, INDEX_NAME)
+        self.lock_path = os.path.join(self.path, LOCK_NAME)
+
+    def name(self, filepath):
+        """Returns the name of the file in the index, or None if the file is
+        not inside the cache directory."""
+        relpath = os.path.relpath(os.path.abspath(filepath), self.path)
+        if relpath.startswith(os.pardir):
+            return None
+        return relpath
+
+    @contextlib.contextmanager
+    def locked(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.lock_path, "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def load(self):
+        """Returns the dictionary of file names to index entries."""
+        try:
+            with open(self.index_path, "r") as fp:
+                index = json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            log.warning(f"Ignoring unreadable dependency index. {e}")
+            return {}
+
+        if index.get("version") != INDEX_VERSION:
+            return {}
+        return index.get("files", {})
+
+    def _write(self, files):
+        fd, tmppath = tempfile.mkstemp(dir=self.path, prefix=INDEX_NAME)
+        try:
+            with os.fdopen(fd, "w") as fp:
+                json.dump({"version": INDEX_VERSION, "files": files}, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmppath, self.index_path)
+        except Exception:
+            os.remove(tmppath)
+            raise
+
+    @contextlib.contextmanager
+    def update(self):
+        """Lock the index and yield its files dictionary. Changes made to
+        the dictionary are written when the context exits."""
+        with self.locked():
+            files = self.load()
+            yield files
+            self._write(files)
+
+    @staticmethod
+    def unchanged(filepath, entry):
+        """True if the file still has the size, mtime and inode of the index
+        entry."""
+        try:
+            signature = _signature(os.stat(filepath))
+        except FileNotFoundError:
+            return False
+
+        return all(entry.get(k) == v for k, v in signature.items())
+
+    def lookup(self, filepath):
+        """Returns the index entry of the file if the file did not change
+        since it was hashed. None otherwise."""
+        name = self.name(filepath)
+        if name is None:
+            return None
+
+        entry = self.load().get(name)
+        if not entry or not self.unchanged(filepath, entry):
+            return None
+        return entry
+
+    def record(self, filepath, **hashes):
+        """Store the given hashes of the file in the index, together with the
+        current size, mtime and inode of the file. Returns the entry."""
+        name = self.name(filepath)
+        signature = _signature(os.stat(filepath))
+        if name is None:
+            return dict(signature, **hashes)
+
+        with self.update() as files:
+            entry = files.get(name) or {}
+            # Keep other hashes we already had of the very same file.
+            if any(entry.get(k) != v for k, v in signature.items()):
+                entry = {}
+            entry.update(signature)
+            entry.update(hashes)
+            entry["last_used"] = int(time.time())
+            files[name] = entry
+        return entry
+
+    def touch(self, filepath):
+        """Remember that the file was used just now. Used to decide which
+        files to remove first when collecting garbage."""
+        name = self.name(filepath)
+        if name is None:
+            return
+
+        with self.update() as files:
+            if name in files:
+                files[name]["last_used"] = int(time.time())
+
+    def forget(self, filepath):
+        name = self.name(filepath)
+        if name is None:
+            return
+
+        with self.update() as files:
+            files.pop(name, None)
+
+    def hashes(self, filepath, full=False):
+        """Returns the index entry of the file with all hashes. The file is
+        only hashed if it changed, if a hash is missing, or if full is
+        True."""
+        entry = None if full else self.lookup(filepath)
+        if entry and all(entry.get(h) for h in HASHES):
+            return entry
+
+        log.debug(f"Hashing {filepath}")
+        return self.record(filepath, **hash_file(filepath, HASHES))
+
+    def sha1(self, filepath):
+        """Returns the sha1 of the file, hashing it only if it changed."""
+        entry = self.lookup(filepath)
+        if entry and entry.get("sha1"):
+            return entry["sha1"]
+
+        return self.hashes(filepath)["sha1"]
+
+    def verify(self, full=False):
+        """Bring the index up-to-date with the files in the cache directory.
+        Yields a (name, status, entry) tuple for each file. The status is
+        'ok', 'hashed' (new or changed file), or 'corrupt' (the contents
+        changed while the size, mtime, and inode did not, only detected when
+        full is True). Index entries of removed files are dropped."""
+        if not os.path.isdir(self.path):
+            return
+
+        # One read and one write of the index, however many files there are.
+        files = self.load()
+        present = set()
+        hashed = {}
+        for entry in sorted(os.scandir(self.path), key=lambda e: e.name):
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+
+            # Unfinished downloads.
+            if entry.name.endswith((PART_SUFFIX, f"{PART_SUFFIX}.json")):
+                continue
+
+            present.add(entry.name)
+            previous = files.get(entry.name)
+            if previous and not self.unchanged(entry.path, previous):
+                previous = None
+            if previous and not full and all(previous.get(h) for h in HASHES):
+                yield entry.name, "ok", previous
+                continue
+
+            log.debug(f"Hashing {entry.path}")
+            current = dict(previous or {"last_used": int(time.time())})
+            current.update(hash_file(entry.path, HASHES))
+            current.update(_signature(os.stat(entry.path)))
+            hashed[entry.name] = current
+            if previous is None:
+                status = "hashed"
+            elif previous.get("sha1") and \
+                    previous.get("sha1") != current["sha1"]:
+                status = "corrupt"
+            else:
+                status = "ok"
+            yield entry.name, status, current
+
+        with self.update() as files:
+            files.update(hashed)
+            # Other processes may have added files since the scan.
+            for name in set(files) - present:
+                if not os.path.exists(os.path.join(self.path, name)):
+                    files.pop(name)
+
+    def gc(self, max_size, pinned=(), dry_run=False):
+        """Remove the least recently used files until the cache is no larger
+        than max_size bytes. Files whose name is in pinned are kept.
+        Unfinished downloads are neither removed nor counted. Returns a list
+        of (name, size) of the removed files (or the files that would be
+        removed if dry_run is True) and the size of the cache after."""
+        if not os.path.isdir(self.path):
+            return [], 0
+
+        files = self.load()
+        candidates = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+
+            # Unfinished downloads may still be written to.
+            if entry.name.endswith((PART_SUFFIX, f"{PART_SUFFIX}.json")):
+                continue
+
+            st = entry.stat()
+            total += st.st_size
+            if entry.name in pinned:
+                continue
+
+            # Files that were never used by this version have only their
+            # modification time to go by.
+            last_used = files.get(entry.name, {}).get(
+                "last_used", int(st.st_mtime)
+            )
+            candidates.append((last_used, entry.name, st.st_size))
+
+        removed = []
+        for _, name, size in sorted(candidates):
+            if total <= max_size:
+                break
+
+            if not dry_run:
+                log.debug(f"Removing {name} from the dependency cache")
+                os.remove(os.path.join(self.path, name))
+            removed.append((name, size))
+            total -= size
+
+        if removed and not dry_run:
+            with self.update() as files:
+                for name, _ in removed:
+                    files.pop(name, None)
+
+        return removed, total
@@ -10,19 +10,20 @@ class ACPIShutdown(Dependency):
     name = "acpishutdown"
 
     def run(self):
-        # Tell Windows to shut down if the power button is clicked when it
-        # is running on the battery
-        self.a.execute(
-            "c:\\Windows\\System32\\powercfg.exe "
-            "-setdcvalueindex SCHEME_CURRENT "
-            "4f971e89-eebd-4455-a8de-9e59040e7347 "
-            "7648efa3-dd9c-4e3e-b566-50f929386280 3"
-        )
-        # Tell Windows to shut down if the power button is clicked when it is
-        # not running from the battery
-        self.a.execute(
-            "c:\\Windows\\System32\\powercfg.exe "
-            "-setacvalueindex SCHEME_CURRENT "
-            "4f971e89-eebd-4455-a8de-9e59040e7347 "
-            "7648efa3-dd9c-4e3e-b566-50f929386280 3"
-        )
+        with self.batch():
+            # Tell Windows to shut down if the power button is clicked when
+            # it is running on the battery
+            self.a.execute(
+                "c:\\Windows\\System32\\powercfg.exe "
+                "-setdcvalueindex SCHEME_CURRENT "
+                "4f971e89-eebd-4455-a8de-9e59040e7347 "
+                "7648efa3-dd9c-4e3e-b566-50f929386280 3"
+            )
+            # Tell Windows to shut down if the power button is clicked when
+            # it is not running from the battery
+            self.a.execute(
+                "c:\\Windows\\System32\\powercfg.exe "
+                "-setacvalueindex SCHEME_CURRENT "
+                "4f971e89-eebd-4455-a8de-9e59040e7347 "
+                "7648efa3-dd9c-4e3e-b566-50f929386280 3"
+            )
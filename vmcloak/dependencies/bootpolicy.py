@@ -16,11 +16,12 @@ class BootPolicy(Dependency):
     debug = "0"
 
     def run(self):
-        if self.debug == "1":
-            self.a.execute("%s /debug on" % BCDEDIT)
-            self.a.execute("%s RecoverOS set AutoReboot = false" % WMIC)
-            # Disable memory dump
-            self.a.execute("%s RecoverOS set DebugInfoType = 0" % WMIC)
+        with self.batch():
+            if self.debug == "1":
+                self.a.execute("%s /debug on" % BCDEDIT)
+                self.a.execute("%s RecoverOS set AutoReboot = false" % WMIC)
+                # Disable memory dump
+                self.a.execute("%s RecoverOS set DebugInfoType = 0" % WMIC)
 
-        self.a.execute("%s /timeout 1" % BCDEDIT)
-        self.a.execute("%s /set {current} bootstatuspolicy ignoreallfailures" % BCDEDIT)
+            self.a.execute("%s /timeout 1" % BCDEDIT)
+            self.a.execute("%s /set {current} bootstatuspolicy ignoreallfailures" % BCDEDIT)
@@ -0,0 +1,81 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import logging
+
+from vmcloak.abstract import Dependency
+
+log = logging.getLogger(__name__)
+
+_cleanup_temp_ps = """
+$paths = @(
+    "$env:TEMP\\*", "C:\\Windows\\Temp\\*",
+    "C:\\Windows\\SoftwareDistribution\\Download\\*",
+    "C:\\Windows\\Logs\\CBS\\*", "C:\\Windows\\Prefetch\\*",
+    "C:\\Users\\*\\AppData\\Local\\Temp\\*"
+)
+foreach ($path in $paths) {
+    Remove-Item -Path $path -Recurse -Force -ErrorAction SilentlyContinue
+}
+"""
+
+# The component store cleanup needs the trustedinstaller service, which
+# finalize disables.
+_cleanup_components_ps = """
+$service = Get-WmiObject Win32_Service -Filter "Name='TrustedInstaller'"
+$mode = $service.StartMode
+if ($mode -eq "Disabled") {
+    Set-Service TrustedInstaller -StartupType Manual
+}
+%s
+if ($mode -eq "Disabled") {
+    Stop-Service TrustedInstaller -Force -ErrorAction SilentlyContinue
+    Set-Service TrustedInstaller -StartupType Disabled
+}
+"""
+
+_dism_commands = {
+    "win7x64": "Dism.exe /Online /Cleanup-Image /SpSuperseded /HideSP",
+    "win7x86": "Dism.exe /Online /Cleanup-Image /SpSuperseded /HideSP",
+}
+_dism_default = (
+    "Dism.exe /Online /Cleanup-Image /StartComponentCleanup /ResetBase"
+)
+
+# Fill the free space with zeros so qemu-img convert can leave it out of
+# the image. The VM runs with detect-zeroes=unmap while compacting, so
+# the zeros are not written to the image first. Some space is left free
+# for Windows itself.
+_zero_fill_ps = """
+$path = "C:\\vmcloak-zero.tmp"
+$drive = New-Object System.IO.DriveInfo("C")
+$buf = New-Object byte[] 67108864
+$fs = [System.IO.File]::Create($path)
+try {
+    while ($drive.AvailableFreeSpace -gt 536870912) {
+        $fs.Write($buf, 0, $buf.Length)
+    }
+    $fs.Flush()
+} finally {
+    $fs.Close()
+    Remove-Item $path -Force
+}
+"""
+
+class Cleanup(Dependency):
+    """Removes temporary files and superseded components and zeroes the
+    free disk space. Used by 'vmcloak compact' before compacting the
+    image."""
+    name = "cleanup"
+
+    def run(self):
+        log.info("Removing temporary files")
+        self.run_powershell_strings(_cleanup_temp_ps)
+
+        log.info("Cleaning up the component store, this can take a while")
+        dism = _dism_commands.get(self.i.osversion, _dism_default)
+        self.run_powershell_strings(_cleanup_components_ps % dism)
+
+        log.info("Zeroing free disk space")
+        self.run_powershell_strings(_zero_fill_ps)
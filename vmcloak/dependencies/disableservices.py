@@ -3,37 +3,87 @@
 # See the file 'docs/LICENSE.txt' for copying permission.
 
 import logging
-from pathlib import Path
 
 from vmcloak.abstract import Dependency
 from vmcloak.exceptions import DependencyError
 
 log = logging.getLogger(__name__)
 
+SERVICES_KEY = "SYSTEM\\CurrentControlSet\\Services"
+
+# These lists are based on blackviper's collection of services that can
+# safely be disabled:
+# http://www.blackviper.com/service-configurations/black-vipers-windows-7-service-pack-1-service-configurations/
+# http://www.blackviper.com/service-configurations/black-vipers-windows-10-service-configurations/
+win7_services = [
+    "DPS", "clr_optimization_v2.0.50727_32", "clr_optimization_v2.0.50727_64",
+    "AxInstSV", "SensrSvc", "ALG", "AppMgmt", "BDESVC", "bthserv",
+    "PeerDistSvc", "CertPropSvc", "KeyIso", "VaultSvc", "WdiServiceHost",
+    "WdiSystemHost", "TrkWks", "EapHost", "Fax", "fdPHost", "FDResPub",
+    "hkmsvc", "HomeGroupListener", "HomeGroupProvider", "hidserv", "IKEEXT",
+    "UI0Detect", "iphlpsvc", "PolicyAgent", "lltdsvc", "Mcx2Svc", "MSiSCSI",
+    "NetTcpPortSharing", "Netlogon", "napagent", "CscService", "WPCSvc",
+    "PNRPsvc", "p2psvc", "p2pimsvc", "IPBusEnum", "PNRPAutoReg",
+    "WPDBusEnum", "wercplsupport", "PcaSvc", "QWAVE", "SessionEnv",
+    "TermService", "UmRdpService", "RpcLocator", "RemoteRegistry", "SstpSvc",
+    "wscsvc", "SCardSvr", "SCPolicySvc", "SNMPTRAP", "StorSvc",
+    "TabletInputService", "lmhosts", "TapiSrv", "TBS", "WebClient",
+    "WbioSrvc", "idsvc", "WcsPlugInService", "wcncsvc", "WinDefend",
+    "WerSvc", "MpsSvc", "ehRecvr", "ehSched", "WMPNetworkSvc",
+    "FontCache3.0.0.0", "WinRM", "WSearch", "WinHttpAutoProxySvc", "dot3svc",
+    "Wlansvc", "WwanSvc",
+]
+
+win10_services = [
+    "PrintNotify", "WpnUserService", "OneSyncSvc", "WdBoot", "WdFilter",
+    "WdNisDrv", "WdNisSvc", "WinDefend", "DiagTrack", "DoSvc",
+    "TimeBrokerSvc", "TokenBroker", "Sense", "SecurityHealthService",
+    "wscsvc", "dmwappushservice", "AJRouter", "ALG", "AppMgmt", "bthserv",
+    "PeerDistSvc", "CertPropSvc", "MapsBroker", "Fax", "lfsvc", "HvHost",
+    "vmickvpexchange", "vmicguestinterface", "vmicshutdown", "vmicheartbeat",
+    "vmicvmsession", "vmicrdv", "vmictimesync", "vmicvss", "irmon",
+    "SharedAccess", "iphlpsvc", "IpxlatCfgSvc", "MSiSCSI", "SmsRouter",
+    "NaturalAuthentication", "NetTcpPortSharing", "Netlogon", "NcdAutoSetup",
+    "CscService", "SEMgrSvc", "PhoneSvc", "SessionEnv", "TermService",
+    "UmRdpService", "RpcLocator", "RetailDemo", "SensorDataService",
+    "SensrSvc", "SensorService", "ScDeviceEnum", "SCPolicySvc", "SNMPTRAP",
+    "TabletInputService", "WebClient", "FrameServer", "wcncsvc", "wisvc",
+    "WMPNetworkSvc", "icssvc", "WinRM", "workfolderssvc", "WwanSvc",
+    "XblAuthManager", "XblGameSave", "XboxNetApiSvc", "WFDSConMgrSvc",
+]
+
 class DisableServices(Dependency):
     name = "disableservices"
     must_reboot = True
 
-    disable_scripts = {
-        "win10": Path(
-            Dependency.data_path, "win10", "scripts", "disableservices.ps1"
-        ),
-        "win7": Path(
-            Dependency.data_path, "win7", "scripts", "disableservices.ps1"
-        ),
+    disable_services = {
+        "win10": win10_services,
+        "win7": win7_services,
     }
 
+    def _installed_services(self):
+        res = self.a.execute(f"reg query HKLM\\{SERVICES_KEY}")
+        installed = set()
+        for line in (res.get("stdout") or "").splitlines():
+            if "\\" in line:
+                installed.add(line.strip().rsplit("\\", 1)[-1].lower())
+        return installed
+
     def run(self):
-        disable_script = self.disable_scripts.get(self.h.name)
-        if not disable_script:
+        services = self.disable_services.get(self.h.name)
+        if not services:
             raise DependencyError(
-                f"OS: {self.h.name} has no service disable script available."
+                f"OS: {self.h.name} has no list of services to disable."
             )
 
-        res = self.run_powershell_file(str(disable_script))
-        exit_code = res.get("exit_code")
-        if exit_code:
-            log.debug(
-                f"Service disable return non-zero exit code. {exit_code}. "
-                f"Stderr={res.get('stderr')}. stdout={res.get('stdout')}. "
-            )
+        # Only disable the services that exist, creating a key for a
+        # service that does not exist would be pointless.
+        installed = self._installed_services()
+        missing = [s for s in services if s.lower() not in installed]
+        if missing:
+            log.debug(f"Services not present, skipping: {', '.join(missing)}")
+
+        self.apply_registry([
+            ("HKLM", f"{SERVICES_KEY}\\{service}", "Start", "REG_DWORD", 4)
+            for service in services if service.lower() in installed
+        ])
@@ -15,17 +15,84 @@ _depends = [
     "kb:2786081", "kb:2882822", "kb:2888049", "kb:2834140",
 ]
 
-ie11settings_ps = """
-reg add "HKLM\SOFTWARE\Microsoft\Internet Explorer\Main\FeatureControl\FEATURE_EUPP_GLOBAL_FORCE_DISABLE" /v iexplore.exe /d 1 /t REG_DWORD /f
-# disable first use popup:
-# http://www.geoffchappell.com/notes/windows/ie/firstrun.htm
-reg add "HKEY_LOCAL_MACHINE\Software\Policies\Microsoft\Internet Explorer\Main" /v DisableFirstRunCustomize /t REG_DWORD /d 1 /f
-reg add "HKEY_LOCAL_MACHINE\Software\Microsoft\Internet Explorer\Main" /v RunOnceComplete /t REG_DWORD /d 1 /f
-reg add "HKEY_LOCAL_MACHINE\Software\Microsoft\Internet Explorer\Main" /v RunOnceHasShown /t REG_DWORD /d 1 /f
-
-# Disables auto update:
-# https:/social.technet.microsoft.com/Forums/en-US/c49c96f7-247e-4404-b80f-3df5253dc13f/how-to-uncheck-install-new-versions-automatically-from-internet-explorer-11-from-sccm-2012?forum=ieitprocurrentver
-reg add "HKEY_LOCAL_MACHINE\Software\Microsoft\Internet Explorer\Main" /v EnableAutoUpgrade /t REG_DWORD /d 0 /f
+_ie_main = "Software\\Microsoft\\Internet Explorer\\Main"
+_ie_policy = "Software\\Policies\\Microsoft\\Internet Explorer"
+_inet_settings = "Software\\Microsoft\\Windows\\CurrentVersion\\Internet Settings"
+
+ie11settings = [
+    ("HKLM", f"{_ie_main}\\FeatureControl\\FEATURE_EUPP_GLOBAL_FORCE_DISABLE",
+     "iexplore.exe", "REG_DWORD", 1),
+    # disable first use popup:
+    # http://www.geoffchappell.com/notes/windows/ie/firstrun.htm
+    ("HKLM", f"{_ie_policy}\\Main", "DisableFirstRunCustomize",
+     "REG_DWORD", 1),
+    ("HKLM", _ie_main, "RunOnceComplete", "REG_DWORD", 1),
+    ("HKLM", _ie_main, "RunOnceHasShown", "REG_DWORD", 1),
+
+    # Disables auto update:
+    # https:/social.technet.microsoft.com/Forums/en-US/c49c96f7-247e-4404-b80f-3df5253dc13f/how-to-uncheck-install-new-versions-automatically-from-internet-explorer-11-from-sccm-2012?forum=ieitprocurrentver
+    ("HKLM", _ie_main, "EnableAutoUpgrade", "REG_DWORD", 0),
+
+    # Disable protected mode
+    # https:/www.eightforums.com/tutorials/31977-internet-explorer-enhanced-protected-mode-turn-off.html
+    ("HKLM", f"{_ie_policy}\\Main", "Isolation", "REG_SZ", "PMIL"),
+
+    # weaken security
+    # http:/www.geoffchappell.com/notes/windows/ie/featurecontrol.htm
+    ("HKLM", f"{_ie_policy}\\Main\\FeatureControl\\"
+     "FEATURE_LOCALMACHINE_LOCKDOWN", "iexplore.exe", "REG_DWORD", 0),
+    ("HKLM", f"{_ie_policy}\\Main\\FeatureControl\\"
+     "FEATURE_RESTRICT_FILEDOWNLOAD", "iexplore.exe", "REG_DWORD", 0),
+
+    ("HKCU", "Software\\Microsoft\\Internet Explorer\\Security",
+     "Safety Warning Level", "REG_SZ", "Low"),
+    ("HKCU", "Software\\Microsoft\\Internet Explorer\\Security",
+     "Sending_Security", "REG_SZ", "Low"),
+    ("HKCU", "Software\\Microsoft\\Internet Explorer\\Security",
+     "Viewing_Security", "REG_SZ", "Low"),
+
+    # "You are about to be redirected to a connection that is not secure."
+    ("HKCU", _inet_settings, "WarnOnHTTPSToHTTPRedirect", "REG_DWORD", 0),
+
+    # "You are about to view pages over a secure connection."
+    ("HKCU", _inet_settings, "WarnOnZoneCrossing", "REG_DWORD", 0),
+
+    # "Internet Explorer - Security Warning"
+    # "The publisher could not be verified."
+    ("HKCU", "Software\\Microsoft\\Internet Explorer\\Download",
+     "CheckExeSignatures", "REG_SZ", "no"),
+
+    # Disable "fix security settings" warning
+    # https:/answers.microsoft.com/en-us/ie/forum/ie8-windows_other/when-opening-internet-explorer-constantly-getting/e591c609-1e50-4210-a770-2474beb1430f?auth=1
+    ("HKLM", f"{_ie_policy}\\Main\\Security", "DisableFixSecuritySettings",
+     "REG_DWORD", 1),
+    ("HKLM", f"{_ie_policy}\\Main\\Security", "DisableSecuritySettingsCheck",
+     "REG_DWORD", 1),
+
+    # Disable IE8 IE9+ smartscreen filter:
+    # https:/www.sevenforums.com/tutorials/1406-internet-explorer-smartscreen-filter-turn-off.html
+    ("HKLM", f"{_ie_policy}\\PhishingFilter", "EnabledV8", "REG_DWORD", 0),
+    ("HKLM", f"{_ie_policy}\\PhishingFilter", "EnabledV9", "REG_DWORD", 0),
+
+    ("HKCU", "Software\\Microsoft\\Internet Explorer\\BrowserEmulation",
+     "MSCompatibilityMode", "REG_DWORD", 0),
+
+    # set default webpage and disable IE default browser check:
+    ("HKLM", f"{_ie_policy}\\Main", "Check_Associations", "REG_SZ", "no"),
+    ("HKLM", f"{_ie_policy}\\Main", "Start Page", "REG_SZ", "about:blank"),
+
+    # Set the window size to maximized
+    ("HKCU", _ie_main, "Window_Placement", "REG_BINARY",
+     "2C0000000200000003000000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF"
+     "2400000024000000AA04000089020000"),
+
+    # Disable addons/plugins
+    ("HKCU", _ie_main, "Enable Browser Extensions", "REG_SZ", "no"),
+
+    # Disable 'addon is ready to use' notification
+    ("HKLM", "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Policies\\Ext",
+     "IgnoreFrameApprovalCheck", "REG_DWORD", 1),
+]
 
 #   0        My Computer
 #   1        Local Intranet Zone
@@ -36,69 +103,22 @@ reg add "HKEY_LOCAL_MACHINE\Software\Microsoft\Internet Explorer\Main" /v Enable
 # disable protected mode for all zones for all users
 # https://superuser.com/questions/1031225/what-is-the-registry-setting-to-enable-protected-mode-in-a-specific-zone
 # Sets permissions in every zone to 'permitted'
-$values = @("1001", "1004", "1200", "1201", "1206", "1207", "1208", "1209", "120A", "120B", "1400", "1402",
-"1405", "1406", "1407", "1408", "1409", "1601", "1604", "1605", "1606", "1607", "1608", "1609", "160A", "1800",
-"1802", "1803", "1804", "1805", "1806", "1807", "1808", "1809", "180A", "180C", "180D", "180E", "180F", "1A02",
-"1A03", "1A04", "1A05", "1A06", "1A10", "2000", "2005", "2100", "2101", "2102", "2103", "2104", "2105", "2106",
-"2200", "2201", "2300", "2301", "2400", "2401", "2402", "2500", "2600", "2700", "2004", "2001", "2007", "2107")
-
-foreach ($zone in (0, 1, 2, 3, 4)) {
-    foreach ($value in $values) {
-	reg add ("HKEY_LOCAL_MACHINE\Software\Policies\Microsoft\Windows\CurrentVersion\Internet Settings\Zones\" + $zone) /v $value /t REG_DWORD /d 0 /f
-    }
-}
-
-# Disable protected mode
-# https:/www.eightforums.com/tutorials/31977-internet-explorer-enhanced-protected-mode-turn-off.html
-reg add "HKEY_LOCAL_MACHINE\Software\Policies\Microsoft\Internet Explorer\Main" /v Isolation /t REG_SZ /d PMIL /f
-
-# weaken security
-# http:/www.geoffchappell.com/notes/windows/ie/featurecontrol.htm
-reg add "HKEY_LOCAL_MACHINE\Software\Policies\Microsoft\Internet Explorer\Main\FeatureControl\FEATURE_LOCALMACHINE_LOCKDOWN" /v iexplore.exe /t REG_DWORD /d 0 /f
-reg add "HKEY_LOCAL_MACHINE\Software\Policies\Microsoft\Internet Explorer\Main\FeatureControl\FEATURE_RESTRICT_FILEDOWNLOAD" /v iexplore.exe /t REG_DWORD /d 0 /f
-
-reg add "HKEY_CURRENT_USER\Software\Microsoft\Internet Explorer\Security" /v "Safety Warning Level" /t REG_SZ /d Low /f
-reg add "HKEY_CURRENT_USER\Software\Microsoft\Internet Explorer\Security" /v Sending_Security /t REG_SZ /d Low /f
-reg add "HKEY_CURRENT_USER\Software\Microsoft\Internet Explorer\Security" /v Viewing_Security /t REG_SZ /d Low /f
-
-# "You are about to be redirected to a connection that is not secure."
-reg add "HKEY_CURRENT_USER\Software\Microsoft\Windows\CurrentVersion\Internet Settings" /v WarnOnHTTPSToHTTPRedirect /t REG_DWORD /d 0 /f
-
-# "You are about to view pages over a secure connection."
-reg add "HKEY_CURRENT_USER\Software\Microsoft\Windows\CurrentVersion\Internet Settings" /v WarnOnZoneCrossing /t REG_DWORD /d 0 /f
-
-# "Internet Explorer - Security Warning"
-# "The publisher could not be verified."
-reg add "HKEY_CURRENT_USER\Software\Microsoft\Internet Explorer\Download" /v CheckExeSignatures /t REG_SZ /d no /f
-
-# Disable "fix security settings" warning
-# https:/answers.microsoft.com/en-us/ie/forum/ie8-windows_other/when-opening-internet-explorer-constantly-getting/e591c609-1e50-4210-a770-2474beb1430f?auth=1
-reg add "HKEY_LOCAL_MACHINE\Software\Policies\Microsoft\Internet Explorer\Main\Security" /v DisableFixSecuritySettings /t REG_DWORD /d 1 /f
-
-reg add "HKEY_LOCAL_MACHINE\Software\Policies\Microsoft\Internet Explorer\Main\Security" /v DisableSecuritySettingsCheck /t REG_DWORD /d 1 /f
-
-# Disable IE8 IE9+ smartscreen filter:
-# https:/www.sevenforums.com/tutorials/1406-internet-explorer-smartscreen-filter-turn-off.html
-reg add "HKEY_LOCAL_MACHINE\Software\Policies\Microsoft\Internet Explorer\PhishingFilter" /v EnabledV8 /t REG_DWORD /d 0 /f
-
-reg add "HKEY_LOCAL_MACHINE\Software\Policies\Microsoft\Internet Explorer\PhishingFilter" /v EnabledV9 /t REG_DWORD /d 0 /f
-
-reg add "HKCU\Software\Microsoft\Internet Explorer\BrowserEmulation" /v MSCompatibilityMode /t REG_DWORD /d 0 /f
-
-# set default webpage and disable IE default browser check:
-reg add "HKEY_LOCAL_MACHINE\Software\Policies\Microsoft\Internet Explorer\Main" /v Check_Associations /t REG_SZ /d no /f
-
-reg add "HKEY_LOCAL_MACHINE\Software\Policies\Microsoft\Internet Explorer\Main" /v "Start Page" /t REG_SZ /d about:blank /f
-
-#Set the window size to maximized
-reg add "HKEY_CURRENT_USER\Software\Microsoft\Internet Explorer\Main" /v "Window_Placement" /t REG_BINARY /d "2C0000000200000003000000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF2400000024000000AA04000089020000" /f
-
-#Disable addons/plugins
-reg add "HKEY_CURRENT_USER\Software\Microsoft\Internet Explorer\Main" /v "Enable Browser Extensions" /t REG_SZ /d "no" /f
+_zone_values = [
+    "1001", "1004", "1200", "1201", "1206", "1207", "1208", "1209", "120A",
+    "120B", "1400", "1402", "1405", "1406", "1407", "1408", "1409", "1601",
+    "1604", "1605", "1606", "1607", "1608", "1609", "160A", "1800", "1802",
+    "1803", "1804", "1805", "1806", "1807", "1808", "1809", "180A", "180C",
+    "180D", "180E", "180F", "1A02", "1A03", "1A04", "1A05", "1A06", "1A10",
+    "2000", "2005", "2100", "2101", "2102", "2103", "2104", "2105", "2106",
+    "2200", "2201", "2300", "2301", "2400", "2401", "2402", "2500", "2600",
+    "2700", "2004", "2001", "2007", "2107",
+]
 
-#Disable 'addon is ready to use' notification
-reg add "HKEY_LOCAL_MACHINE\SOFTWARE\Microsoft\Windows\CurrentVersion\Policies\Ext" /v "IgnoreFrameApprovalCheck" /t REG_DWORD /d 1 /f
-"""
+ie11settings += [
+    ("HKLM", "Software\\Policies\\Microsoft\\Windows\\CurrentVersion\\"
+     f"Internet Settings\\Zones\\{zone}", value, "REG_DWORD", 0)
+    for zone in range(5) for value in _zone_values
+]
 
 class IE11(Dependency):
     name = "ie11"
@@ -110,6 +130,7 @@ class IE11(Dependency):
     }
 
     tags = ["browser_internet_explorer"]
+    registry = ie11settings
 
     no_exe = ["win10x64"]
     exes = [{
@@ -167,17 +188,12 @@ class IE11(Dependency):
         # the reboot.
         self.installer.do_reboot()
         log.debug("Applying settings to optimize IE11")
-        res = self.run_powershell_strings(ie11settings_ps)
-        if res.get("stderr"):
-            log.error(
-                "Failed to apply on or more IE11 registry settings. "
-                f"Script return errors. {res.get('stderr')}"
-            )
+        self.apply_registry()
         self._run_once()
 
     def _run_win10(self):
         log.debug("Applying settings to optimize IE11")
-        self.run_powershell_strings(ie11settings_ps)
+        self.apply_registry()
         self._run_once()
 
     def run(self):
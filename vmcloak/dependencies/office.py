@@ -56,259 +56,121 @@ class Office(Dependency):
             )
             return False
 
-    def run(self):
-        self.disable_autorun()
-        self.m.attach_iso(self.isopath)
-
-        self.a.upload(
-            "C:\\config.xml",
-            config % dict(serial_key=self.serialkey, activate=self.activate)
-        )
-        self.a.execute("D:\\setup.exe /config C:\\config.xml")
-
-        # Wait until setup.exe is no longer running.
-        self.wait_process_exit("setup.exe")
-
-        self.a.remove("C:\\config.xml")
-
-        # disable first use popup
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Common\\General\" "
-            "/v ShownFirstRunOptin /t REG_DWORD /d 1 /f" %
-            officever[self.version]
-        )
-
-        # dont report office binary files (pub/doc/xls/etc) to MS if validation failed
-        # https://blogs.technet.microsoft.com/office2010/2009/12/16/office-2010-file-validation/
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Common\\Security\\FileValidation\" "
-            "/v DisableReporting /t REG_DWORD /d 1 /f" %
-            officever[self.version]
-        )
-
-        # Disable all privacy settings in all Office products
-        # https://social.technet.microsoft.com/Forums/office/en-US/0db3e246-04b6-4948-a98c-4459fb65b1f9/privacy-options-in-access-2010?forum=officeitproprevious
-        # https://msdn.microsoft.com/en-us/library/office/aa205294(v=office.11).aspx
-        # https://www.stigviewer.com/stig/microsoft_office_system_2007/2014-01-07/finding/V-17740
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Common\\Internet\" "
-            "/v UseOnlineContent /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Common\\Internet\" "
-            "/v UseOnlineAppDetect /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Common\\Internet\" "
-            "/v IDN_AlertOff /t REG_DWORD /d 1 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Common\\Research\\Options\" "
-            "/v NoDiscovery /t REG_DWORD /d 1 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Common\\Research\\Options\" "
-            "/v DiscoveryNeedOptIn /t REG_DWORD /d 1 /f" %
-            officever[self.version]
-        )
-        # dont use online dictionaries
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Common\\Research\\Translation\" "
-            "/v UseOnline /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Common\" "
-            "/v UpdateReliabilityData /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
-
-        # disable activeX warnings, disable AX safe mode
-        # https://www.greyhathacker.net/?p=948
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\Common\\Security\" "
-            "/v DisableAllActiveX /t REG_DWORD /d 0 /f"
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\Common\\Security\" "
-            "/v UFIControls /t REG_DWORD /d 1 /f"
-        )
+    def registry_tweaks(self):
+        office = "Software\\Microsoft\\Office\\%s" % officever[self.version]
+        entries = [
+            # disable first use popup
+            ("HKCU", f"{office}\\Common\\General",
+             "ShownFirstRunOptin", "REG_DWORD", 1),
+
+            # dont report office binary files (pub/doc/xls/etc) to MS if validation failed
+            # https://blogs.technet.microsoft.com/office2010/2009/12/16/office-2010-file-validation/
+            ("HKCU", f"{office}\\Common\\Security\\FileValidation",
+             "DisableReporting", "REG_DWORD", 1),
+
+            # Disable all privacy settings in all Office products
+            # https://social.technet.microsoft.com/Forums/office/en-US/0db3e246-04b6-4948-a98c-4459fb65b1f9/privacy-options-in-access-2010?forum=officeitproprevious
+            # https://msdn.microsoft.com/en-us/library/office/aa205294(v=office.11).aspx
+            # https://www.stigviewer.com/stig/microsoft_office_system_2007/2014-01-07/finding/V-17740
+            ("HKCU", f"{office}\\Common\\Internet",
+             "UseOnlineContent", "REG_DWORD", 0),
+            ("HKCU", f"{office}\\Common\\Internet",
+             "UseOnlineAppDetect", "REG_DWORD", 0),
+            ("HKCU", f"{office}\\Common\\Internet",
+             "IDN_AlertOff", "REG_DWORD", 1),
+            ("HKCU", f"{office}\\Common\\Research\\Options",
+             "NoDiscovery", "REG_DWORD", 1),
+            ("HKCU", f"{office}\\Common\\Research\\Options",
+             "DiscoveryNeedOptIn", "REG_DWORD", 1),
+            # dont use online dictionaries
+            ("HKCU", f"{office}\\Common\\Research\\Translation",
+             "UseOnline", "REG_DWORD", 0),
+            ("HKCU", f"{office}\\Common",
+             "UpdateReliabilityData", "REG_DWORD", 0),
+
+            # disable activeX warnings, disable AX safe mode
+            # https://www.greyhathacker.net/?p=948
+            ("HKCU", "Software\\Microsoft\\Office\\Common\\Security",
+             "DisableAllActiveX", "REG_DWORD", 0),
+            ("HKCU", "Software\\Microsoft\\Office\\Common\\Security",
+             "UFIControls", "REG_DWORD", 1),
+        ]
 
         # disable Protected View for all office products files
         for product in ["Access", "Excel", "Outlook", "PowerPoint", "Publisher", "Word"]:
-            self.a.execute(
-                "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-                "Microsoft\\Office\\%s\\%s\\Security\\ProtectedView\" "
-                "/v DisableAttachmentsInPV /t REG_DWORD /d 1 /f" %
-                (officever[self.version], product)
-            )
-            self.a.execute(
-                "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-                "Microsoft\\Office\\%s\\%s\\Security\\ProtectedView\" "
-                "/v DisableInternetFilesInPV /t REG_DWORD /d 1 /f" %
-                (officever[self.version], product)
-            )
-            self.a.execute(
-                "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-                "Microsoft\\Office\\%s\\%s\\Security\\ProtectedView\" "
-                "/v DisableUnsafeLocationsInPV /t REG_DWORD /d 1 /f" %
-                (officever[self.version], product)
-            )
+            key = f"{office}\\{product}\\Security\\ProtectedView"
+            for value in ["DisableAttachmentsInPV", "DisableInternetFilesInPV",
+                          "DisableUnsafeLocationsInPV"]:
+                entries.append(("HKCU", key, value, "REG_DWORD", 1))
 
         for product in ["Excel", "Powerpoint", "Word"]:
             # disable DEP and macro warnings
-            self.a.execute(
-                "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-                "Microsoft\\Office\\%s\\%s\\Security\" "
-                "/v EnableDEP /t REG_DWORD /d 0 /f" %
-                (officever[self.version], product)
-            )
-            self.a.execute(
-                "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-                "Microsoft\\Office\\%s\\%s\\Security\" "
-                "/v VBAWarnings /t REG_DWORD /d 1 /f" %
-                (officever[self.version], product)
-            )
-            self.a.execute(
-                "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-                "Microsoft\\Office\\%s\\%s\\Security\" "
-                "/v AccessVBOM /t REG_DWORD /d 1 /f" %
-                (officever[self.version], product)
-            )
+            key = f"{office}\\{product}\\Security"
+            entries.append(("HKCU", key, "EnableDEP", "REG_DWORD", 0))
+            entries.append(("HKCU", key, "VBAWarnings", "REG_DWORD", 1))
+            entries.append(("HKCU", key, "AccessVBOM", "REG_DWORD", 1))
 
             # Dont show warnings for files from the network
-            self.a.execute(
-                "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-                "Microsoft\\Office\\%s\\%s\\Security\\Trusted Locations\" "
-                "/v AllowNetworkLocations /t REG_DWORD /d 1 /f" %
-                (officever[self.version], product)
-            )
+            entries.append((
+                "HKCU", f"{key}\\Trusted Locations",
+                "AllowNetworkLocations", "REG_DWORD", 1
+            ))
 
         # Dont block older Word documents
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
-            "/v OpenInProtectedView /t REG_DWORD /d 2 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
-            "/v Word2Files /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
-            "/v Word60Files /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
-            "/v Word95Files /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
+        key = f"{office}\\Word\\Security\\FileBlock"
+        entries.append(("HKCU", key, "OpenInProtectedView", "REG_DWORD", 2))
+        for value in ["Word2Files", "Word60Files", "Word95Files"]:
+            entries.append(("HKCU", key, value, "REG_DWORD", 0))
 
         # Dont block older Excel documents
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Excel\\Security\\FileBlock\" "
-            "/v OpenInProtectedView /t REG_DWORD /d 2 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
-            "/v XL2Macros /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
-            "/v XL2Worksheets /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
-            "/v XL3Macros /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
-            "/v XL3Worksheets /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
-            "/v XL4Macros /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
-            "/v XL4Workbooks /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
-            "/v XL4Worksheets /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
+        entries.append((
+            "HKCU", f"{office}\\Excel\\Security\\FileBlock",
+            "OpenInProtectedView", "REG_DWORD", 2
+        ))
+        for value in ["XL2Macros", "XL2Worksheets", "XL3Macros",
+                      "XL3Worksheets", "XL4Macros", "XL4Workbooks",
+                      "XL4Worksheets"]:
+            entries.append(("HKCU", key, value, "REG_DWORD", 0))
+
+        entries.extend([
+            # Allow data connections without warnings in Excel
+            # https://www.experts-exchange.com/questions/28247804/Enable-Data-Connections-for-all-users.html
+            ("HKCU", f"{office}\\Excel\\Security",
+             "DataConnectionWarnings", "REG_DWORD", 0),
+
+            # auto update workbook links
+            # https://support.microsoft.com/en-us/help/826921/how-to-control-the-startup-message-about-updating-linked-workbooks-in-excel
+            ("HKCU", f"{office}\\Excel\\Security",
+             "WorkbookLinkWarnings", "REG_DWORD", 0),
+
+            # Enable macros in Outlook
+            ("HKCU", f"{office}\\Outlook\\Security",
+             "Level", "REG_DWORD", 1),
+
+            # disable AV Notification in outlook
+            # https://www.slipstick.com/developer/change-programmatic-access-options/
+            ("HKLM", "SOFTWARE\\Wow6432Node\\Microsoft\\Office\\%s\\Outlook\\Security"
+             % officever[self.version],
+             "ObjectModelGuard", "REG_DWORD", 2),
+        ])
+        return entries
 
-        # Allow data connections without warnings in Excel
-        # https://www.experts-exchange.com/questions/28247804/Enable-Data-Connections-for-all-users.html
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Excel\\Security\" "
-            "/v DataConnectionWarnings /t REG_DWORD /d 0 /f" %
-            officever[self.version]
-        )
+    def run(self):
+        self.disable_autorun()
+        self.m.attach_iso(self.isopath)
 
-        # auto update workbook links
-        # https://support.microsoft.com/en-us/help/826921/how-to-control-the-startup-message-about-updating-linked-workbooks-in-excel
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Excel\\Security\" "
-            "/v WorkbookLinkWarnings /t REG_DWORD /d 0 /f" %
-            officever[self.version]
+        self.a.upload(
+            "C:\\config.xml",
+            config % dict(serial_key=self.serialkey, activate=self.activate)
         )
+        self.a.execute("D:\\setup.exe /config C:\\config.xml")
 
-        # Enable macros in Outlook
-        self.a.execute(
-            "REG ADD \"HKEY_CURRENT_USER\\Software\\"
-            "Microsoft\\Office\\%s\\Outlook\\Security\" "
-            "/v Level /t REG_DWORD /d 1 /f" %
-            officever[self.version]
-        )
+        # Wait until setup.exe is no longer running.
+        self.wait_process_exit("setup.exe")
 
-        # disable AV Notification in outlook
-        # https://www.slipstick.com/developer/change-programmatic-access-options/
-        self.a.execute(
-            "REG ADD \"HKEY_LOCAL_MACHINE\\SOFTWARE\\"
-            "Wow6432Node\\Microsoft\\Office\\%s\\Outlook\\Security\" "
-            "/v ObjectModelGuard /t REG_DWORD /d 2 /f" %
-            officever[self.version]
-        )
+        self.a.remove("C:\\config.xml")
+
+        self.apply_registry()
 
         self.m.detach_iso()
 
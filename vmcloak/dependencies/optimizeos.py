@@ -10,31 +10,218 @@ from vmcloak.exceptions import DependencyError
 
 log = logging.getLogger(__name__)
 
+_explorer_policies = "Software\\Microsoft\\Windows\\CurrentVersion\\Policies\\Explorer"
+_system_policies = "Software\\Microsoft\\Windows\\CurrentVersion\\Policies\\System"
+_defender_rtp = "SOFTWARE\\Policies\\Microsoft\\Windows Defender\\Real-Time Protection"
+_cloud_content = "Software\\Policies\\Microsoft\\Windows\\CloudContent"
+
+win7_registry = [
+    # Hide Action Center icon
+    ("HKCU", _explorer_policies, "HideSCAHealth", "REG_DWORD", 1),
+
+    # Disable security center notifications
+    ("HKLM", "SOFTWARE\\Microsoft\\Security Center", "FirewallOverride",
+     "REG_DWORD", 0),
+    ("HKLM", "SOFTWARE\\Microsoft\\Security Center", "AntiVirusOverride",
+     "REG_DWORD", 0),
+
+    # Disable Roaming security checks
+    ("HKLM", "SOFTWARE\\Policies\\Microsoft\\Windows\\System",
+     "CompatibleRUPSecurity", "REG_DWORD", 0),
+    ("HKCU", "SOFTWARE\\Policies\\Microsoft\\Windows\\System",
+     "CompatibleRUPSecurity", "REG_DWORD", 0),
+
+    # Deactivate the secured shell modus
+    ("HKLM", _explorer_policies, "PreXPSP2ShellProtocolBehavior",
+     "REG_DWORD", 1),
+
+    # Enable TLS 1.1/1.2
+    ("HKLM", "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\"
+     "Internet Settings\\WinHttp\\DefaultSecureProtocols",
+     "DefaultSecureProtocols", "REG_DWORD", 0xAA0),
+    ("HKLM", "SOFTWARE\\Wow6432Node\\Microsoft\\Windows\\CurrentVersion\\"
+     "Internet Settings\\WinHttp\\DefaultSecureProtocols",
+     "DefaultSecureProtocols", "REG_DWORD", 0xAA0),
+    ("HKLM", "SYSTEM\\CurrentControlSet\\Control\\SecurityProviders\\"
+     "SCHANNEL\\Protocols\\TLS 1.1\\Client", "DisabledByDefault",
+     "REG_SZ", "0"),
+    ("HKLM", "SYSTEM\\CurrentControlSet\\Control\\SecurityProviders\\"
+     "SCHANNEL\\Protocols\\TLS 1.2\\Client", "DisabledByDefault",
+     "REG_SZ", "0"),
+]
+
+win10_registry = [
+    # Remove OneDrive startup key
+    ("HKCU", "Software\\Microsoft\\Windows\\CurrentVersion\\Run",
+     "OneDriveSetup", None, None),
+
+    # Disable smartscreen
+    ("HKLM", "SOFTWARE\\Policies\\Microsoft\\Windows\\System",
+     "EnableSmartScreen", "REG_DWORD", 0),
+    ("HKLM", "SOFTWARE\\Policies\\Microsoft\\MicrosoftEdge\\PhishingFilter",
+     "Enabledv9", "REG_DWORD", 0),
+    ("HKLM", "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Explorer",
+     "SmartScreenEnabled", "REG_SZ", "Off"),
+    ("HKCU", "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\AppHost",
+     "SmartScreenEnabled", "REG_SZ", "Off"),
+    ("HKCU", "Software\\Microsoft\\Windows\\CurrentVersion\\AppHost",
+     "EnableWebContentEvaluation", "REG_DWORD", 0),
+    ("HKCU", "Software\\Microsoft\\Windows\\CurrentVersion\\AppHost",
+     "PreventOverride", "REG_DWORD", 0),
+
+    # Further disable Windows Defender
+    ("HKLM", _defender_rtp, "DisableRealtimeMonitoring", "REG_DWORD", 1),
+    ("HKLM", _defender_rtp, "DisableBehaviorMonitoring", "REG_DWORD", 1),
+    ("HKLM", _defender_rtp, "DisableOnAccessProtection", "REG_DWORD", 1),
+    ("HKLM", _defender_rtp, "DisableScanOnRealtimeEnable", "REG_DWORD", 1),
+
+    # Disable biometrics
+    ("HKLM", "SOFTWARE\\Policies\\Microsoft\\Biometrics", "Enabled",
+     "REG_DWORD", 0),
+
+    # Disable the notification center
+    ("HKCU", "Software\\Policies\\Microsoft\\Windows\\Explorer",
+     "DisableNotificationCenter", "REG_DWORD", 1),
+
+    # Disable the Security and Maintenance toast notifications
+    ("HKCU", "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Notifications\\"
+     "Settings\\Windows.SystemToast.SecurityAndMaintenance", "Enabled",
+     "REG_DWORD", 0),
+
+    # Disable windows defender notifications
+    ("HKLM", "SOFTWARE\\Policies\\Microsoft\\Windows Defender\\"
+     "UX Configuration", "Notification_Suppress", "REG_DWORD", 1),
+    ("HKLM", "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Run",
+     "SecurityHealth", None, None),
+
+    # Disable tips about Windows (might cause high cpu load)
+    ("HKCU", "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\"
+     "ContentDeliveryManager", "SoftLandingEnabled", "REG_DWORD", 0),
+
+    # Disable Windows app tracking to improve start and search results
+    ("HKCU", "Software\\Policies\\Microsoft\\Windows\\EdgeUI",
+     "DisableMFUTracking", "REG_DWORD", 1),
+
+    # Disable maintenance
+    ("HKLM", "SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion\\Schedule\\"
+     "Maintenance", "Activation Boundary", "REG_SZ", "2001-01-01T16:00:00"),
+    ("HKLM", "SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion\\Schedule\\"
+     "Maintenance", "MaintenanceDisabled", "REG_DWORD", 1),
+
+    # Skip the first logon animation
+    ("HKLM", _system_policies, "EnableFirstLogonAnimation", "REG_DWORD", 0),
+    ("HKLM", "Software\\Microsoft\\Windows NT\\CurrentVersion\\Winlogon",
+     "EnableFirstLogonAnimation", "REG_DWORD", 0),
+
+    # Enable admin approval mode
+    ("HKLM", _system_policies, "FilterAdministratorToken", "REG_DWORD", 1),
+    ("HKLM", f"{_system_policies}\\UIPI", None, "REG_SZ", "1"),
+
+    # Zero Startup Delay
+    ("HKCU", "Software\\Microsoft\\Windows\\CurrentVersion\\Explorer\\"
+     "Serialize", "Startupdelayinmsec", "REG_DWORD", 0),
+
+    # Disable live tiles
+    ("HKCU", "SOFTWARE\\Policies\\Microsoft\\Windows\\CurrentVersion\\"
+     "PushNotifications", "NoTileApplicationNotification", "REG_DWORD", 1),
+
+    # Diagnostics and feedback
+    ("HKLM", "Software\\Policies\\Microsoft\\Windows\\DataCollection",
+     "DoNotShowFeedbackNotifications", "REG_DWORD", 1),
+    ("HKLM", "SOFTWARE\\Policies\\Microsoft\\Windows\\System",
+     "EnableActivityFeed", "REG_DWORD", 0),
+    ("HKLM", "SOFTWARE\\Policies\\Microsoft\\Windows\\System",
+     "PublishUserActivities", "REG_DWORD", 0),
+    ("HKLM", "SOFTWARE\\Policies\\Microsoft\\Windows\\System",
+     "UploadUserActivities", "REG_DWORD", 0),
+
+    # Do not collect/send data
+    ("HKLM", "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\AdvertisingInfo",
+     "Enabled", "REG_DWORD", 0),
+    ("HKCU", "SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Explorer\\"
+     "Advanced", "Start_TrackProgs", "REG_DWORD", 0),
+
+    # Disable license telemetry
+    ("HKLM", "Software\\Policies\\Microsoft\\Windows NT\\CurrentVersion\\"
+     "Software Protection Platform", "NoGenTicket", "REG_DWORD", 1),
+
+    # Disable windows feedback
+    ("HKCU", "SOFTWARE\\Microsoft\\Siuf\\Rules", "NumberOfSIUFInPeriod",
+     "REG_DWORD", 0),
+
+    # Inking and typing personalization
+    ("HKCU", "Software\\Microsoft\\InputPersonalization",
+     "RestrictImplicitInkCollection", "REG_DWORD", 1),
+    ("HKCU", "SOFTWARE\\Microsoft\\Personalization\\Settings",
+     "AcceptedPrivacyPolicy", "REG_DWORD", 0),
+    ("HKCU", "SOFTWARE\\Microsoft\\InputPersonalization\\TrainedDataStore",
+     "HarvestContacts", "REG_DWORD", 0),
+    ("HKCU", "SOFTWARE\\Microsoft\\InputPersonalization",
+     "RestrictImplicitTextCollection", "REG_DWORD", 1),
+    ("HKLM", "SOFTWARE\\Microsoft\\Speech_OneCore\\Preferences",
+     "ModelDownloadAllowed", "REG_DWORD", 0),
+    ("HKLM", "SOFTWARE\\Policies\\Microsoft\\Windows\\TabletPC",
+     "PreventHandwritingDataSharing", "REG_DWORD", 1),
+    ("HKLM", "SOFTWARE\\Policies\\Microsoft\\Windows\\HandwritingErrorReports",
+     "PreventHandwritingErrorReports", "REG_DWORD", 1),
+
+    # Disable Windows tips
+    ("HKLM", _cloud_content, "DisableSoftLanding", "REG_DWORD", 1),
+    ("HKLM", _cloud_content, "DisableWindowsSpotlightFeatures",
+     "REG_DWORD", 1),
+
+    # Do not automatically download apps
+    ("HKLM", _cloud_content, "DisableWindowsConsumerFeatures",
+     "REG_DWORD", 1),
+
+    # Skip the 'keep using this app' file assocation dialog
+    ("HKCU", "SOFTWARE\\Policies\\Microsoft\\Windows\\Explorer",
+     "NoNewAppAlert", "REG_DWORD", 1),
+
+    # Disable KMS connection broker (SppExtComObj.exe)
+    ("HKLM", "SOFTWARE\\Microsoft\\Windows NT\\CurrentVersion\\"
+     "SoftwareProtectionPlatform", "DisableDnsPublishing", "REG_DWORD", 0),
+
+    # Disable Cortana
+    ("HKLM", "SOFTWARE\\Policies\\Microsoft\\Windows\\Windows Search",
+     "AllowCortana", "REG_DWORD", 0),
+]
+
 class OptimizeOS(Dependency):
     name = "optimizeos"
     must_reboot = True
 
+    optimize_registry = {
+        "win10": win10_registry,
+        "win7": win7_registry,
+    }
+
+    # Whatever cannot be expressed as registry values.
     optimize_scripts = {
         "win10": Path(
             Dependency.data_path, "win10", "scripts", "optimize.ps1"
         ),
-        "win7": Path(
-            Dependency.data_path, "win7", "scripts", "optimize.ps1"
-        ),
     }
 
+    def registry_tweaks(self):
+        return self.optimize_registry.get(self.h.name, [])
+
     def run(self):
-        optimize_script = self.optimize_scripts.get(self.h.name)
-        if not optimize_script:
+        if self.h.name not in self.optimize_registry:
             raise DependencyError(
                 f"OS: {self.h.name} has no optimizing script available."
             )
 
-        res = self.run_powershell_file(str(optimize_script))
-        if res.get("exit_code", 0):
-            raise DependencyError(
-                "OS optimize script returned non-zero exit code."
-                f"exit_code={res.get('exit_code')}"
-                f"stdout={res.get('stdout')}. "
-                f"Stderr={res.get('stderr')}"
-            )
+        optimize_script = self.optimize_scripts.get(self.h.name)
+        if optimize_script:
+            res = self.run_powershell_file(str(optimize_script))
+            if res.get("exit_code", 0):
+                raise DependencyError(
+                    "OS optimize script returned non-zero exit code."
+                    f"exit_code={res.get('exit_code')}"
+                    f"stdout={res.get('stdout')}. "
+                    f"Stderr={res.get('stderr')}"
+                )
+
+        log.debug(f"Applying registry settings to optimize {self.h.name}")
+        self.apply_registry()
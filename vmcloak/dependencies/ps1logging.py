@@ -5,6 +5,8 @@
 from vmcloak.abstract import Dependency
 
 
+_policy = "SOFTWARE\\Policies\\Microsoft\\Windows\\PowerShell"
+
 _win7depends = ["win7sp:sp1", "dotnet:4.6.1", "kb:2819745", "kb:3109118"]
 
 class PS1Logging(Dependency):
@@ -16,41 +18,26 @@ class PS1Logging(Dependency):
         "win7x86": _win7depends
     }
 
-    def run(self):
-        # Set registry keys to enable PowerShell enchanced logging
-
+    registry = [
         # Enable Module Logging for all modules
-        self.a.execute(
-            "reg add \"HKEY_LOCAL_MACHINE\\SOFTWARE\\"
-            "Policies\\Microsoft\\Windows\\PowerShell\\ModuleLogging\" "
-            "/v EnableModuleLogging /t REG_DWORD /d 00000001 /f /reg:64"
-        )
-        self.a.execute(
-            "reg add \"HKEY_LOCAL_MACHINE\\SOFTWARE\\"
-            "Policies\\Microsoft\\Windows\\PowerShell\\ModuleLogging\\ModuleNames\" "
-            "/v * /t REG_SZ /d * /f /reg:64"
-        )
+        ("HKLM", f"{_policy}\\ModuleLogging", "EnableModuleLogging",
+         "REG_DWORD", 1),
+        ("HKLM", f"{_policy}\\ModuleLogging\\ModuleNames", "*",
+         "REG_SZ", "*"),
 
         # Enable Script Block Logging
-        self.a.execute(
-            "reg add \"HKEY_LOCAL_MACHINE\\SOFTWARE\\"
-            "Policies\\Microsoft\\Windows\\PowerShell\\ScriptBlockLogging\" "
-            "/v EnableScriptBlockLogging /t REG_DWORD /d 00000001 /f /reg:64"
-        )
+        ("HKLM", f"{_policy}\\ScriptBlockLogging", "EnableScriptBlockLogging",
+         "REG_DWORD", 1),
 
         # Enable Transcription and log to a central location
-        self.a.execute(
-            "reg add \"HKEY_LOCAL_MACHINE\\SOFTWARE\\"
-            "Policies\\Microsoft\\Windows\\PowerShell\\Transcription\" "
-            "/v EnableTranscripting /t REG_DWORD /d 00000001 /f /reg:64"
-        )
-        self.a.execute(
-            "reg add \"HKEY_LOCAL_MACHINE\\SOFTWARE\\"
-            "Policies\\Microsoft\\Windows\\PowerShell\\Transcription\" "
-            "/v OutputDirectory /t REG_SZ /d \"C:\PSTranscipts\" /f /reg:64"
-        )
-        self.a.execute(
-            "reg add \"HKEY_LOCAL_MACHINE\\SOFTWARE\\"
-            "Policies\\Microsoft\\Windows\\PowerShell\\Transcription\" "
-            "/v EnableInvocationHeader /t REG_DWORD /d 00000001 /f /reg:64"
-        )
+        ("HKLM", f"{_policy}\\Transcription", "EnableTranscripting",
+         "REG_DWORD", 1),
+        ("HKLM", f"{_policy}\\Transcription", "OutputDirectory",
+         "REG_SZ", "C:\\PSTranscipts"),
+        ("HKLM", f"{_policy}\\Transcription", "EnableInvocationHeader",
+         "REG_DWORD", 1),
+    ]
+
+    def run(self):
+        # Set registry keys to enable PowerShell enchanced logging
+        self.apply_registry(view=64)
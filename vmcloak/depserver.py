@@ -0,0 +1,223 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import logging
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from vmcloak.depcache import DepCache
+
+log = logging.getLogger(__name__)
+
+_SHA1_PATH = re.compile(r"^/sha1/([0-9a-fA-F]{40})$")
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+class _DepHandler(BaseHTTPRequestHandler):
+    """Serves the files of the dependency cache as /sha1/<sha1>. Supports
+    HEAD and single byte range requests."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.address_string(), format % args)
+
+    def _error(self, code):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _range(self, size, etag):
+        """Returns the (start, end) to send, None for the whole file, or
+        False if the range cannot be satisfied."""
+        rng = self.headers.get("Range")
+        if not rng:
+            return None
+
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range != etag:
+            return None
+
+        match = _RANGE.match(rng.strip())
+        if not match or match.groups() == ("", ""):
+            return None
+
+        first, last = match.groups()
+        if not first:
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+
+        if start >= size or start > end:
+            return False
+        return start, end
+
+    def _serve(self, send_body):
+        match = _SHA1_PATH.match(self.path)
+        if not match:
+            return self._error(404)
+
+        sha1 = match.group(1).lower()
+        filepath = self.server.find(sha1)
+        if not filepath:
+            return self._error(404)
+
+        with open(filepath, "rb") as fp:
+            size = os.fstat(fp.fileno()).st_size
+            etag = f'"{sha1}"'
+            rng = self._range(size, etag)
+            if rng is False:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            if rng:
+                start, end = rng
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", f"bytes {start}-{end}/{size}"
+                )
+            else:
+                start, end = 0, size - 1
+                self.send_response(200)
+
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.end_headers()
+            if send_body and end >= start:
+                self.wfile.flush()
+                self.connection.sendfile(fp, start, end - start + 1)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+class DepServer(ThreadingHTTPServer):
+    """HTTP server for the dependency cache. Files are addressed by their
+    sha1, which is looked up in the hash index of the cache. Use as a
+    context manager to run it in a background thread.
+
+    Requests never hash files. An unknown sha1 reloads the index, at most
+    once per index_interval seconds, which finds files downloaded by
+    VMCloak since. If it is still unknown it is remembered as missing for
+    missing_ttl seconds and the scanner thread is asked to hash new and
+    changed files. The scanner also runs every scan_interval seconds."""
+    daemon_threads = True
+
+    index_interval = 1
+    missing_ttl = 10
+    scan_interval = 300
+
+    def __init__(self, address=("0.0.0.0", 8080), cache=None):
+        super().__init__(address, _DepHandler)
+        self.cache = cache or DepCache()
+        self._by_sha1 = {}
+        self._missing = {}
+        self._loaded = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._scan_wanted = threading.Event()
+        self.rescan()
+        self._scanner = threading.Thread(target=self._scan_loop)
+        self._scanner.daemon = True
+        self._scanner.start()
+
+    def _set_table(self, entries):
+        by_sha1 = {}
+        for name, entry in entries:
+            if entry.get("sha1"):
+                by_sha1[entry["sha1"]] = (
+                    os.path.join(self.cache.path, name), entry
+                )
+
+        with self._lock:
+            self._by_sha1 = by_sha1
+            self._missing.clear()
+            self._loaded = time.monotonic()
+        return len(by_sha1)
+
+    def rescan(self):
+        """Hash new and changed files and rebuild the sha1 lookup table."""
+        return self._set_table(
+            (name, entry) for name, _, entry in self.cache.verify()
+        )
+
+    def _reload_index(self):
+        with self._lock:
+            if time.monotonic() - self._loaded < self.index_interval:
+                return
+            self._loaded = time.monotonic()
+        self._set_table(self.cache.load().items())
+
+    def _scan_loop(self):
+        while not self._stop.is_set():
+            self._scan_wanted.wait(self.scan_interval)
+            if self._stop.is_set():
+                break
+            self._scan_wanted.clear()
+            try:
+                self.rescan()
+            except Exception as e:
+                log.exception(f"Failed to scan the dependency cache. {e}")
+
+    def _get(self, sha1):
+        with self._lock:
+            filepath, entry = self._by_sha1.get(sha1, (None, None))
+        if filepath and self.cache.unchanged(filepath, entry):
+            return filepath
+        return None
+
+    def find(self, sha1):
+        now = time.monotonic()
+        with self._lock:
+            if self._missing.get(sha1, 0) > now:
+                return None
+
+        filepath = self._get(sha1)
+        if filepath:
+            return filepath
+
+        # Files may have been downloaded since the last scan, or changed.
+        self._reload_index()
+        filepath = self._get(sha1)
+        if filepath:
+            return filepath
+
+        with self._lock:
+            self._missing[sha1] = now + self.missing_ttl
+        self._scan_wanted.set()
+        return None
+
+    @property
+    def file_count(self):
+        return len(self._by_sha1)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def server_close(self):
+        self._stop.set()
+        self._scan_wanted.set()
+        super().server_close()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
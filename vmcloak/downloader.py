@@ -0,0 +1,300 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from vmcloak.misc import (
+    download_file, DOWNLOAD_USER_AGENT, PART_SUFFIX, sha1_file
+)
+
+log = logging.getLogger(__name__)
+
+PROBE_SIZE = 256 * 1024
+SEGMENT_SIZE = 8 * 1024 * 1024
+# Files smaller than this are downloaded with a single stream.
+MIN_SEGMENTED_SIZE = 4 * SEGMENT_SIZE
+CONNECTIONS = 4
+SEGMENT_TRIES = 4
+# A mirror is dropped after this many failed segments, or when it is this
+# many times slower than the fastest mirror.
+MAX_MIRROR_FAILURES = 2
+SLOW_FACTOR = 4
+TIMEOUT = (10, 30)
+
+class Mirror(object):
+    def __init__(self, url):
+        self.url = url
+        self.size = None
+        self.ranges = False
+        self.rate = 0.0
+        self.failures = 0
+        self.inflight = 0
+        self.segments = 0
+        self.dropped = False
+
+    def __repr__(self):
+        return f"<Mirror {self.url} {self.rate / 1024 / 1024:.1f}MB/s>"
+
+def _get(session, url, start=None, end=None):
+    # Sizes and ranges are of the file as it is, not of an encoded body.
+    headers = {
+        "User-Agent": DOWNLOAD_USER_AGENT, "Accept-Encoding": "identity",
+    }
+    if start is not None:
+        headers["Range"] = f"bytes={start}-{end}"
+    return session.get(url, headers=headers, stream=True, timeout=TIMEOUT)
+
+def probe(url):
+    """Fetch the first bytes of url to see if it works, if it supports
+    range requests, how large the file is, and how fast it is. Returns a
+    Mirror, or None if the url does not work."""
+    mirror = Mirror(url)
+    start = time.monotonic()
+    try:
+        with requests.Session() as session, \
+                _get(session, url, 0, PROBE_SIZE - 1) as resp:
+            resp.raise_for_status()
+            if resp.status_code == 206:
+                total = resp.headers.get("Content-Range", "").rpartition("/")
+                if total[2].isdigit():
+                    mirror.size = int(total[2])
+                    mirror.ranges = True
+            elif resp.headers.get("Content-Length", "").isdigit():
+                mirror.size = int(resp.headers["Content-Length"])
+
+            received = 0
+            for chunk in resp.iter_content(chunk_size=64*1024):
+                received += len(chunk)
+                if received >= PROBE_SIZE:
+                    break
+    except requests.RequestException as e:
+        log.warning(f"Mirror {url} does not work: {e}")
+        return None
+
+    mirror.rate = received / max(time.monotonic() - start, 0.001)
+    return mirror
+
+def probe_mirrors(urls):
+    """Probe all urls at once. Returns the working ones as Mirror objects,
+    the fastest first."""
+    with ThreadPoolExecutor(max_workers=len(urls) or 1) as pool:
+        mirrors = [m for m in pool.map(probe, urls) if m]
+
+    mirrors.sort(key=lambda m: m.rate, reverse=True)
+    return mirrors
+
+class SegmentedDownload(object):
+    """Download a file as byte ranges over several connections, spread
+    over the given mirrors. Mirrors that fail or are much slower than the
+    others are dropped while downloading."""
+
+    def __init__(self, mirrors, filepath, size, connections=CONNECTIONS,
+                 segment_size=SEGMENT_SIZE):
+        self.mirrors = mirrors
+        self.filepath = filepath
+        self.size = size
+        self.connections = connections
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _live(self):
+        return [m for m in self.mirrors if not m.dropped]
+
+    def _pick_mirror(self, exclude):
+        with self._lock:
+            live = self._live()
+            candidates = [m for m in live if m not in exclude] or live
+            if not candidates:
+                return None
+
+            mirror = min(
+                candidates,
+                key=lambda m: (m.inflight + 1) / max(m.rate, 1)
+            )
+            mirror.inflight += 1
+            return mirror
+
+    def _drop(self, mirror, reason):
+        # Never drop the last mirror, it may still work on a next try.
+        if mirror.dropped or len(self._live()) <= 1:
+            return
+        mirror.dropped = True
+        log.warning(f"Dropping mirror {mirror.url}: {reason}")
+
+    def _done(self, mirror, length=None, seconds=None):
+        with self._lock:
+            mirror.inflight -= 1
+            if length is None:
+                mirror.failures += 1
+                if mirror.failures >= MAX_MIRROR_FAILURES:
+                    self._drop(mirror, f"{mirror.failures} failed segments")
+                return
+
+            mirror.failures = 0
+            mirror.segments += 1
+            mirror.rate = length / max(seconds, 0.001)
+            # Compare with the segment speed of the other mirrors, not with
+            # the speed of the much smaller probe.
+            fastest = max(m.rate for m in self._live() if m.segments)
+            if mirror.rate * SLOW_FACTOR < fastest:
+                self._drop(
+                    mirror, f"{mirror.rate / 1024 / 1024:.2f}MB/s is too "
+                    f"slow compared to {fastest / 1024 / 1024:.2f}MB/s"
+                )
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _fetch_segment(self, fd, start, end):
+        """Fetch bytes start-end (inclusive) and write them at their offset.
+        Only the length and position of the received range can be checked,
+        the sha1 is of the whole file."""
+        length = end - start + 1
+        tried = []
+        for _ in range(SEGMENT_TRIES):
+            mirror = self._pick_mirror(tried)
+            if not mirror:
+                break
+            tried.append(mirror)
+
+            began = time.monotonic()
+            try:
+                with _get(self._session(), mirror.url, start, end) as resp:
+                    resp.raise_for_status()
+                    expected = f"bytes {start}-{end}/{self.size}"
+                    if resp.status_code != 206 or \
+                            resp.headers.get("Content-Range") != expected:
+                        raise requests.RequestException(
+                            f"Unexpected range response "
+                            f"{resp.headers.get('Content-Range')}"
+                        )
+
+                    offset = start
+                    for chunk in resp.iter_content(chunk_size=256*1024):
+                        if offset + len(chunk) > end + 1:
+                            raise requests.RequestException(
+                                "Received more data than requested"
+                            )
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+
+                if offset != end + 1:
+                    raise requests.RequestException(
+                        f"Received {offset - start} of {length} bytes"
+                    )
+            except requests.RequestException as e:
+                log.debug(
+                    f"Segment {start}-{end} from {mirror.url} failed: {e}"
+                )
+                self._done(mirror)
+                continue
+
+            self._done(mirror, length, time.monotonic() - began)
+            return length
+
+        raise requests.RequestException(
+            f"Could not download segment {start}-{end} from any mirror"
+        )
+
+    def run(self):
+        """Download the file to filepath. Raises requests.RequestException
+        if a segment could not be downloaded."""
+        segments = [
+            (start, min(start + self.segment_size, self.size) - 1)
+            for start in range(0, self.size, self.segment_size)
+        ]
+        fd = os.open(self.filepath, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        try:
+            os.ftruncate(fd, self.size)
+            with ThreadPoolExecutor(max_workers=self.connections) as pool:
+                futures = [
+                    pool.submit(self._fetch_segment, fd, start, end)
+                    for start, end in segments
+                ]
+                try:
+                    for future in futures:
+                        future.result()
+                except requests.RequestException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            os.close(fd)
+
+def download(urls, filepath, expected_sha1=None, connections=CONNECTIONS):
+    """Download a file that is available from one or more urls. The mirrors
+    are probed concurrently. Large files are downloaded in segments from
+    all mirrors that support range requests, the rest is downloaded from
+    the fastest mirror first, trying the others after. Returns
+    (success, sha1)."""
+    mirrors = probe_mirrors(urls)
+    if not mirrors:
+        return False, None
+
+    log.debug(f"Mirrors for {os.path.basename(filepath)}: {mirrors}")
+    ranged = [m for m in mirrors if m.ranges]
+    size = ranged[0].size if ranged else None
+    ranged = [m for m in ranged if m.size == size]
+    if size and size >= MIN_SEGMENTED_SIZE and connections > 1:
+        partpath = filepath + PART_SUFFIX
+        # Segments are not resumable, forget about any earlier partial
+        # single stream download.
+        if os.path.exists(f"{partpath}.json"):
+            os.remove(f"{partpath}.json")
+
+        start = time.monotonic()
+        try:
+            SegmentedDownload(
+                ranged, partpath, size, connections, SEGMENT_SIZE
+            ).run()
+        except requests.RequestException as e:
+            log.warning(f"Segmented download of {filepath} failed: {e}")
+        else:
+            sha1 = sha1_file(partpath)
+            if not expected_sha1 or sha1 == expected_sha1:
+                os.replace(partpath, filepath)
+                took = max(time.monotonic() - start, 0.001)
+                log.debug(
+                    f"Downloaded {os.path.basename(filepath)} "
+                    f"({size / 1024 / 1024:.2f}MB) in {took:.2f}s "
+                    f"({size / 1024 / 1024 / took:.2f}MB/s) from "
+                    f"{len(ranged)} mirror(s)"
+                )
+                return True, sha1
+
+            log.warning(
+                f"Segmented download of {filepath} has sha1 {sha1}, expected "
+                f"{expected_sha1}. Downloading from each mirror in turn"
+            )
+
+        if os.path.exists(partpath):
+            os.remove(partpath)
+
+    for mirror in mirrors:
+        success, sha1 = download_file(mirror.url, filepath)
+        if not success:
+            continue
+
+        if expected_sha1 and sha1 != expected_sha1:
+            log.warning(
+                f"Calculated sha1 hash '{sha1}' of downloaded file "
+                f"{filepath} did not match expected hash "
+                f"'{expected_sha1}'. File source: {mirror.url}"
+            )
+            os.remove(filepath)
+            continue
+
+        return True, sha1
+
+    return False, None
@@ -10,3 +10,15 @@ class DependencyError(Exception):
 
 class SwarmError(Exception):
     pass
+
+class BundleError(Exception):
+    pass
+
+class ISOError(Exception):
+    pass
+
+class BatchError(Exception):
+    pass
+
+class QMPError(Exception):
+    pass
@@ -2,11 +2,18 @@
 # This file is part of VMCloak - http://www.vmcloak.org/.
 # See the file 'docs/LICENSE.txt' for copying permission.
 import logging
+import os
+import subprocess
+import threading
 import time
+import types
+from concurrent.futures import ThreadPoolExecutor
 
 import vmcloak.dependencies
+from vmcloak.abstract import Dependency
 from vmcloak.agent import Agent
 from vmcloak.exceptions import DependencyError
+from vmcloak.layers import layer_item
 from vmcloak.misc import wait_for_agent
 from vmcloak.ostype import get_os
 from vmcloak.repository import Session, Image
@@ -87,6 +94,88 @@ def _raise_for_non_existing(deps_versions):
             f"{', '.join(non_existing)}"
         )
 
+def resolve_dependencies(osversion, deps_versions):
+    """Return the given (dependency, version) list extended with all
+    subdependencies the dependencies have on the given OS version."""
+    target = types.SimpleNamespace(osversion=osversion)
+    resolved = []
+
+    def _add(dep, version):
+        if (dep, version) in resolved:
+            return
+
+        for dep_dependency in \
+                vmcloak.dependencies.names[dep].get_dependencies(target) or []:
+            _add(*_split_dep_version(dep_dependency))
+        resolved.append((dep, version))
+
+    for dep, version in deps_versions:
+        _add(dep, version)
+    return resolved
+
+def plan_downloads(osversion, deps_versions, include_latest=False):
+    """Return the downloadable files of the given dependencies for the given
+    OS version. Files of the 'latest' version are left out, unless
+    include_latest is True, as dependencies always download these again."""
+    arch = get_os(osversion).arch
+    downloadables = {}
+    for dep, version in deps_versions:
+        dependency_class = vmcloak.dependencies.names[dep]
+        try:
+            planned = dependency_class.plan_downloads(osversion, arch, version)
+        except DependencyError as e:
+            log.debug(f"No downloads planned for '{dep}'. {e}")
+            continue
+
+        for downloadable in planned:
+            if downloadable[3] == "latest" and not include_latest:
+                continue
+
+            downloadables.setdefault(downloadable[0], downloadable)
+
+    return list(downloadables.values())
+
+def _prefetch_one(downloadable, stop=None):
+    if stop is not None and stop.is_set():
+        return None, 0
+
+    if Dependency.is_downloaded(downloadable):
+        return True, 0
+
+    Dependency._do_downloads([downloadable])
+    return False, os.path.getsize(downloadable[0])
+
+def prefetch_downloads(downloadables, workers=4, stop=None):
+    """Download and verify all given downloadables on a pool of at most
+    'workers' threads. Failures are logged, the dependency tries again when
+    it is installed. Once the stop event is set, downloads that did not
+    start yet are skipped. Returns a dict with a summary."""
+    summary = {"files": len(downloadables), "cached": 0, "downloaded": 0,
+               "failed": 0, "skipped": 0, "bytes": 0}
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            (d, pool.submit(_prefetch_one, d, stop)) for d in downloadables
+        ]
+        for downloadable, future in futures:
+            try:
+                cached, size = future.result()
+            except (DependencyError, OSError) as e:
+                log.warning(f"Failed to prefetch {downloadable[0]}. {e}")
+                summary["failed"] += 1
+                continue
+
+            if cached is None:
+                summary["skipped"] += 1
+            elif cached:
+                summary["cached"] += 1
+            else:
+                summary["downloaded"] += 1
+                summary["bytes"] += size
+
+    summary["seconds"] = time.monotonic() - start
+    return summary
+
 def _wait_for_agent(agent, timeout=1200):
     # wrap func just to change default argument.
     wait_for_agent(agent, timeout=timeout)
@@ -134,7 +223,7 @@ class _Installable:
 
 class DependencyInstaller:
 
-    def __init__(self, image, dependencies, attrs={}):
+    def __init__(self, image, dependencies, attrs={}, layers=None):
         self.image = image
         self.dependency_list = dependencies
         self.attrs = attrs
@@ -153,6 +242,18 @@ class DependencyInstaller:
         self.agent = Agent(image.ipaddr, image.port)
         self._prepared = False
         self._no_machine_start = False
+        self.prefetch_workers = 4
+        self._prefetch_stop = threading.Event()
+
+        # A LayerStore to store a layer of the image disk after each
+        # dependency in, and to start installing from the deepest
+        # matching layer.
+        self.layers = layers
+        self._layer = None
+        self._layer_base = None
+        self._layer_items = []
+        self._layer_depth = 0
+        self._capture_last = False
 
     def _find_in_queue(self, dep):
         for item in self.install_queue:
@@ -210,6 +311,45 @@ class DependencyInstaller:
 
             self._discover_subdependencies(dep_installer)
 
+    def _all_deps_versions(self):
+        deps_versions = list(self.install_queue)
+        for dep_deps in self._depending_deps.values():
+            deps_versions.extend(dep_deps)
+
+        return deps_versions
+
+    def plan_downloads(self):
+        """Return all files the dependencies and subdependencies that are
+        not installed on the image yet will download."""
+        return plan_downloads(self.image.osversion, [
+            (dep, version) for dep, version in self._all_deps_versions()
+            if not self.image.dependency_installed(dep, version)
+        ])
+
+    def _prefetch(self):
+        downloadables = self.plan_downloads()
+        if not downloadables:
+            return
+
+        log.info(
+            f"Prefetching {len(downloadables)} dependency files using "
+            f"{self.prefetch_workers} workers"
+        )
+        summary = prefetch_downloads(
+            downloadables, self.prefetch_workers, self._prefetch_stop
+        )
+        if self._prefetch_stop.is_set():
+            log.info(f"Stopped prefetching, {summary['skipped']} skipped")
+            return
+
+        mb = summary["bytes"] / 1024 / 1024
+        log.info(
+            f"Prefetched {summary['downloaded']} files "
+            f"({mb:.1f} MB, {mb / max(summary['seconds'], 0.001):.1f} MB/s)"
+            f" in {summary['seconds']:.1f}s. Cache hits: {summary['cached']}."
+            f" Failed: {summary['failed']}"
+        )
+
     def do_reboot(self):
         try:
             # Ignore timeout/socket etc errors as machine will
@@ -223,6 +363,70 @@ class DependencyInstaller:
         # Long timeout as a boot may take long after windows/system updates.
         _wait_for_agent(self.agent, timeout=1200)
 
+    def _branch_layer(self):
+        """Replace the image disk with an overlay on the deepest layer that
+        has a prefix of the install queue installed and remove that prefix
+        from the queue. The disk becomes the base layer if there is none."""
+        disk = self.image.path
+        osversion = self.image.osversion
+        self._layer_base = self.layers.disk_key(disk)
+        self._layer_items = [
+            layer_item(dep, version, self.deps_settings)
+            for dep, version in self.install_queue
+        ]
+        depth, key = self.layers.find(
+            self._layer_base, osversion, self._layer_items
+        )
+        if not key:
+            self._layer = self.layers.adopt(self._layer_base, osversion, disk)
+            return
+
+        meta = self.layers.branch(key, disk)
+        log.info(
+            f"Using layer {key[:16]}, skipping {depth} dependencies: "
+            f"{', '.join(item[0] for item in self._layer_items[:depth])}"
+        )
+        for depname, versions in meta["installed"].items():
+            self.installed.setdefault(depname, []).extend(versions)
+        self.install_queue = self.install_queue[depth:]
+        self._layer = key
+        self._layer_depth = depth
+
+    def _capture_layer(self, count, restart=True):
+        """Store the image disk as the layer with the first count
+        dependencies of the install queue installed. The vm must be shut
+        down. It is started again if restart is True."""
+        depth = self._layer_depth + count
+        try:
+            self._layer = self.layers.capture(
+                self._layer, self._layer_base, self.image.osversion,
+                self._layer_items[:depth], self.image.path,
+                installed=self.installed
+            )
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.error(f"Failed to store layer, not storing more. {e}")
+            self._layer = None
+
+        if restart:
+            self.platform.start_image_vm(self.image, self.attrs)
+            _wait_for_agent(self.agent)
+
+    def _shutdown_vm(self):
+        log.debug("Shutting down vm")
+        try:
+            self.agent.shutdown()
+        except (IOError, OSError) as e:
+            log.error(f"Error sending shutdown command to agent. {e}")
+        finally:
+            self.agent.close()
+
+        try:
+            self.platform.wait_for_shutdown(self.image.name)
+        except ValueError as e:
+            log.error(f"Error while waiting for vm to shut down: {e}")
+
+        self.platform.remove_vm_data(self.image.name)
+
     def prepare(self, timeout=1200, no_machine_start=False):
         """Compile list of all dependencies to install and starts a vm for the
         image to install them on. Returns when the vm has booted and its agent
@@ -230,12 +434,33 @@ class DependencyInstaller:
         log.debug("Find all dependencies of the chosen dependencies")
         self._populate_dep_dependencies()
 
-        if not no_machine_start:
-            self.platform.start_image_vm(self.image, self.attrs)
-        else:
-            self._no_machine_start = no_machine_start
+        if self.layers:
+            if no_machine_start:
+                raise InstallError(
+                    "Layers cannot be stored of a machine that is not "
+                    "started by VMCloak"
+                )
+            self._branch_layer()
+
+        # Download everything while the vm boots. Wait for it to finish
+        # before installing, so dependencies do not download the same file.
+        # If the vm does not come up, do not wait for the downloads.
+        prefetcher = ThreadPoolExecutor(max_workers=1)
+        prefetch = prefetcher.submit(self._prefetch)
+        try:
+            if not no_machine_start:
+                self.platform.start_image_vm(self.image, self.attrs)
+            else:
+                self._no_machine_start = no_machine_start
+
+            _wait_for_agent(self.agent, timeout=timeout)
+            prefetch.result()
+        except BaseException:
+            self._prefetch_stop.set()
+            raise
+        finally:
+            prefetcher.shutdown(wait=False)
 
-        _wait_for_agent(self.agent, timeout=timeout)
         self._prepared = True
 
     def _is_installed(self, depname, version=None):
@@ -324,19 +549,31 @@ class DependencyInstaller:
                     f"Failed to install dependency '{dep}'. {e}"
                 )
                 has_fails = True
+                # Later layers would miss this dependency.
+                self._layer = None
+                continue
+
+            # Store a layer after each dependency. The shutdown also does
+            # what a reboot would do. The last layer is stored by finish.
+            last = len(self.install_queue) == dep_count
+            if self._layer and installable and not last:
+                log.info(f"Storing a layer with '{dep}' installed")
+                self._shutdown_vm()
+                self._capture_layer(dep_count)
                 continue
 
             # Do a reboot is a dependency/change requires it. But only if
             # it is not the last one. If it is the last one, normal shutdown
             # will suffice.
             if installable and installable.dependency_class.must_reboot and \
-                    len(self.install_queue) != dep_count:
+                    not last:
                 log.debug(
                     f"Rebooting machine as dependency '{dep}' requires it."
                 )
                 self.do_reboot()
 
         log.info("No more dependencies to install")
+        self._capture_last = self._layer is not None
 
         return not has_fails
 
@@ -369,15 +606,6 @@ class DependencyInstaller:
         if self._no_machine_start:
             return
 
-        log.debug("Shutting down vm")
-        try:
-            self.agent.shutdown()
-        except (IOError, OSError) as e:
-            log.error(f"Error sending shutdown command to agent. {e}")
-
-        try:
-            self.platform.wait_for_shutdown(self.image.name)
-        except ValueError as e:
-            log.error(f"Error while waiting for vm to shut down: {e}")
-
-        self.platform.remove_vm_data(self.image.name)
+        self._shutdown_vm()
+        if self._capture_last and self.install_queue:
+            self._capture_layer(len(self.install_queue), restart=False)
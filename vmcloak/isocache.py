@@ -0,0 +1,136 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from vmcloak.isoreader import ISOImage
+from vmcloak.misc import sha1_file
+from vmcloak.repository import iso_dst_path
+
+log = logging.getLogger(__name__)
+
+# Change this when the layout of the static ISO changes, so older ISOs in
+# the cache are no longer used.
+STATIC_VERSION = 1
+
+def _tree_files(path):
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            filepath = os.path.join(dirpath, fname)
+            yield os.path.relpath(filepath, path), filepath
+
+def static_iso_key(h, mount, bootstrap, graft=True):
+    """Returns a hash of everything that ends up on the static ISO of OS
+    handler h. The files of the mounted installer ISO are identified by
+    their path, size and mtime (or the ISO file itself when reading an
+    ISOImage), the small files VMCloak adds by their sha1."""
+    inputs = {
+        "version": STATIC_VERSION,
+        "os": [h.name, h.arch, h.osdir, h.genisoargs, graft],
+        "mount": [], "files": [],
+    }
+    if isinstance(mount, ISOImage):
+        inputs["mount"].append(mount.signature)
+    else:
+        for relpath, filepath in _tree_files(mount):
+            st = os.stat(filepath)
+            inputs["mount"].append([relpath, st.st_size, st.st_mtime_ns])
+
+    agent_path, _ = h.find_agent_binary()
+    added = [("boot.img", os.path.join(h.path, "boot.img")),
+             ("agent", agent_path)]
+    added.extend(
+        (f"bootstrap/{relpath}", filepath)
+        for relpath, filepath in _tree_files(h.bootstrap_path)
+        if os.path.dirname(relpath) == ""
+    )
+    added.extend(
+        (f"extra/{relpath}", filepath)
+        for relpath, filepath in _tree_files(bootstrap)
+    )
+    for name, filepath in added:
+        inputs["files"].append([name, sha1_file(filepath)])
+
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True).encode()
+    ).hexdigest()
+
+class StaticISOCache(object):
+    """Built static installer ISOs, see OperatingSystem.buildstatic(),
+    stored as <os>-<key>.iso with a .json file that has the name of the
+    agent on the ISO. Building is done under a lock so concurrent runs
+    wait for one another instead of building the same ISO twice."""
+
+    def __init__(self, path=None):
+        self.path = path or iso_dst_path
+
+    def paths(self, h, key):
+        base = os.path.join(self.path, f"{h.name}-{key[:16]}")
+        return f"{base}.iso", f"{base}.json"
+
+    @contextlib.contextmanager
+    def _locked(self, isopath):
+        os.makedirs(self.path, exist_ok=True)
+        with open(f"{isopath}.lock", "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def lookup(self, h, key):
+        """Returns (isopath, meta) of the cached ISO, or None."""
+        isopath, metapath = self.paths(h, key)
+        try:
+            with open(metapath, "r") as fp:
+                meta = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if meta.get("key") != key or not os.path.isfile(isopath):
+            return None
+        return isopath, meta
+
+    def get(self, h, mount, bootstrap, tmp_dir=None, graft=True):
+        """Returns (isopath, meta) of the static ISO for these inputs,
+        building it first if it is not cached. Returns None if building
+        fails."""
+        key = static_iso_key(h, mount, bootstrap, graft)
+        isopath, metapath = self.paths(h, key)
+        with self._locked(isopath):
+            cached = self.lookup(h, key)
+            if cached:
+                log.info(f"Using cached installer ISO {isopath}")
+                return cached
+
+            log.info(f"Building installer ISO {isopath}")
+            fd, tmppath = tempfile.mkstemp(
+                dir=self.path, prefix=os.path.basename(isopath)
+            )
+            os.close(fd)
+            try:
+                agent_file = h.buildstatic(
+                    mount, tmppath, bootstrap, tmp_dir, graft=graft
+                )
+                if not agent_file:
+                    return None
+
+                meta = {"key": key, "os": h.name, "agent": agent_file}
+                with open(metapath, "w") as fp:
+                    json.dump(meta, fp)
+                # Images attach it read-only and share it.
+                os.chmod(tmppath, 0o444)
+                os.replace(tmppath, isopath)
+            finally:
+                if os.path.exists(tmppath):
+                    os.remove(tmppath)
+
+        return isopath, meta
@@ -0,0 +1,362 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import mmap
+import os
+import struct
+
+from vmcloak.exceptions import ISOError
+
+SECTOR_SIZE = 2048
+FIRST_DESCRIPTOR = 16
+JOLIET_ESCAPES = (b"%/@", b"%/C", b"%/E")
+# The UDF anchor volume descriptor pointer is at this sector.
+UDF_ANCHOR = 256
+COPY_CHUNK = 1024 * 1024
+
+# UDF descriptor tag identifiers.
+TAG_ANCHOR = 2
+TAG_PARTITION = 5
+TAG_LOGICAL_VOLUME = 6
+TAG_TERMINATOR = 8
+TAG_FILE_SET = 256
+TAG_FILE_IDENTIFIER = 257
+TAG_FILE_ENTRY = 261
+TAG_EXTENDED_FILE_ENTRY = 266
+
+class ISOEntry(object):
+    """A file or directory of an ISOImage. The data of a file is a list of
+    (offset, length) extents in the image file."""
+
+    def __init__(self, image, name, is_dir, extents, size):
+        self.image = image
+        self.name = name
+        self.is_dir = is_dir
+        self.extents = extents
+        self.size = size
+
+    def __repr__(self):
+        return f"<ISOEntry {self.name} {self.size}>"
+
+    def chunks(self, chunk_size=COPY_CHUNK):
+        """Yields the data of the file as memoryviews of the memory mapped
+        image, so nothing is copied until it is written."""
+        view = memoryview(self.image.mm)
+        remaining = self.size
+        try:
+            for offset, length in self.extents:
+                length = min(length, remaining)
+                if offset + length > len(view):
+                    raise ISOError(f"{self.name} extends beyond the image")
+                remaining -= length
+                end = offset + length
+                while offset < end:
+                    size = min(chunk_size, end - offset)
+                    yield view[offset:offset + size]
+                    offset += size
+        finally:
+            view.release()
+
+    def write_to(self, fp):
+        for chunk in self.chunks():
+            fp.write(chunk)
+
+    def read(self):
+        return b"".join(bytes(chunk) for chunk in self.chunks())
+
+def _udf_string(buf):
+    """Decode an OSTA compressed unicode (CS0) string."""
+    if not buf:
+        return ""
+    if buf[0] == 8:
+        return buf[1:].decode("latin1")
+    if buf[0] == 16:
+        return buf[1:].decode("utf-16-be", "replace")
+    raise ISOError(f"Unknown UDF string compression {buf[0]}")
+
+def _udf_dstring(buf):
+    # The last byte of a fixed length dstring is the length of the string.
+    return _udf_string(buf[:buf[-1]]) if buf[-1] else ""
+
+class ISOImage(object):
+    """Reads the files of an ISO image without mounting it. The UDF file
+    system is used if there is one, as Windows installer ISOs keep their
+    files there, otherwise the Joliet or ISO9660 directory tree. The image
+    is memory mapped, so any number of builds can read one image."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, "rb")
+        try:
+            self.mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._fp.close()
+            raise ISOError(f"{path} is empty")
+
+        self.volume_id = ""
+        self.filesystem = None
+        try:
+            self._root = self._udf_root()
+            if self._root is None:
+                self._root = self._iso9660_root()
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            self.close()
+            raise ISOError(f"{path} is not a valid ISO image: {e}")
+        except ISOError:
+            self.close()
+            raise
+
+    def close(self):
+        self.mm.close()
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _sector(self, number, count=1):
+        offset = number * SECTOR_SIZE
+        if offset + count * SECTOR_SIZE > len(self.mm):
+            raise ISOError(f"Sector {number} is beyond the end of the image")
+        return self.mm[offset:offset + count * SECTOR_SIZE]
+
+    #
+    # ISO9660 and Joliet.
+    #
+
+    def _iso9660_root(self):
+        primary = joliet = None
+        number = FIRST_DESCRIPTOR
+        while True:
+            desc = self._sector(number)
+            if desc[1:6] != b"CD001":
+                raise ISOError(f"{self.path} is not an ISO image")
+            if desc[0] == 255:
+                break
+            if desc[0] == 1 and primary is None:
+                primary = desc
+            elif desc[0] == 2 and desc[88:91] in JOLIET_ESCAPES:
+                joliet = desc
+            number += 1
+
+        if primary is None:
+            raise ISOError(f"{self.path} has no primary volume descriptor")
+
+        self.volume_id = primary[40:72].decode("latin1").strip()
+        self.filesystem = "joliet" if joliet else "iso9660"
+        desc = joliet or primary
+        extent, size = struct.unpack_from("<I4xI", desc, 156 + 2)
+        return ISOEntry(self, "", True, [(extent * SECTOR_SIZE, size)], size)
+
+    def _iso9660_children(self, entry):
+        joliet = self.filesystem == "joliet"
+        children = []
+        for offset, length in entry.extents:
+            buf = self.mm[offset:offset + length]
+            pos = 0
+            while pos < len(buf):
+                reclen = buf[pos]
+                if not reclen:
+                    # Records do not cross sectors, the rest is padding.
+                    pos = (pos // SECTOR_SIZE + 1) * SECTOR_SIZE
+                    continue
+
+                extent, size = struct.unpack_from("<I4xI", buf, pos + 2)
+                flags = buf[pos + 25]
+                ident = bytes(buf[pos + 33:pos + 33 + buf[pos + 32]])
+                pos += reclen
+                if ident in (b"\x00", b"\x01"):
+                    continue
+
+                name = ident.decode("utf-16-be" if joliet else "latin1")
+                if not flags & 2:
+                    name = name.split(";")[0]
+                    if not joliet:
+                        name = name.rstrip(".")
+
+                # Files larger than 4GB have a record for each extent, all
+                # but the last with the multi-extent flag.
+                previous = children[-1] if children else None
+                if previous and previous.name == name and \
+                        previous.multi_extent:
+                    previous.extents.append((extent * SECTOR_SIZE, size))
+                    previous.size += size
+                    previous.multi_extent = bool(flags & 0x80)
+                    continue
+
+                child = ISOEntry(
+                    self, name, bool(flags & 2),
+                    [(extent * SECTOR_SIZE, size)], size
+                )
+                child.multi_extent = bool(flags & 0x80)
+                children.append(child)
+        return children
+
+    #
+    # UDF.
+    #
+
+    def _udf_root(self):
+        if len(self.mm) < (UDF_ANCHOR + 1) * SECTOR_SIZE:
+            return None
+
+        anchor = self._sector(UDF_ANCHOR)
+        if struct.unpack_from("<H", anchor)[0] != TAG_ANCHOR:
+            return None
+
+        length, location = struct.unpack_from("<II", anchor, 16)
+        partitions, maps, fileset = {}, [], None
+        for number in range(location, location + length // SECTOR_SIZE):
+            desc = self._sector(number)
+            tag = struct.unpack_from("<H", desc)[0]
+            if tag == TAG_PARTITION:
+                partition = struct.unpack_from("<H", desc, 22)[0]
+                partitions[partition] = struct.unpack_from("<I", desc, 188)[0]
+            elif tag == TAG_LOGICAL_VOLUME:
+                block_size = struct.unpack_from("<I", desc, 212)[0]
+                if block_size != SECTOR_SIZE:
+                    raise ISOError(f"Unsupported UDF block size {block_size}")
+                self.volume_id = _udf_dstring(desc[84:212])
+                fileset = struct.unpack_from("<IIH", desc, 248)
+                count = struct.unpack_from("<I", desc, 268)[0]
+                pos = 440
+                for _ in range(count):
+                    maptype, maplen = desc[pos], desc[pos + 1]
+                    if maptype != 1:
+                        raise ISOError(
+                            "Only UDF type 1 partition maps are supported"
+                        )
+                    maps.append(struct.unpack_from("<H", desc, pos + 4)[0])
+                    pos += maplen
+            elif tag == TAG_TERMINATOR:
+                break
+
+        if fileset is None or not maps:
+            raise ISOError(f"{self.path} has no UDF logical volume")
+
+        self._udf_starts = [partitions[partition] for partition in maps]
+        _, lbn, ref = fileset
+        fsd = self._sector(self._udf_block(lbn, ref))
+        if struct.unpack_from("<H", fsd)[0] != TAG_FILE_SET:
+            raise ISOError(f"{self.path} has no UDF file set descriptor")
+
+        self.filesystem = "udf"
+        _, lbn, ref = struct.unpack_from("<IIH", fsd, 400)
+        return self._udf_entry("", lbn, ref)
+
+    def _udf_block(self, lbn, ref):
+        return self._udf_starts[ref] + lbn
+
+    def _udf_entry(self, name, lbn, ref):
+        block = self._udf_block(lbn, ref)
+        fe = self._sector(block)
+        tag = struct.unpack_from("<H", fe)[0]
+        if tag == TAG_FILE_ENTRY:
+            ea_len, ad_len = struct.unpack_from("<II", fe, 168)
+            ad_start = 176 + ea_len
+        elif tag == TAG_EXTENDED_FILE_ENTRY:
+            ea_len, ad_len = struct.unpack_from("<II", fe, 208)
+            ad_start = 216 + ea_len
+        else:
+            raise ISOError(f"Expected a UDF file entry for {name}, got {tag}")
+
+        is_dir = fe[16 + 11] == 4
+        size = struct.unpack_from("<Q", fe, 56)[0]
+        adtype = struct.unpack_from("<H", fe, 16 + 18)[0] & 7
+        ads = fe[ad_start:ad_start + ad_len]
+
+        extents = []
+        if adtype == 3:
+            # The data is embedded in the file entry.
+            offset = block * SECTOR_SIZE + ad_start
+            extents.append((offset, ad_len))
+        elif adtype in (0, 1):
+            adsize = 8 if adtype == 0 else 16
+            for pos in range(0, len(ads) - adsize + 1, adsize):
+                length, position = struct.unpack_from("<II", ads, pos)
+                partref = ref if adtype == 0 else \
+                    struct.unpack_from("<H", ads, pos + 8)[0]
+                # The two high bits are the extent type, only recorded
+                # extents (0) have data.
+                if length >> 30:
+                    continue
+                extents.append(
+                    (self._udf_block(position, partref) * SECTOR_SIZE,
+                     length & 0x3fffffff)
+                )
+        else:
+            raise ISOError(f"Unsupported UDF allocation descriptors for {name}")
+
+        return ISOEntry(self, name, is_dir, extents, size)
+
+    def _udf_children(self, entry):
+        buf = b"".join(bytes(chunk) for chunk in entry.chunks())
+        children = []
+        pos = 0
+        while pos + 38 <= len(buf):
+            tag = struct.unpack_from("<H", buf, pos)[0]
+            if tag != TAG_FILE_IDENTIFIER:
+                raise ISOError(f"Invalid UDF directory {entry.name}")
+
+            characteristics, fi_len = buf[pos + 18], buf[pos + 19]
+            _, lbn, ref = struct.unpack_from("<IIH", buf, pos + 20)
+            iu_len = struct.unpack_from("<H", buf, pos + 36)[0]
+            ident = buf[pos + 38 + iu_len:pos + 38 + iu_len + fi_len]
+            pos += (38 + iu_len + fi_len + 3) & ~3
+
+            # Skip the parent and deleted entries.
+            if characteristics & (8 | 4):
+                continue
+            children.append(self._udf_entry(_udf_string(ident), lbn, ref))
+        return children
+
+    #
+    # Public interface.
+    #
+
+    def children(self, entry):
+        if self.filesystem == "udf":
+            return self._udf_children(entry)
+        return self._iso9660_children(entry)
+
+    def walk(self, entry=None, prefix=""):
+        """Yields (path, entry) for all files and directories."""
+        for child in self.children(entry or self._root):
+            path = f"{prefix}{child.name}"
+            yield path, child
+            if child.is_dir:
+                yield from self.walk(child, f"{path}/")
+
+    def find(self, relpath):
+        """Returns the entry of relpath, matched case-insensitively, or
+        None."""
+        entry = self._root
+        for part in relpath.replace("\\", "/").split("/"):
+            if not part:
+                continue
+            if not entry.is_dir:
+                return None
+            for child in self.children(entry):
+                if child.name.lower() == part.lower():
+                    entry = child
+                    break
+            else:
+                return None
+        return entry
+
+    def read(self, relpath):
+        """Returns the contents of relpath, or None if there is no such
+        file."""
+        entry = self.find(relpath)
+        if entry is None or entry.is_dir:
+            return None
+        return entry.read()
+
+    @property
+    def signature(self):
+        """Identifies the image file by name, size, and mtime."""
+        st = os.stat(self.path)
+        return [os.path.basename(self.path), st.st_size, st.st_mtime_ns]
@@ -0,0 +1,390 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import io
+import os
+import re
+import shutil
+import struct
+import time
+
+SECTOR_SIZE = 2048
+# Sectors 0-15 are the system area, the volume descriptors start after.
+FIRST_DESCRIPTOR = 16
+# The Joliet UCS-2 level 3 escape sequence.
+JOLIET_ESCAPE = b"%/E"
+JOLIET_MAX_NAME = 103
+# Files larger than this are split into several extents, each with its own
+# directory record.
+MAX_EXTENT = 0xfffff800
+COPY_CHUNK = 1024 * 1024
+
+def _both16(value):
+    return struct.pack("<H", value) + struct.pack(">H", value)
+
+def _both32(value):
+    return struct.pack("<I", value) + struct.pack(">I", value)
+
+def _sectors(size):
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+def _record_date(timestamp):
+    t = time.gmtime(timestamp)
+    return bytes((t.tm_year - 1900, t.tm_mon, t.tm_mday, t.tm_hour,
+                  t.tm_min, t.tm_sec, 0))
+
+def _volume_date(timestamp):
+    return time.strftime(
+        "%Y%m%d%H%M%S00", time.gmtime(timestamp)
+    ).encode() + b"\x00"
+
+def _record_length(ident):
+    # A padding byte keeps each record at an even length.
+    return 33 + len(ident) + (len(ident) % 2 == 0)
+
+def _dir_record(extent, size, flags, ident, date):
+    length = _record_length(ident)
+    record = struct.pack("<BB", length, 0) + _both32(extent) + \
+        _both32(size) + date + struct.pack("<BBB", flags, 0, 0) + \
+        _both16(1) + struct.pack("<B", len(ident)) + ident
+    return record.ljust(length, b"\x00")
+
+def _extents(size):
+    """Returns the sizes of the extents of a file."""
+    sizes = []
+    while size > MAX_EXTENT:
+        sizes.append(MAX_EXTENT)
+        size -= MAX_EXTENT
+    return sizes + [size]
+
+class FileSource(object):
+    """A file on disk that is copied into the image while it is written,
+    instead of being read into memory first."""
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+
+    def write_to(self, fp):
+        with open(self.path, "rb") as f:
+            shutil.copyfileobj(f, fp, COPY_CHUNK)
+
+def _iso_name(name, is_dir, taken):
+    """Returns a unique ISO9660 level 1 (8.3, uppercase) identifier."""
+    base, dot, ext = name.upper().rpartition(".")
+    if is_dir or not dot:
+        base, ext = name.upper(), ""
+    base = re.sub("[^A-Z0-9_]", "_", base) or "_"
+    ext = re.sub("[^A-Z0-9_]", "_", ext)[:3]
+
+    candidate, count = base[:8], 0
+    while True:
+        ident = candidate if is_dir else f"{candidate}.{ext};1"
+        if ident not in taken:
+            taken.add(ident)
+            return ident.encode()
+        count += 1
+        suffix = f"~{count}"
+        candidate = base[:8 - len(suffix)] + suffix
+
+class _Entry(object):
+    def __init__(self, name, parent=None, data=None, is_dir=True):
+        self.name = name
+        self.parent = parent
+        self.data = data
+        self.children = {} if is_dir else None
+        self.extent = 0
+        # Per tree: the identifier, directory extent, size, and path table
+        # number of directories.
+        self.ident = {}
+        self.dir_extent = {}
+        self.dir_size = {}
+        self.number = {}
+
+    @property
+    def is_dir(self):
+        return self.children is not None
+
+    @property
+    def size(self):
+        if isinstance(self.data, bytes):
+            return len(self.data)
+        return self.data.size
+
+    def write_to(self, fp):
+        if isinstance(self.data, bytes):
+            fp.write(self.data)
+        else:
+            self.data.write_to(fp)
+
+class ISOWriter(object):
+    """Writes an ISO9660 image with Joliet extensions. Used for the
+    per-image config medium, which holds only a few small files, so no
+    temporary directory or genisoimage run is needed, and to build the
+    installer ISO from the files of another ISO image. Files are bytes, or
+    objects with a size and a write_to(fp) method that are read while the
+    image is written. If boot is given, that file is made the El Torito
+    no emulation boot image."""
+
+    def __init__(self, volume_id="CDROM", timestamp=None, boot=None):
+        self.volume_id = volume_id
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.boot = boot
+        self.root = _Entry("")
+
+    def _parent(self, parts, path):
+        parent = self.root
+        for part in parts:
+            child = parent.children.get(part.lower())
+            if child is None:
+                child = parent.children[part.lower()] = _Entry(part, parent)
+            elif not child.is_dir:
+                raise ValueError(f"{part} of {path} is a file")
+            parent = child
+        return parent
+
+    def add_directory(self, path):
+        """Add a directory, also if it is empty."""
+        self._parent([p for p in path.replace("\\", "/").split("/") if p],
+                     path)
+
+    def add_file(self, path, data):
+        """Add a file with the given contents. Directories in the path are
+        created as needed."""
+        parts = [p for p in path.replace("\\", "/").split("/") if p]
+        parent = self._parent(parts[:-1], path)
+        if parts[-1].lower() in parent.children:
+            raise ValueError(f"{path} was already added")
+        parent.children[parts[-1].lower()] = _Entry(
+            parts[-1], parent, data, is_dir=False
+        )
+
+    def _find(self, path):
+        entry = self.root
+        for part in path.replace("\\", "/").split("/"):
+            if part:
+                entry = (entry.children or {}).get(part.lower())
+                if entry is None:
+                    return None
+        return entry
+
+    def _assign_names(self):
+        for entry in self._walk(self.root):
+            if not entry.is_dir:
+                continue
+            taken = set()
+            for child in sorted(entry.children.values(), key=lambda e: e.name):
+                child.ident["iso"] = _iso_name(child.name, child.is_dir, taken)
+                child.ident["joliet"] = \
+                    child.name[:JOLIET_MAX_NAME].encode("utf-16-be")
+
+    def _walk(self, entry):
+        yield entry
+        if entry.is_dir:
+            for child in entry.children.values():
+                yield from self._walk(child)
+
+    def _directories(self, tree):
+        """Directories in path table order: by level, then by parent, then
+        by identifier."""
+        ordered = [self.root]
+        for entry in ordered:
+            ordered.extend(sorted(
+                (c for c in entry.children.values() if c.is_dir),
+                key=lambda c: c.ident[tree]
+            ))
+        for number, entry in enumerate(ordered, 1):
+            entry.number[tree] = number
+        return ordered
+
+    def _records(self, entry, tree):
+        """Returns the directory records of a directory as (entry,
+        identifier, extent, size, flags) tuples. The extent of files is
+        relative to the first extent of the file."""
+        parent = entry.parent or entry
+        records = [
+            (entry, b"\x00", 0, 0, 2), (parent, b"\x01", 0, 0, 2),
+        ]
+        for child in sorted(entry.children.values(),
+                            key=lambda c: c.ident[tree]):
+            ident = child.ident[tree]
+            if child.is_dir:
+                records.append((child, ident, 0, 0, 2))
+                continue
+
+            sizes = _extents(child.size)
+            for index, size in enumerate(sizes):
+                flags = 0x80 if index < len(sizes) - 1 else 0
+                records.append((
+                    child, ident, index * MAX_EXTENT // SECTOR_SIZE, size,
+                    flags
+                ))
+        return records
+
+    def _dir_size(self, entry, tree):
+        offset = 0
+        for _, ident, _, _, _ in self._records(entry, tree):
+            length = _record_length(ident)
+            if offset % SECTOR_SIZE + length > SECTOR_SIZE:
+                offset += SECTOR_SIZE - offset % SECTOR_SIZE
+            offset += length
+        return _sectors(offset) * SECTOR_SIZE
+
+    def _path_table(self, directories, tree, big_endian):
+        fmt = ">IH" if big_endian else "<IH"
+        table = b""
+        for entry in directories:
+            ident = entry.ident[tree] if entry is not self.root else b"\x00"
+            parent = entry.parent or entry
+            table += struct.pack("<BB", len(ident), 0)
+            table += struct.pack(fmt, entry.dir_extent[tree],
+                                 parent.number[tree])
+            table += ident + b"\x00" * (len(ident) % 2)
+        return table
+
+    def _directory(self, entry, tree, date):
+        buf = bytearray()
+        records = self._records(entry, tree)
+        for child, ident, extent, size, flags in records:
+            length = _record_length(ident)
+            if len(buf) % SECTOR_SIZE + length > SECTOR_SIZE:
+                buf += b"\x00" * (SECTOR_SIZE - len(buf) % SECTOR_SIZE)
+
+            if child.is_dir:
+                buf += _dir_record(child.dir_extent[tree],
+                                   child.dir_size[tree], flags, ident, date)
+            else:
+                extent = child.extent + extent if size else 0
+                buf += _dir_record(extent, size, flags, ident, date)
+        return bytes(buf.ljust(entry.dir_size[tree], b"\x00"))
+
+    def _boot_record(self, catalog):
+        desc = struct.pack("<B5sB", 0, b"CD001", 1)
+        desc += b"EL TORITO SPECIFICATION".ljust(32, b"\x00")
+        desc += b"\x00" * 32 + struct.pack("<I", catalog)
+        return desc.ljust(SECTOR_SIZE, b"\x00")
+
+    def _boot_catalog(self, boot):
+        validation = bytearray(struct.pack(
+            "<BBH24sHBB", 1, 0, 0, b"", 0, 0x55, 0xaa
+        ))
+        # The 16-bit words of the validation entry add up to zero.
+        checksum = -sum(struct.unpack("<16H", validation)) & 0xffff
+        struct.pack_into("<H", validation, 28, checksum)
+
+        # No emulation, loading all of the boot image in 512 byte sectors.
+        initial = struct.pack(
+            "<BBHBBHI", 0x88, 0, 0, 0, 0, (boot.size + 511) // 512,
+            boot.extent
+        )
+        return bytes(validation + initial).ljust(SECTOR_SIZE, b"\x00")
+
+    def _descriptor(self, joliet, volume_size, path_table_size,
+                    path_tables, root_record):
+        if joliet:
+            def text(value, length):
+                padding = " ".encode("utf-16-be") * length
+                return (value.encode("utf-16-be") + padding)[:length]
+        else:
+            def text(value, length):
+                return value.encode().ljust(length, b" ")[:length]
+
+        date = _volume_date(self.timestamp)
+        desc = struct.pack("<B5sBB", 2 if joliet else 1, b"CD001", 1, 0)
+        desc += text("", 32) + text(self.volume_id, 32) + b"\x00" * 8
+        desc += _both32(volume_size)
+        desc += (JOLIET_ESCAPE if joliet else b"").ljust(32, b"\x00")
+        desc += _both16(1) + _both16(1) + _both16(SECTOR_SIZE)
+        desc += _both32(path_table_size)
+        desc += struct.pack("<II", path_tables[0], 0)
+        desc += struct.pack(">II", path_tables[1], 0)
+        desc += root_record
+        desc += text("", 128) * 2 + text("VMCLOAK", 128) + text("", 128)
+        desc += text("", 37) * 3
+        desc += date + date + b"0" * 16 + b"\x00" + date
+        desc += b"\x01\x00"
+        return desc.ljust(SECTOR_SIZE, b"\x00")
+
+    def write(self, fp):
+        """Write the image to the binary file object fp."""
+        boot = None
+        if self.boot:
+            boot = self._find(self.boot)
+            if boot is None or boot.is_dir:
+                raise ValueError(f"Boot image {self.boot} was not added")
+
+        self._assign_names()
+        trees = {"iso": self._directories("iso"),
+                 "joliet": self._directories("joliet")}
+
+        # Primary, boot record, Joliet, and terminator volume descriptors,
+        # followed by the boot catalog.
+        sector = FIRST_DESCRIPTOR + (5 if boot else 3)
+        tables, tables_size = {}, {}
+        for tree, directories in trees.items():
+            for entry in directories:
+                entry.dir_extent[tree] = 0
+            tables_size[tree] = len(self._path_table(directories, tree, False))
+            tables[tree] = (sector, sector + _sectors(tables_size[tree]))
+            sector += 2 * _sectors(tables_size[tree])
+
+        for tree, directories in trees.items():
+            for entry in directories:
+                entry.dir_size[tree] = self._dir_size(entry, tree)
+                entry.dir_extent[tree] = sector
+                sector += entry.dir_size[tree] // SECTOR_SIZE
+
+        files = [e for e in self._walk(self.root) if not e.is_dir]
+        for entry in files:
+            entry.extent = sector
+            sector += _sectors(entry.size)
+
+        volume_size = sector
+        date = _record_date(self.timestamp)
+
+        fp.write(b"\x00" * SECTOR_SIZE * FIRST_DESCRIPTOR)
+        for tree in ("iso", "joliet"):
+            root_record = _dir_record(
+                self.root.dir_extent[tree], self.root.dir_size[tree], 2,
+                b"\x00", date
+            )
+            fp.write(self._descriptor(
+                tree == "joliet", volume_size, tables_size[tree],
+                tables[tree], root_record
+            ))
+            if boot and tree == "iso":
+                fp.write(self._boot_record(FIRST_DESCRIPTOR + 4))
+        fp.write(struct.pack("<B5sB", 255, b"CD001", 1).ljust(
+            SECTOR_SIZE, b"\x00"
+        ))
+        if boot:
+            fp.write(self._boot_catalog(boot))
+
+        for tree, directories in trees.items():
+            for big_endian in (False, True):
+                table = self._path_table(directories, tree, big_endian)
+                fp.write(table.ljust(
+                    _sectors(len(table)) * SECTOR_SIZE, b"\x00"
+                ))
+
+        for tree, directories in trees.items():
+            for entry in directories:
+                fp.write(self._directory(entry, tree, date))
+
+        for entry in files:
+            entry.write_to(fp)
+            fp.write(b"\x00" * (-entry.size % SECTOR_SIZE))
+
+    def getvalue(self):
+        buf = io.BytesIO()
+        self.write(buf)
+        return buf.getvalue()
+
+def build_iso(files, volume_id="CDROM"):
+    """Returns an ISO image with the given files, a dictionary of paths to
+    bytes, as bytes."""
+    writer = ISOWriter(volume_id)
+    for path, data in files.items():
+        writer.add_file(path, data)
+    return writer.getvalue()
@@ -0,0 +1,264 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from vmcloak.misc import sha1_file
+from vmcloak.repository import layers_path
+
+log = logging.getLogger(__name__)
+
+INDEX_NAME = ".index.json"
+LOCK_NAME = ".index.lock"
+INDEX_VERSION = 1
+
+def _create_overlay(backing, path):
+    """Atomically replace path with a new qcow2 overlay on backing."""
+    fd, tmppath = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path)
+    )
+    os.close(fd)
+    try:
+        subprocess.check_call([
+            "qemu-img", "create", "-q", "-f", "qcow2", "-o",
+            "lazy_refcounts=on,cluster_size=2M", "-b", backing, "-F", "qcow2",
+            tmppath
+        ])
+        os.replace(tmppath, path)
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+def backing_chain(path):
+    """Returns the files path is backed by, nearest first."""
+    out = subprocess.check_output([
+        "qemu-img", "info", "-U", "--backing-chain", "--output=json", path
+    ])
+    return [
+        os.path.abspath(info["filename"]) for info in json.loads(out)[1:]
+    ]
+
+def layer_item(dep, version, settings):
+    """The (dep, version, settings) of one installed dependency, with only
+    the settings that belong to the dependency."""
+    return [dep, version or "", sorted(
+        [k, str(v)] for k, v in settings.items()
+        if k.split(".", 1)[0] == dep
+    )]
+
+class LayerStore(object):
+    """qcow2 layers of images with dependencies installed, see
+    DependencyInstaller. Each layer is an overlay of its parent with the
+    changes of one dependency. The first layer of a chain is the disk of
+    the image the dependencies were installed on. A layer is identified by
+    a hash of that base disk, the OS and the ordered list of (dependency,
+    version, settings) installed on it, so installing the same list on a
+    copy of the same disk can start from the deepest matching layer. The
+    layers are read-only and listed in a JSON index."""
+
+    def __init__(self, path=None):
+        self.path = path or layers_path
+        self.index_path = os.path.join(self.path, INDEX_NAME)
+        self.lock_path = os.path.join(self.path, LOCK_NAME)
+
+    @contextlib.contextmanager
+    def locked(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.lock_path, "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def load(self):
+        try:
+            with open(self.index_path, "r") as fp:
+                index = json.load(fp)
+        except FileNotFoundError:
+            index = {}
+        except ValueError as e:
+            log.warning(f"Ignoring unreadable layer index. {e}")
+            index = {}
+
+        if index.get("version") != INDEX_VERSION:
+            index = {"version": INDEX_VERSION}
+        index.setdefault("layers", {})
+        index.setdefault("disks", {})
+        return index
+
+    def _write(self, index):
+        fd, tmppath = tempfile.mkstemp(dir=self.path, prefix=INDEX_NAME)
+        try:
+            with os.fdopen(fd, "w") as fp:
+                json.dump(index, fp)
+            os.replace(tmppath, self.index_path)
+        except Exception:
+            os.remove(tmppath)
+            raise
+
+    @contextlib.contextmanager
+    def update(self):
+        with self.locked():
+            index = self.load()
+            yield index
+            self._write(index)
+
+    def layer_path(self, key):
+        return os.path.join(self.path, f"{key[:16]}.qcow2")
+
+    def disk_key(self, path):
+        """The sha1 of the disk at path. It is only computed again when the
+        size or mtime of the disk changed."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        signature = [st.st_size, st.st_mtime_ns]
+        cached = self.load()["disks"].get(path)
+        if cached and cached[:2] == signature:
+            return cached[2]
+
+        log.info(f"Hashing {path} to look for matching layers")
+        sha1 = sha1_file(path)
+        with self.update() as index:
+            index["disks"][path] = signature + [sha1]
+        return sha1
+
+    @staticmethod
+    def layer_key(base, osversion, prefix):
+        return hashlib.sha256(json.dumps(
+            {"version": INDEX_VERSION, "base": base, "os": osversion,
+             "prefix": prefix}, sort_keys=True
+        ).encode()).hexdigest()
+
+    def find(self, base, osversion, items):
+        """Returns (depth, key) of the deepest layer for a prefix of items,
+        or (0, None) if there is none."""
+        layers = self.load()["layers"]
+        for depth in range(len(items), 0, -1):
+            key = self.layer_key(base, osversion, items[:depth])
+            if key in layers and os.path.exists(self.layer_path(key)):
+                return depth, key
+        return 0, None
+
+    def _add(self, index, key, disk_path, meta):
+        """Move the disk into the store as layer key."""
+        layer = self.layer_path(key)
+        shutil.move(disk_path, layer)
+        os.chmod(layer, 0o444)
+        meta.update({
+            "size": os.path.getsize(layer), "created": int(time.time()),
+            "last_used": int(time.time()), "pinned": False,
+        })
+        index["layers"][key] = meta
+        return layer
+
+    def adopt(self, base, osversion, disk_path):
+        """Make the disk at disk_path the base layer of its chains. The disk
+        is replaced by an overlay on it. If an identical disk is already a
+        base layer, the disk is replaced by an overlay on that one."""
+        key = self.layer_key(base, osversion, [])
+        with self.update() as index:
+            layer = self.layer_path(key)
+            if key in index["layers"] and os.path.exists(layer):
+                log.info(f"{disk_path} is identical to base layer {key[:16]}")
+                index["layers"][key]["last_used"] = int(time.time())
+            else:
+                layer = self._add(index, key, disk_path, {
+                    "parent": None, "os": osversion, "deps": [],
+                    "base": base, "installed": {},
+                })
+            _create_overlay(layer, disk_path)
+            index["disks"].pop(os.path.abspath(disk_path), None)
+        return key
+
+    def branch(self, key, disk_path):
+        """Replace the disk at disk_path with an overlay on layer key.
+        Returns the information stored with the layer."""
+        with self.update() as index:
+            meta = index["layers"][key]
+            meta["last_used"] = int(time.time())
+            _create_overlay(self.layer_path(key), disk_path)
+            index["disks"].pop(os.path.abspath(disk_path), None)
+        return meta
+
+    def capture(self, parent, base, osversion, items, disk_path,
+                installed=None):
+        """Store the disk at disk_path, an overlay on layer parent, as the
+        layer with items installed. The disk is replaced by an overlay on
+        the new layer. installed are the dependency versions the install
+        chose, they are returned by branch. Returns the key of the layer."""
+        key = self.layer_key(base, osversion, items)
+        with self.update() as index:
+            if key in index["layers"]:
+                # Another install stored the same layer first.
+                _create_overlay(self.layer_path(key), disk_path)
+                return key
+            layer = self._add(index, key, disk_path, {
+                "parent": parent, "os": osversion, "deps": items,
+                "base": base, "installed": installed or {},
+            })
+            _create_overlay(layer, disk_path)
+        log.info(f"Stored layer {key[:16]} ({len(items)} dependencies)")
+        return key
+
+    def resolve(self, prefix):
+        """Returns the key of the one layer that starts with prefix."""
+        keys = [k for k in self.load()["layers"] if k.startswith(prefix)]
+        if len(keys) != 1:
+            raise KeyError(
+                f"{'No' if not keys else 'More than one'} layer {prefix}"
+            )
+        return keys[0]
+
+    def pin(self, key, pinned=True):
+        """Pinned layers are never pruned."""
+        with self.update() as index:
+            index["layers"][key]["pinned"] = pinned
+
+    def prune(self, in_use=(), older_than=None, dry_run=False):
+        """Remove the layers that are not pinned, not used by a disk in
+        in_use and not the parent of a layer that is kept. With older_than,
+        only layers that were not used for that many seconds are removed.
+        Returns the (key, size) of the removed layers."""
+        in_use = set(os.path.abspath(path) for path in in_use)
+        now = int(time.time())
+        removed = []
+        with self.locked():
+            index = self.load()
+            layers = index["layers"]
+            candidates = [
+                key for key, meta in layers.items()
+                if not meta["pinned"]
+                and self.layer_path(key) not in in_use
+                and (older_than is None
+                     or now - meta["last_used"] >= older_than)
+            ]
+            # Remove children before their parents.
+            while True:
+                parents = {meta["parent"] for meta in layers.values()}
+                leaves = [key for key in candidates if key not in parents]
+                if not leaves:
+                    break
+                for key in leaves:
+                    candidates.remove(key)
+                    removed.append((key, layers.pop(key)["size"]))
+
+            if dry_run:
+                return removed
+
+            for key, _ in removed:
+                path = self.layer_path(key)
+                if os.path.exists(path):
+                    os.remove(path)
+            self._write(index)
+        return removed
@@ -4,29 +4,46 @@
 # See the file 'docs/LICENSE.txt' for copying permission.
 
 import click
+import json
 import logging
 import os.path
 import shutil
 import subprocess
 import tempfile
+import threading
 import time
+from ipaddress import ip_address
 
 from sqlalchemy.orm.session import make_transient
 
 from vmcloak import repository
+import vmcloak.bench
 import vmcloak.dependencies
 
 from vmcloak.agent import Agent
+from vmcloak.batch import (
+    BatchJob, Scheduler, host_capacity, load_specs, status_table
+)
 from vmcloak.constants import VMCLOAK_ROOT
-from vmcloak.dependencies import Python, ThreemonPatch, Finalize
-from vmcloak.install import DependencyInstaller, InstallError, find_recipe
+from vmcloak.dependencies import Python, ThreemonPatch, Finalize, Cleanup
+from vmcloak.depserver import DepServer
+from vmcloak.depbundle import read_bundle, write_bundle
+from vmcloak.depcache import DepCache
+from vmcloak.exceptions import BatchError, BundleError, ISOError
+from vmcloak.install import (
+    DependencyInstaller, InstallError, find_recipe, parse_dependencies_list,
+    resolve_dependencies, plan_downloads, prefetch_downloads, _recipes
+)
+from vmcloak.isocache import StaticISOCache
+from vmcloak.isoreader import ISOImage
+from vmcloak.layers import LayerStore, backing_chain
 from vmcloak.misc import (
     wait_for_agent, drop_privileges, download_file, filename_from_url
 )
 from vmcloak.rand import random_string
 from vmcloak.repository import (
     image_path, Session, Image, Snapshot, iso_dst_path, db_migratable,
-    SCHEMA_VERSION, IPNet, conf_path
+    SCHEMA_VERSION, IPNet, conf_path, vms_path
 )
 from vmcloak.ostype import get_os
 
@@ -34,14 +51,20 @@ logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s: %(message)s")
 log = logging.getLogger("vmcloak")
 log.setLevel(logging.INFO)
 
+# Images built in parallel by init-batch share the downloaded files.
+_download_lock = threading.Lock()
+
 @click.group(invoke_without_command=True)
 @click.option("-u", "--user", help="Drop privileges to user.")
 @click.option("-q", "--quiet", help="Only show log warnings or higher")
 @click.option("-d", "--debug", is_flag=True, help="Enable debugging.")
+@click.option("--mirror", envvar="VMCLOAK_MIRROR", help="URL of a 'vmcloak deps serve' mirror to download dependencies from first. Also read from VMCLOAK_MIRROR.")
 @click.pass_context
-def main(ctx, user, quiet, debug):
+def main(ctx, user, quiet, debug, mirror):
     ctx.meta["debug"] = debug
     user and drop_privileges(user)
+    if mirror:
+        vmcloak.dependencies.Dependency.mirror = mirror.rstrip("/")
     if quiet:
         log.setLevel(logging.WARNING)
     if debug:
@@ -116,9 +139,11 @@ _iso_attributes = [
     # click.option("--win10x86", is_flag=True, help="This is a Windows 10 32-bit instance."),  # Comment all non-x64 OS for now until we test them with new VMCloak.
     click.option("--win10x64", is_flag=True, help="This is a Windows 10 64-bit instance."),
     click.option("--iso-mount", help="Mounted ISO Windows installer image."),
+    click.option("--iso-file", help="Windows installer ISO image to read directly, without mounting it."),
     click.option("--serial-key", help="Windows Serial Key."),
     click.option("--product", help="Windows 7 product version."),
     click.option("--python-version", help="Python version to install on VM."),
+    click.option("--copy-iso", is_flag=True, help="Copy all files of the mounted ISO to a temporary directory instead of only the changed files."),
 ]
 
 def _add_install_attr(func):
@@ -192,7 +217,10 @@ def createiso(ctx, iso_path, **attr):
 
     _create_iso(iso_path, attr)
 
-def _create_iso(iso_path, attr):
+def _prepare_iso(attr):
+    """Check the settings and gather what is needed to build the installer
+    ISO. Returns the OS handler, the mount, a temporary directory with the
+    additional bootstrap files, and the values for settings.bat."""
     try:
         if not _ip_in_network(attr["ip"], attr["gateway"], attr["netmask"]):
             log.error(
@@ -210,9 +238,17 @@ def _create_iso(iso_path, attr):
 
     if not h.set_serial_key(attr["serial_key"]):
         exit(1)
-    mount = h.pickmount(attr["iso_mount"])
+    if attr["iso_file"]:
+        try:
+            mount = ISOImage(attr["iso_file"])
+        except (OSError, ISOError) as e:
+            log.error(f"Cannot read {attr['iso_file']}: {e}")
+            exit(1)
+    else:
+        mount = h.pickmount(attr["iso_mount"])
     if not mount:
-        log.error("Please specify --iso-mount to a directory containing the "
+        log.error("Please specify --iso-file to the Windows Installer ISO "
+                  "image or --iso-mount to a directory containing the "
                   "mounted Windows Installer ISO image.")
         log.info("Refer to the documentation on mounting an .iso image.")
         exit(1)
@@ -223,7 +259,8 @@ def _create_iso(iso_path, attr):
 
     # Download the Python dependency and set it up for bootstrapping the VM.
     d = Python(h=h, i=Image(osversion=attr["osversion"]), version=attr.get("python_version"))
-    d.download()
+    with _download_lock:
+        d.download()
     shutil.copy(d.filepath, vmcloak_dir)
 
     # Prepare settings
@@ -246,17 +283,52 @@ def _create_iso(iso_path, attr):
         PYTHONWINDOW=d.exe["window_name"],
         PYTHONPATH=d.exe["install_path"]
     )
+    return h, mount, bootstrap, env_vars
+
+def _create_iso(iso_path, attr):
+    h, mount, bootstrap, env_vars = _prepare_iso(attr)
 
     # Now try building the ISO
     try:
         if not h.buildiso(mount, iso_path, bootstrap, h.tempdir,
-                          env_vars=env_vars):
+                          env_vars=env_vars, graft=not attr["copy_iso"]):
             exit(1)
     finally:
         shutil.rmtree(bootstrap)
+        _close_mount(mount)
 
     log.info("Created ISO: %s", iso_path)
 
+def _create_split_iso(name, attr):
+    """Get the installer ISO that is the same for all images from the cache,
+    building it if needed, and create the small ISO with the values of
+    this image. Returns the paths of both."""
+    h, mount, bootstrap, env_vars = _prepare_iso(attr)
+    try:
+        try:
+            cached = StaticISOCache().get(
+                h, mount, bootstrap, h.tempdir, graft=not attr["copy_iso"]
+            )
+        finally:
+            shutil.rmtree(bootstrap)
+
+        if not cached:
+            exit(1)
+
+        static_iso, meta = cached
+        config_iso = os.path.join(attr["tempdir"], f"{name}-config.iso")
+        if not h.buildconfig(mount, config_iso, meta["agent"], h.tempdir,
+                             env_vars=env_vars):
+            exit(1)
+    finally:
+        _close_mount(mount)
+
+    return static_iso, config_iso
+
+def _close_mount(mount):
+    if isinstance(mount, ISOImage):
+        mount.close()
+
 def _get_network(platform, attrs):
     network_str = attrs["network"]
     bridge_ip = attrs["gateway"]
@@ -311,7 +383,12 @@ def _get_ip(ipnet, attr):
 @click.argument("adapter")
 @_add_install_attr
 @click.option("--iso", help="Specify install ISO to use.")
+@click.option("--single-iso", is_flag=True, help="Build an installer ISO for this image only instead of using the cached installer ISO, so the agent on it gets a name of its own.")
 @click.option("--vm", default="qemu", help="Virtual Machinery.", show_default=True)
+@click.option("--stall-timeout", default=10, help="Stop the installation when the disk is not written to and no progress is reported for this many minutes.", show_default=True)
+@click.option("--install-timeout", type=int, help="Stop the installation when it takes longer than this many minutes.")
+@click.option("--fast-build", is_flag=True, help="Use the host cache and ignore disk flushes during the installation. A host crash can corrupt the image.")
+@click.option("--build-overlay", help="Directory, such as a tmpfs, for an overlay that takes all disk writes during the installation. It is committed to the image when the VM shuts down cleanly.")
 @click.pass_context
 def init(ctx, name, adapter, iso, vm, **attr):
     """Create a new image with 'name' attached to network (bridge)
@@ -345,14 +422,31 @@ def init(ctx, name, adapter, iso, vm, **attr):
     attr["netmask"] = ipnet.netmask
     attr["ip"] = ip
 
+    image = _build_image(name, vm, p, attr, iso=iso)
+    if not image:
+        return
+
+    log.info("Added image %r to the repository.", name)
+    session.add(image)
+    session.commit()
+
+def _build_image(name, vm, p, attr, iso=None, job=None):
+    """Build the installer ISO unless one is given and install a new image
+    from it. Returns the Image to add to the repository, or None if the
+    installation failed."""
     h = os_from_attr(attr)
-    if not iso:
+    remove_iso = False
+    if iso:
+        iso_path = iso
+    elif attr["single_iso"] or not h.config_medium:
         iso_path = os.path.join(attr["tempdir"], "%s.iso" % name)
         _create_iso(iso_path, attr)
         remove_iso = True
     else:
-        iso_path = iso
-        remove_iso = False
+        iso_path, attr["config_iso"] = _create_split_iso(name, attr)
+
+    if job:
+        job.set_state("install")
 
     try:
         attr["path"] = os.path.join(image_path, "%s.%s" % (name, p.disk_format))
@@ -361,35 +455,174 @@ def init(ctx, name, adapter, iso, vm, **attr):
         p.create_new_image(name, os, iso_path, attr)
     except:
         log.exception("Failed to create %r:", name)
-        return
+        return None
     finally:
         p.remove_vm_data(name)
         if remove_iso:
             os.remove(iso_path)
+        if attr.get("config_iso"):
+            os.remove(attr["config_iso"])
+
+    return Image(name=name,
+                 path=attr["path"],
+                 osversion=attr["osversion"],
+                 servicepack="%s" % h.service_pack,
+                 mode="normal",
+                 ipaddr=attr["ip"],
+                 port=attr["port"],
+                 adapter=attr["adapter"],
+                 netmask=attr["netmask"],
+                 gateway=attr["gateway"],
+                 cpus=attr["cpus"],
+                 ramsize=attr["ramsize"],
+                 vramsize=attr["vramsize"],
+                 vm="%s" % vm,
+                 # paravirtprovider=attr["paravirtprovider"],
+                 mac=attr["mac"])
+
+def _allocate_batch_ips(p, attrs):
+    """Give all images of a batch an IP. The free IPs of a network are
+    taken in one pass, so the images never get the same IP."""
+    networks = {}
+    for attr in attrs:
+        key = (attr["network"], attr["gateway"], attr["adapter"])
+        networks.setdefault(key, []).append(attr)
+
+    for group in networks.values():
+        ipnet = _get_network(p, group[0])
+        gateway, netmask = ipnet.bridge_ip, ipnet.netmask
+        try:
+            ipnet.reserve_ip(gateway)
+        except (ValueError, KeyError):
+            pass
+
+        for attr in group:
+            if not attr["ip"]:
+                continue
+            try:
+                ipnet.reserve_ip(attr["ip"])
+            except (ValueError, KeyError) as e:
+                log.error(f"Cannot use IP '{attr['ip']}'. {e}")
+                exit(1)
 
-    log.info("Added image %r to the repository.", name)
-    session.add(Image(name=name,
-                      path=attr["path"],
-                      osversion=attr["osversion"],
-                      servicepack="%s" % h.service_pack,
-                      mode="normal",
-                      ipaddr=attr["ip"],
-                      port=attr["port"],
-                      adapter=attr["adapter"],
-                      netmask=attr["netmask"],
-                      gateway=attr["gateway"],
-                      cpus=attr["cpus"],
-                      ramsize=attr["ramsize"],
-                      vramsize=attr["vramsize"],
-                      vm="%s" % vm,
-                      # paravirtprovider=attr["paravirtprovider"],
-                      mac=attr["mac"]))
-    session.commit()
+        unassigned = [attr for attr in group if not attr["ip"]]
+        try:
+            ips = ipnet.get_ips(count=len(unassigned)) if unassigned else []
+        except (ValueError, KeyError) as e:
+            log.error(f"Failed to get IPs in network: {ipnet}. {e}")
+            exit(1)
+
+        for attr, ip in zip(unassigned, sorted(ips, key=ip_address)):
+            attr["ip"] = ip
+        for attr in group:
+            attr["gateway"] = gateway
+            attr["netmask"] = netmask
+
+def _init_defaults():
+    """The values init gets for the options that are not given. An empty
+    command line is parsed, as newer click versions do not put these in
+    param.default."""
+    defaults = init.make_context("init", [], resilient_parsing=True).params
+    for name in ("name", "vm"):
+        defaults.pop(name)
+    return defaults
+
+@main.command("init-batch")
+@click.argument("specfile")
+@click.option("--vm", default="qemu", help="Virtual Machinery.", show_default=True)
+@click.option("--max-ram", type=int, help="Memory in MB the images may use together. Host memory minus 2 GB if not given.")
+@click.option("--max-cpus", type=int, help="CPUs the images may use together. Host cores if not given.")
+@click.option("--max-parallel", type=int, help="Maximum amount of images to create at once.")
+@click.pass_context
+def init_batch(ctx, specfile, vm, max_ram, max_cpus, max_parallel):
+    """Create the images of a YAML or JSON file of image specs in
+    parallel. Each spec has a name, an os (such as win10x64) and any of
+    the 'init' options, such as adapter, network, cpus and ramsize."""
+    if vm.lower() != "qemu":
+        log.error("VMCloak temporarily only supports QEMU vm creation.")
+        exit(1)
+
+    try:
+        p = repository.platform(vm)
+    except ImportError:
+        log.error("Platform %r is not supported at this point.", vm)
+        exit(1)
+
+    defaults = _init_defaults()
+    try:
+        specs = load_specs(specfile, known=defaults)
+    except BatchError as e:
+        log.error(e)
+        exit(1)
+
+    session = Session()
+    jobs = []
+    for spec in specs:
+        name = spec.pop("name")
+        if session.query(Image).filter_by(name=name).first():
+            log.error("Image already exists: %s", name)
+            exit(1)
+
+        attr = dict(defaults)
+        attr[spec.pop("os")] = True
+        attr.update(spec)
+        attr["debug"] = ctx.meta["debug"]
+        if attr["vrde"] or attr["debug"]:
+            attr["vrde"] = attr["vrde_port"]
+        os_from_attr(attr)
+        jobs.append(BatchJob(name, attr))
+    session.close()
+
+    _allocate_batch_ips(p, [job.attr for job in jobs])
+
+    host_ram, host_cpus = host_capacity()
+    scheduler = Scheduler(
+        max_ram or host_ram, max_cpus or host_cpus, max_jobs=max_parallel
+    )
+    log.info(
+        f"Creating {len(jobs)} images using at most {scheduler.max_ram} MB "
+        f"of memory and {scheduler.max_cpus} CPUs"
+    )
+
+    db_lock = threading.Lock()
+    def build(job):
+        image = _build_image(
+            job.name, vm, p, job.attr, iso=job.attr["iso"], job=job
+        )
+        if not image:
+            raise BatchError("installation failed")
+
+        with db_lock:
+            s = Session()
+            try:
+                s.add(image)
+                s.commit()
+            finally:
+                s.close()
+        log.info("Added image %r to the repository.", job.name)
+
+    def show(jobs):
+        click.echo(status_table(jobs) + "\n")
+
+    try:
+        scheduler.run(jobs, build, on_change=show)
+    except KeyboardInterrupt:
+        for job in jobs:
+            if job.state in ("iso", "install"):
+                p.remove_vm_data(job.name)
+        exit(1)
+
+    done = [job for job in jobs if job.state == "done"]
+    log.info(f"Created {len(done)} of {len(jobs)} images")
+    if len(done) != len(jobs):
+        exit(1)
 
 def _do_install(image, dependencies, attrs={}, skip_installed=True,
-                no_machine_start=False):
+                no_machine_start=False, layers=None):
     try:
-        installer = DependencyInstaller(image, dependencies, attrs)
+        installer = DependencyInstaller(
+            image, dependencies, attrs, layers=layers
+        )
     except InstallError as e:
         log.error(f"Install failed: {e}")
         return False
@@ -426,12 +659,19 @@ def _do_install(image, dependencies, attrs={}, skip_installed=True,
 @click.option("--no-machine-start", is_flag=True, help="Do not try to start the machine. Assume it is somehow already started and reachable.")
 @click.option("-r", "--recommended", is_flag=True, help="Install and perform recommended software and configuration changes for the OS.")
 @click.option("-d", "--debug", is_flag=True, help="Install applications in debug mode.")
+@click.option("--fast-build", is_flag=True, help="Use the host cache and ignore disk flushes while installing. A host crash can corrupt the image.")
+@click.option("--build-overlay", help="Directory, such as a tmpfs, for an overlay that takes all disk writes while installing. It is committed to the image when the VM shuts down cleanly.")
+@click.option("--layers", "use_layers", is_flag=True, help="Store a layer of the disk after each dependency and start from the deepest stored layer that has the first dependencies installed.")
 @click.pass_context
 def install(ctx, name, dependencies, vm_visible, vrde, vrde_port,
-            force_reinstall, no_machine_start, recommended, debug):
+            force_reinstall, no_machine_start, recommended, debug, fast_build,
+            build_overlay, use_layers):
     """Install dependencies on an image. Dependency settings are specified
     using name.setting=value. Multiple settings per dependency can be given."""
-    user_attr = {"vm_visible": vm_visible}
+    user_attr = {
+        "vm_visible": vm_visible, "fast_build": fast_build,
+        "build_overlay": build_overlay,
+    }
     if vrde or ctx.meta["debug"]:
         user_attr["vrde"] = vrde_port
 
@@ -478,12 +718,76 @@ def install(ctx, name, dependencies, vm_visible, vrde, vrde_port,
         log.error("No dependencies given to install")
         exit(1)
 
+    layers = None
+    if use_layers:
+        if no_machine_start:
+            log.error("Layers cannot be used with --no-machine-start")
+            exit(1)
+        layers = LayerStore()
+
     if not _do_install(image, dependencies, user_attr,
                        skip_installed=not force_reinstall,
-                       no_machine_start=no_machine_start):
+                       no_machine_start=no_machine_start, layers=layers):
         exit(1)
 
 
+@main.command()
+@click.argument("name")
+@click.option("--compress", is_flag=True, help="Compress the disk. It gets smaller, but reading from it costs more CPU time.")
+@click.option("--skip-cleanup", is_flag=True, help="Do not start the VM to remove temporary files and zero the free space first.")
+@click.option("--vrde", is_flag=True, help="Enable the remote display (RDP or VNC).")
+@click.option("--vrde-port", default=3389, help="Specify the remote display port.")
+@click.pass_context
+def compact(ctx, name, compress, skip_cleanup, vrde, vrde_port):
+    """Remove temporary files, superseded Windows components and unused
+    space from image NAME and rewrite its disk to a smaller file."""
+    image = repository.find_image(name)
+    if not image:
+        log.error("Image not found: %s", name)
+        exit(1)
+
+    if image.vm and image.vm.lower() != "qemu":
+        log.error(f"Only QEMU images can be compacted, not {image.vm} images")
+        exit(1)
+
+    if image.mode != "normal":
+        log.error(
+            "Image is already in use for snapshots. You can no longer "
+            "modify it."
+        )
+        exit(1)
+
+    if not skip_cleanup:
+        user_attr = {"compact": True}
+        if vrde or ctx.meta["debug"]:
+            user_attr["vrde"] = vrde_port
+        if not _do_install(image, [Cleanup.name], user_attr,
+                           skip_installed=False):
+            log.error("Cleanup in the VM failed, not compacting the image")
+            exit(1)
+
+    try:
+        before, after = image.platform.compact_disk(
+            image.path, compress=compress
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.error(f"Failed to compact {image.path}: {e}")
+        exit(1)
+
+    session = Session()
+    try:
+        image = session.query(Image).filter_by(name=name).first()
+        image.precompact_size = before
+        image.compact_size = after
+        session.commit()
+    finally:
+        session.close()
+
+    log.info(
+        f"Compacted {name} from {before / 1024**3:.2f} GB to "
+        f"{after / 1024**3:.2f} GB"
+    )
+
 @main.command()
 @click.argument("name")
 @click.option("--vm-visible", is_flag=True)
@@ -580,6 +884,8 @@ def _snapshot(image, vmname, attr, interactive):
     h = get_os(image.osversion)
     a.static_ip(attr["ip"], attr["netmask"], attr["gateway"], h.interface)
 
+    a.close()
+
     log.debug("Creating snapshot")
     p.create_snapshot(vmname)
     p.create_machineinfo_dump(vmname, image)
@@ -693,10 +999,13 @@ def cleanup(name, vm):
 @click.option("--interactive", is_flag=True, help="Enable interactive snapshot mode.")
 @click.option("--com1", is_flag=True, help="Enable COM1 for this VM.")
 @click.option("--nopatch", is_flag=True, help="Do not patch the image to be able to load threemon")
+@click.option("--snapshot-codec", type=click.Choice(["zstd", "lz4", "gzip", "none"]), help="Compressor of the memory snapshot. Defaults to lz4, gzip or none, whichever is installed first.")
+@click.option("--snapshot-level", type=int, help="Compression level of the memory snapshot.")
+@click.option("--snapshot-format", type=click.Choice(["stream", "mapped-ram"]), default="stream", show_default=True, help="Format of the memory snapshot. mapped-ram snapshots can be restored faster, but are not compressed. Needs QEMU 9.0.")
 @click.pass_context
 def snapshot(ctx, name, vmname, ip, resolution, ramsize, cpus, hostname,
              vm_visible, count, vrde, vrde_port, interactive,
-             com1, nopatch):
+             com1, nopatch, snapshot_codec, snapshot_level, snapshot_format):
     """Create one or more snapshots from an image"""
     if count and hostname:
         log.error(
@@ -735,9 +1044,19 @@ def snapshot(ctx, name, vmname, ip, resolution, ramsize, cpus, hostname,
         log.error(f"Image IP network error: {e}")
         exit(1)
 
+    try:
+        image.platform.check_snapshot_format(snapshot_format, snapshot_codec)
+        image.platform.find_snapshot_codec(snapshot_codec, snapshot_level)
+    except ValueError as e:
+        log.error(e)
+        exit(1)
+
     attr = image.attr()
     if vrde or ctx.meta["debug"]:
         attr["vrde"] = vrde_port
+    _if_defined(attr, "snapshot_codec", snapshot_codec)
+    _if_defined(attr, "snapshot_level", snapshot_level)
+    attr["snapshot_format"] = snapshot_format
 
     # Perform final changes such patching for kernel monitor and
     # disabling services that were still needed during the image
@@ -936,6 +1255,10 @@ def list_images():
     for img in repository.list_images():
         print("*", img.name, "|", img.platform.name,"|",
               img.ipaddr, "|","Adapter:", img.adapter)
+        if img.compact_size:
+            print("\t", "Compacted from",
+                  f"{img.precompact_size / 1024**3:.2f} GB to",
+                  f"{img.compact_size / 1024**3:.2f} GB")
         installed = img.installed
         if not installed:
             continue
@@ -982,3 +1305,359 @@ def list_dependencies(name_only=False):
 @click.option("--name-only", is_flag=True, help="Only list the names of existing dependencies")
 def _list_deps(name_only):
     list_dependencies(name_only)
+
+@main.group()
+def bench():
+    """Measure the performance of VMCloak operations."""
+
+@bench.command("agent")
+@click.argument("ip", required=False)
+@click.argument("port", required=False, default=8000)
+@click.option("-n", "--count", default=1000, help="Amount of requests to send.", show_default=True)
+@click.option("-c", "--concurrency", default=1, help="Amount of concurrent requests.", show_default=True)
+def bench_agent(ip, port, count, concurrency):
+    """Measure how many requests per second one Agent can take. A local
+    stand-in Agent is used if no IP is given."""
+    if ip:
+        results = vmcloak.bench.bench_agent(ip, port, count, concurrency)
+    else:
+        with vmcloak.bench.StandInAgent() as server:
+            results = vmcloak.bench.bench_agent(
+                server.ipaddr, server.port, count, concurrency
+            )
+
+    for mode in ("pooled", "unpooled"):
+        print(
+            f"{mode}: {results[mode]['rps']:.1f} requests/s "
+            f"({count} requests in {results[mode]['seconds']:.2f}s)"
+        )
+
+@bench.command("install")
+@click.argument("name")
+@click.argument("dependencies", nargs=-1, required=True)
+@click.option("--build-overlay", help="Also measure with a build overlay in this directory, such as a tmpfs.")
+def bench_install(name, dependencies, build_overlay):
+    """Compare how long installing dependencies on image NAME takes with
+    the default disk settings and with --fast-build. The dependencies are
+    installed on throw-away overlays, the image is not changed."""
+    image = repository.find_image(name)
+    if not image:
+        log.error("Image not found: %s", name)
+        exit(1)
+    if image.vm and image.vm.lower() != "qemu":
+        log.error("Install benchmarks are only supported for QEMU images")
+        exit(1)
+
+    profiles = [("default", {}), ("fast-build", {"fast_build": True})]
+    if build_overlay:
+        profiles.append(("fast-build-overlay", {
+            "fast_build": True, "build_overlay": build_overlay
+        }))
+
+    try:
+        results = vmcloak.bench.bench_install(
+            image, list(dependencies), profiles
+        )
+    except InstallError as e:
+        log.error(f"Cannot install dependencies: {e}")
+        exit(1)
+
+    default = results["default"]["seconds"]
+    for profile, result in results.items():
+        print(
+            f"{profile}: {result['seconds']:.1f}s "
+            f"({default / result['seconds']:.2f}x)"
+            f"{'' if result['success'] else ' (install failed)'}"
+        )
+
+@bench.command("restore")
+@click.argument("snapshot")
+@click.option("-n", "--count", default=20, help="Amount of restores.", show_default=True)
+@click.option("--qemu", default="qemu-system-x86_64", help="QEMU binary to restore with.", show_default=True)
+@click.option("--agent-timeout", default=60, help="Seconds to wait for the Agent after each restore.", show_default=True)
+@click.option("-o", "--output", help="Write the results as JSON to this file, - for stdout.")
+def bench_restore(snapshot, count, qemu, agent_timeout, output):
+    """Measure how long restoring SNAPSHOT takes until its Agent answers.
+    SNAPSHOT is a snapshot name or the directory with its machineinfo.json.
+    The snapshot is not changed."""
+    vm_dir = snapshot
+    if not os.path.isdir(vm_dir):
+        vm_dir = os.path.join(vms_path, "qemu", snapshot)
+
+    try:
+        results = vmcloak.bench.bench_restore(
+            vm_dir, count, qemu, agent_timeout
+        )
+    except ValueError as e:
+        log.error(f"Cannot restore {snapshot}: {e}")
+        exit(1)
+
+    if output == "-":
+        print(json.dumps(results, indent=2))
+    elif output:
+        with open(output, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+    if output != "-":
+        print(
+            f"{results['snapshot']}: {len(results['runs'])} restores, "
+            f"{results['failed']} failed ({results['format']}, "
+            f"{results['codec']})"
+        )
+        for phase in vmcloak.bench.RESTORE_PHASES:
+            stats = results["summary"][phase]
+            if stats:
+                print(f"{phase:>8}: " + " ".join(
+                    f"{k} {stats[k]:.3f}s"
+                    for k in ("min", "p50", "p90", "p99", "max")
+                ))
+
+    if results["failed"]:
+        exit(1)
+
+@main.group()
+def deps():
+    """Manage the dependency download cache."""
+
+def _known_sha1s():
+    known = {}
+    for d in vmcloak.dependencies.names.values():
+        for entry in d.exes + d.files:
+            urls = entry.get("urls") or [entry.get("url")]
+            filename = entry.get("filename") or filename_from_url(urls[0])
+            if filename and entry.get("sha1"):
+                known.setdefault(filename, set()).add(entry["sha1"])
+    return known
+
+@deps.command("verify")
+@click.option("--full", is_flag=True, help="Hash all files again, even if they look unchanged.")
+def deps_verify(full):
+    """Update the hash index of the dependency cache and check the files
+    against the hashes the dependencies expect."""
+    known = _known_sha1s()
+    failed = False
+    for name, status, entry in DepCache().verify(full=full):
+        if status == "corrupt":
+            log.error(f"{name}: contents changed without being modified")
+            failed = True
+        elif name in known and entry["sha1"] not in known[name]:
+            log.error(
+                f"{name}: sha1 {entry['sha1']} does not match any known "
+                f"hash for this file"
+            )
+            failed = True
+
+        print(name, status, entry["size"], entry["sha1"])
+
+    if failed:
+        exit(1)
+
+@deps.command("serve")
+@click.option("--host", default="0.0.0.0", help="Address to listen on.", show_default=True)
+@click.option("--port", default=8080, help="Port to listen on.", show_default=True)
+def deps_serve(host, port):
+    """Serve the dependency cache over HTTP so other hosts can use it with
+    --mirror. Files are served as /sha1/<sha1>."""
+    server = DepServer((host, port))
+    log.info(
+        f"Serving {server.file_count} files of the dependency cache on "
+        f"{server.url}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+@deps.command("bundle")
+@click.argument("dependencies", nargs=-1)
+@click.option("--recipe", help="Include the recommended dependencies of this OS version.")
+@click.option("--osversion", help="OS version to bundle DEPENDENCIES for. Defaults to the recipe.")
+@click.option("-o", "--output", required=True, help="Bundle file to write, - for stdout.")
+def deps_bundle(dependencies, recipe, osversion, output):
+    """Write all files needed to install a recipe and/or the given
+    dependencies, including their own dependencies, to one tar file that
+    'vmcloak deps import' can read on a host without internet access."""
+    osversion = osversion or recipe
+    if not osversion:
+        log.error("Specify a recipe or an OS version with --osversion")
+        exit(1)
+
+    dependencies = list(dependencies)
+    try:
+        if recipe:
+            dependencies = find_recipe(recipe) + dependencies
+        deps_versions, _ = parse_dependencies_list(dependencies)
+        deps_versions = resolve_dependencies(osversion, deps_versions)
+    except (InstallError, KeyError) as e:
+        log.error(f"Cannot bundle dependencies: {e}")
+        exit(1)
+
+    downloadables = plan_downloads(
+        osversion, deps_versions, include_latest=True
+    )
+    summary = prefetch_downloads(downloadables)
+    if summary["failed"]:
+        log.error("Not all files could be downloaded, not writing a bundle")
+        exit(1)
+
+    filepaths = [d[0] for d in downloadables]
+    meta = {"osversion": osversion, "dependencies": dependencies}
+    if output == "-":
+        manifest = write_bundle(
+            click.get_binary_stream("stdout"), filepaths, meta=meta
+        )
+    else:
+        with open(output, "wb") as fp:
+            manifest = write_bundle(fp, filepaths, meta=meta)
+
+    size = sum(f["size"] for f in manifest["files"])
+    log.info(
+        f"Bundled {len(filepaths)} files ({size / 1024 / 1024:.1f} MB) for "
+        f"{osversion}"
+    )
+
+@deps.command("import")
+@click.argument("bundle")
+def deps_import(bundle):
+    """Unpack a bundle made with 'vmcloak deps bundle' into the dependency
+    cache. Use - to read it from stdin."""
+    try:
+        if bundle == "-":
+            manifest, written = read_bundle(click.get_binary_stream("stdin"))
+        else:
+            with open(bundle, "rb") as fp:
+                manifest, written = read_bundle(fp)
+    except (BundleError, OSError) as e:
+        log.error(f"Failed to import bundle: {e}")
+        exit(1)
+
+    log.info(
+        f"Imported {len(written)} of {len(manifest['files'])} files, the "
+        f"others were already present"
+    )
+
+def _parse_size(size):
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def _pinned_deps_files():
+    """Names of the files needed by the recipes and the images."""
+    wanted = []
+    for osversion, recipe in _recipes.items():
+        deps_versions, _ = parse_dependencies_list(recipe)
+        wanted.append((osversion, deps_versions))
+
+    for image in repository.list_images():
+        wanted.append((image.osversion, list(image.installed)))
+
+    pinned = set()
+    for osversion, deps_versions in wanted:
+        deps_versions = resolve_dependencies(osversion, [
+            (dep, version) for dep, version in deps_versions
+            if dep in vmcloak.dependencies.names
+        ])
+        for downloadable in plan_downloads(
+                osversion, deps_versions, include_latest=True):
+            pinned.add(os.path.basename(downloadable[0]))
+    return pinned
+
+@deps.command("gc")
+@click.option("--max-size", required=True, help="Maximum size of the dependency cache, such as 50G or 500M.")
+@click.option("--dry-run", is_flag=True, help="Only show what would be removed.")
+def deps_gc(max_size, dry_run):
+    """Remove the least recently used files from the dependency cache until
+    it fits in the given size. Files needed by the recommended recipes or
+    by the dependencies installed on images are never removed."""
+    try:
+        max_size = _parse_size(max_size)
+    except ValueError:
+        log.error(f"Invalid size: {max_size}")
+        exit(1)
+
+    removed, total = DepCache().gc(
+        max_size, pinned=_pinned_deps_files(), dry_run=dry_run
+    )
+    for name, size in removed:
+        print("Would remove" if dry_run else "Removed", name,
+              f"({size / 1024 / 1024:.1f} MB)")
+
+    freed = sum(size for _, size in removed)
+    print(
+        f"{'Would free' if dry_run else 'Freed'} {freed / 1024**3:.2f} GB. "
+        f"Cache size: {total / 1024**3:.2f} GB"
+    )
+    if total > max_size:
+        log.warning(
+            "The cache is still larger than the maximum size, the remaining "
+            "files are needed by recipes or images"
+        )
+
+@main.group()
+def layers():
+    """Manage the layers stored by 'vmcloak install --layers'."""
+
+def _find_layer(store, key):
+    try:
+        return store.resolve(key)
+    except KeyError as e:
+        log.error(e.args[0])
+        exit(1)
+
+@layers.command("list")
+def layers_list():
+    """Show the stored layers and the dependencies installed on them."""
+    store = LayerStore()
+    for key, meta in sorted(store.load()["layers"].items(),
+                            key=lambda item: len(item[1]["deps"])):
+        deps = ", ".join(
+            f"{dep}:{version}" if version else dep
+            for dep, version, _ in meta["deps"]
+        )
+        print(
+            key[:16], meta["parent"][:16] if meta["parent"] else "-" * 16,
+            meta["os"], f"{meta['size'] / 1024**2:.0f}MB",
+            "pinned" if meta["pinned"] else "-", deps or "(base)"
+        )
+
+@layers.command("pin")
+@click.argument("key")
+@click.option("--unpin", is_flag=True, help="Allow the layer to be pruned again.")
+def layers_pin(key, unpin):
+    """Never prune the layer KEY or the layers it is based on."""
+    store = LayerStore()
+    store.pin(_find_layer(store, key), pinned=not unpin)
+
+def _layers_in_use():
+    """The layers images are based on."""
+    in_use = set()
+    for image in repository.list_images():
+        if not os.path.exists(image.path):
+            continue
+        try:
+            in_use.update(backing_chain(image.path))
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            log.error(f"Cannot read the backing files of {image.path}: {e}")
+            exit(1)
+    return in_use
+
+@layers.command("prune")
+@click.option("--older-than", type=int, help="Only remove layers not used for this many days.")
+@click.option("--dry-run", is_flag=True, help="Only show what would be removed.")
+def layers_prune(older_than, dry_run):
+    """Remove the layers that are not pinned and that no image is based
+    on."""
+    removed = LayerStore().prune(
+        in_use=_layers_in_use(), dry_run=dry_run,
+        older_than=older_than * 86400 if older_than is not None else None
+    )
+    for key, size in removed:
+        print("Would remove" if dry_run else "Removed", key[:16],
+              f"({size / 1024**2:.1f} MB)")
+
+    freed = sum(size for _, size in removed)
+    print(f"{'Would free' if dry_run else 'Freed'} {freed / 1024**3:.2f} GB")
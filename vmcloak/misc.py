@@ -2,8 +2,10 @@
 # This file is part of VMCloak - http://www.vmcloak.org/.
 # See the file 'docs/LICENSE.txt' for copying permission.
 
+import fcntl
 import hashlib
 import importlib
+import json
 import logging
 import os
 import shutil
@@ -13,6 +15,7 @@ import struct
 import sys
 import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 
 import requests
@@ -25,35 +28,187 @@ except ImportError:
 
 log = logging.getLogger(__name__)
 
+# From linux/fs.h, _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+COPY_WORKERS = 8
+COPY_CHUNK = 1024 * 1024
+
+def _copy_data(src, dst):
+    """Copy the contents of src to dst. Tries a reflink first, which shares
+    the data blocks on btrfs and XFS, then copy_file_range(), which copies
+    inside the kernel, and then a plain copy. Returns the method used."""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return "reflink"
+        except OSError:
+            pass
+
+        size = os.fstat(fsrc.fileno()).st_size
+        if size and hasattr(os, "copy_file_range"):
+            copied = 0
+            try:
+                while copied < size:
+                    count = os.copy_file_range(
+                        fsrc.fileno(), fdst.fileno(), size - copied
+                    )
+                    if not count:
+                        break
+                    copied += count
+            except OSError:
+                pass
+            if copied == size:
+                return "copy_file_range"
+
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+
+        shutil.copyfileobj(fsrc, fdst, COPY_CHUNK)
+        return "copy"
+
+def _copy_file(src, dst, mode):
+    method = _copy_data(src, dst)
+    if mode is None:
+        shutil.copymode(src, dst)
+    else:
+        os.chmod(dst, mode)
+    return method, os.path.getsize(dst)
+
+class CopyStats(object):
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.methods = {}
+
+    def add(self, method, size):
+        self.files += 1
+        self.bytes += size
+        self.methods[method] = self.methods.get(method, 0) + 1
+
+    def __str__(self):
+        seconds = max(self.seconds, 0.001)
+        methods = ", ".join(
+            f"{method}: {count}" for method, count in sorted(
+                self.methods.items()
+            )
+        )
+        return (
+            f"{self.files} files ({self.bytes / 1024 / 1024:.1f}MB) in "
+            f"{self.seconds:.2f}s, {self.files / seconds:.0f} files/s, "
+            f"{self.bytes / 1024 / 1024 / seconds:.1f}MB/s ({methods})"
+        )
+
+def copytree(srcdir, dstdir, lower=False, mode=None, workers=COPY_WORKERS):
+    """Copy the contents of srcdir into dstdir, which may already exist.
+    Files are copied by a pool of threads, see _copy_data(). With lower,
+    all directory and file names are translated to lowercase. With mode,
+    the permissions of the copies are set to it instead of being copied.
+    Returns a CopyStats."""
+    stats = CopyStats()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        todo = [(srcdir, dstdir)]
+        while todo:
+            src, dst = todo.pop()
+            os.makedirs(dst, exist_ok=True)
+            with os.scandir(src) as entries:
+                for entry in entries:
+                    name = entry.name.lower() if lower else entry.name
+                    target = os.path.join(dst, name)
+                    if entry.is_dir():
+                        todo.append((entry.path, target))
+                    else:
+                        futures.append(
+                            pool.submit(_copy_file, entry.path, target, mode)
+                        )
+
+        for future in futures:
+            stats.add(*future.result())
+
+    stats.seconds = time.monotonic() - start
+    return stats
+
 def copytreelower(srcdir, dstdir):
     """Copies the source directory as lowercase to the destination directory.
 
     Lowercase as in, all directory and filenames are translated to lowercase,
-    thus emulating Windows case-insensitive filepaths.
+    thus emulating Windows case-insensitive filepaths. The copies are made
+    writable.
 
     """
-    # If the source directory doesn't end with a slash then we have to take
-    # this into account when slicing it later on. Namely, when the source
-    # directory is "/mnt/winxp" then we slice up to "/mnt/winxp/", thus we
-    # require one extra character for the slash. When the source directory is
-    # "/mnt/winxp/" then of course we don't an extra character for the slice.
-    prefix = len(srcdir) + (not srcdir.endswith("/"))
+    stats = copytree(
+        srcdir, dstdir, lower=True, mode=stat.S_IRUSR | stat.S_IWUSR
+    )
+    log.info(f"Copied {srcdir}: {stats}")
+
+def copyfileslower(srcdir, dstdir, relpaths):
+    """Copies the given files of the source directory to the destination
+    directory with lowercase paths, like copytreelower(). Paths are matched
+    case-insensitively, files that do not exist are skipped."""
+    wanted = set(relpath.lower() for relpath in relpaths)
+    for relpath, path in _walk_lower(srcdir):
+        if relpath not in wanted:
+            continue
+
+        dstpath = os.path.join(dstdir, relpath)
+        os.makedirs(os.path.dirname(dstpath), exist_ok=True)
+        shutil.copyfile(path, dstpath)
+
+def find_lower(srcdir, relpath):
+    """Returns the path of relpath below srcdir, matched case-insensitively,
+    or None if there is no such file."""
+    path = srcdir
+    for part in relpath.replace("\\", "/").split("/"):
+        if not part:
+            continue
+        try:
+            names = os.listdir(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        for name in names:
+            if name.lower() == part.lower():
+                path = os.path.join(path, name)
+                break
+        else:
+            return None
+    return path if os.path.isfile(path) else None
+
+def _walk_lower(srcdir):
+    """Yields (lowercase relative path, path) for the files below srcdir.
+    Empty directories are yielded with a trailing slash."""
     for dirpath, dirnames, filenames in os.walk(srcdir):
-        for dirname in dirnames:
-            os.mkdir(os.path.join(dstdir,
-                                  dirpath[prefix:].lower(),
-                                  dirname.lower()))
+        reldir = os.path.relpath(dirpath, srcdir).lower()
+        reldir = "" if reldir == os.curdir else reldir
+        if not dirnames and not filenames:
+            yield f"{reldir}/", dirpath
 
         for fname in filenames:
-            path = os.path.join(dirpath, fname)[prefix:]
-
-            # Copy the file.
-            shutil.copyfile(os.path.join(srcdir, path),
-                            os.path.join(dstdir, path.lower()))
+            yield os.path.join(reldir, fname.lower()), \
+                os.path.join(dirpath, fname)
+
+def _graft_escape(path):
+    return path.replace("\\", "\\\\").replace("=", "\\=")
+
+def graft_points(srcdir, overrides_dir):
+    """Returns genisoimage -graft-points path specifications that place the
+    files of srcdir in the root of the ISO with lowercase paths, as
+    copytreelower() would, without copying them. The contents of
+    overrides_dir are added as well and take precedence over files of
+    srcdir with the same (case-insensitive) path."""
+    overridden = set(relpath for relpath, _ in _walk_lower(overrides_dir))
+    overridden.discard("/")
+
+    specs = []
+    for relpath, path in _walk_lower(srcdir):
+        if relpath in overridden or relpath == "/":
+            continue
+        specs.append(f"{_graft_escape(relpath)}={_graft_escape(path)}")
 
-            # Make the file writable.
-            os.chmod(os.path.join(dstdir, path.lower()),
-                     stat.S_IRUSR | stat.S_IWUSR)
+    specs.append(f"/={_graft_escape(overrides_dir)}")
+    return specs
 
 def copytreeinto(srcdir, dstdir):
     """Copy one directory into another directory.
@@ -66,24 +221,18 @@ def copytreeinto(srcdir, dstdir):
         raise Exception("Cannot create directory if there is already "
                         "a file: %s" % dstdir)
 
-    if not os.path.isdir(dstdir):
-        os.mkdir(dstdir)
-
-    for fname in os.listdir(srcdir):
-        path_in = os.path.join(srcdir, fname)
-        path_out = os.path.join(dstdir, fname)
-        if os.path.isfile(path_in):
-            shutil.copy(path_in, path_out)
-        else:
-            copytreeinto(path_in, path_out)
+    stats = copytree(srcdir, dstdir)
+    log.debug(f"Copied {srcdir}: {stats}")
 
 def ini_read(path):
-    ret, section = {}, None
-
     if os.path.exists(path):
         buf = open(path, "rb").read()
     else:
         buf = b""
+    return ini_parse(buf)
+
+def ini_parse(buf):
+    ret, section = {}, None
 
     # UTF-16 Byte Order Mark ("BOM")
     mode = "utf16" if buf[:2] == "\xff\xfe" else "latin1"
@@ -175,6 +324,24 @@ def sha1_file(path):
 
     return h.hexdigest()
 
+def hash_file(path, algorithms=("sha1", "sha256")):
+    """Calculate several hashes of a file while reading it once. Returns a
+    dictionary of algorithm name to hex digest."""
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+
+    with open(path, "rb") as fp:
+        while True:
+            buf = fp.read(8*1024*1024)
+            if not buf:
+                break
+
+            for h in hashes:
+                h.update(buf)
+
+    return {
+        algorithm: h.hexdigest() for algorithm, h in zip(algorithms, hashes)
+    }
+
 def wait_for_agent(a, timeout=180):
     """Wait for the Agent to come up."""
     now = time.time()
@@ -233,33 +400,146 @@ def filename_from_url(url):
     """Return the filename from a given url."""
     return os.path.basename(urllib.parse.urlparse(url).path)
 
-def download_file(url, filepath):
-    """Download the file from url and store it in the given filepath."""
-    user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:94.0) " \
-                 "Gecko/20100101 Firefox/94.0"
+PART_SUFFIX = ".part"
+DOWNLOAD_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:94.0) " \
+                      "Gecko/20100101 Firefox/94.0"
+
+def _read_part_state(partpath, url):
+    """Returns the validator (ETag or Last-Modified) of a partial download
+    of url, or None if it cannot be resumed."""
+    try:
+        with open(partpath + ".json", "r") as fp:
+            state = json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+    if state.get("url") != url or not os.path.isfile(partpath):
+        return None
+    return state.get("validator")
+
+def _write_part_state(partpath, url, validator):
+    with open(partpath + ".json", "w") as fp:
+        json.dump({"url": url, "validator": validator}, fp)
+
+def _remove_part(partpath):
+    for path in (partpath, partpath + ".json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+def _part_hash(partpath):
+    """Hash the bytes of a partial download so hashing can continue where
+    the previous attempt stopped."""
+    h = hashlib.sha1()
+    with open(partpath, "rb") as fp:
+        while True:
+            buf = fp.read(8*1024*1024)
+            if not buf:
+                break
+            h.update(buf)
+    return h
+
+def _download_attempt(url, partpath, validator):
+    """Download (the rest of) url into partpath. Returns the sha1 object of
+    the complete file. Raises requests.RequestException if the download
+    could not be completed."""
+    # Content-Length and ranges count the encoded bytes, so ask for the
+    # file as it is.
     headers = {
-        "User-Agent": user_agent,
+        "User-Agent": DOWNLOAD_USER_AGENT, "Accept-Encoding": "identity",
     }
-
+    offset = os.path.getsize(partpath) if validator else 0
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+
+    with requests.get(url, headers=headers, stream=True, timeout=60) as resp:
+        if offset and resp.status_code == 416:
+            # The part may already hold the whole file. Otherwise start over.
+            total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+            if total == str(offset):
+                return _part_hash(partpath)
+            _remove_part(partpath)
+            raise requests.RequestException(
+                "Requested range not satisfiable, starting over"
+            )
+
+        resp.raise_for_status()
+        if offset and resp.status_code == 206:
+            content_range = resp.headers.get("Content-Range", "")
+            if not content_range.startswith(f"bytes {offset}-"):
+                _remove_part(partpath)
+                raise requests.RequestException(
+                    f"Server sent range '{content_range}' instead of "
+                    f"{offset}-, starting over"
+                )
+            log.debug("Resuming download of '%s' at %d bytes", url, offset)
+            sha1_hash = _part_hash(partpath)
+            mode = "ab"
+        else:
+            # No partial file, or the file changed and the server sent all
+            # of it.
+            offset = 0
+            sha1_hash = hashlib.sha1()
+            mode = "wb"
+
+        validator = resp.headers.get("ETag") or \
+            resp.headers.get("Last-Modified")
+        if validator:
+            _write_part_state(partpath, url, validator)
+
+        length = resp.headers.get("Content-Length")
+        written = 0
+        with open(partpath, mode) as fp:
+            for chunk in resp.iter_content(chunk_size=256*1024):
+                written += fp.write(chunk)
+                sha1_hash.update(chunk)
+
+        # A connection closed early by the server is not always an error
+        # for requests.
+        if length is not None and written != int(length):
+            raise requests.RequestException(
+                f"Connection closed after {offset + written} bytes"
+            )
+
+    return sha1_hash
+
+def download_file(url, filepath, retries=3):
+    """Download the file from url and store it in the given filepath. The
+    download is written to a .part file first. An interrupted download is
+    resumed with a HTTP Range request, from this or a later call, if the
+    server supports it and the file did not change."""
+    partpath = filepath + PART_SUFFIX
     start = time.time()
-    sha1_hash = hashlib.sha1()
-    written = 0
-    try:
-        with requests.get(url, headers=headers, stream=True) as resp:
-            resp.raise_for_status()
-            with open(filepath, "wb") as fp:
-                for chunk in resp.iter_content(chunk_size=2*1024*1024):
-                    written += fp.write(chunk)
-                    sha1_hash.update(chunk)
-    except requests.RequestException as e:
-        log.warning("Failed to download file from '%s', got error: %s", url, e)
-        return False, None
+    start_size = os.path.getsize(partpath) \
+        if _read_part_state(partpath, url) else 0
 
+    for attempt in range(retries + 1):
+        try:
+            sha1_hash = _download_attempt(
+                url, partpath, _read_part_state(partpath, url)
+            )
+            break
+        except requests.RequestException as e:
+            log.warning(
+                "Failed to download file from '%s', got error: %s", url, e
+            )
+            # Client errors will not go away by trying again.
+            if attempt == retries or (
+                    isinstance(e, requests.HTTPError) and
+                    e.response is not None and e.response.status_code < 500):
+                return False, None
+            time.sleep(min(attempt, 10))
+
+    os.replace(partpath, filepath)
+    _remove_part(partpath)
+
+    written = os.path.getsize(filepath) - start_size
+    took = max(time.time() - start, 0.001)
     log.debug(
         "Successfully downloaded file '{}' ({:.2f}MB)' in "
         "'{:.2f}' second(s) ({:.2f}MB/s)".format(
             filename_from_url(url), written / 1024.**2.,
-            time.time() - start, written / (time.time() - start)
+            took, written / 1024.**2. / took
         )
     )
     return True, sha1_hash.hexdigest()
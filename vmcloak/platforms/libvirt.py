@@ -78,6 +78,12 @@ def _create_vm(name, attr, iso_path=None, is_snapshot=False):
         # TODO: cannot use --transient here because virt-install will fail
         args.extend(["--livecd", "--cdrom", iso_path,
                      "--wait", "-1"])
+        if attr.get("config_iso"):
+            # The per-image settings for an installer ISO shared by all
+            # images.
+            args.extend([
+                "--disk", f"path={attr['config_iso']},device=cdrom,readonly=on"
+            ])
     else:
         # Create a new (snapshot) VM
         args.append("--import")
@@ -7,14 +7,16 @@ import os.path
 import subprocess
 import time
 import shutil
-from re import search
 from pkg_resources import parse_version
 
+from vmcloak import qemucaps
+from vmcloak.exceptions import QMPError
 from vmcloak.platforms import Machinery
 from vmcloak.repository import vms_path, IPNet
 from vmcloak.rand import random_vendor_mac
 from vmcloak.machineconf import MachineConfDump
 from vmcloak.ostype import get_os
+from vmcloak.qmp import InstallMonitor, QMPClient
 
 log = logging.getLogger(__name__)
 name = "QEMU"
@@ -22,10 +24,16 @@ disk_format = "qcow2"
 
 machines = {}
 confdumps = {}
+# QMP sockets and connected QMPClients of running VMs, see _qmp().
+qmp_paths = {}
+qmp_clients = {}
+# Build overlays of running VMs, see _create_build_overlay().
+overlays = {}
+_io_uring = None
 
 default_net = IPNet("192.168.30.0/24")
 
-QEMU_AMD64 = ["qemu-system-x86_64", "-monitor", "stdio"]
+QEMU_AMD64 = ["qemu-system-x86_64"]
 
 def _create_image_disk(path, size):
     log.info("Creating disk %s with size %s", path, size)
@@ -34,6 +42,29 @@ def _create_image_disk(path, size):
          "-o", "lazy_refcounts=on,cluster_size=2M", path, size]
     )
 
+def _create_overlay_disk(base_path, path):
+    log.info("Creating overlay %s on %s", path, base_path)
+    subprocess.check_call(["qemu-img", "create", "-f", "qcow2", "-o",
+                           "cluster_size=2M", "-b", base_path, "-F", "qcow2",
+                           path])
+
+def _supports_io_uring(path):
+    """Check once if QEMU can open disks with aio=io_uring. That needs
+    QEMU 5.0 or newer, built with liburing, on a kernel with io_uring."""
+    global _io_uring
+    if _io_uring is None:
+        opts = (f"driver=qcow2,file.driver=file,"
+                f"file.filename={path.replace(',', ',,')},file.aio=io_uring")
+        try:
+            subprocess.check_call(
+                ["qemu-img", "info", "--image-opts", opts],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            _io_uring = True
+        except (OSError, subprocess.CalledProcessError):
+            _io_uring = False
+    return _io_uring
+
 def _create_snapshot_disk(image_path, path):
     log.info("Creating snapshot %s with master %s", path, image_path)
     subprocess.check_call(["qemu-img", "create", "-f", "qcow2", "-o",
@@ -41,73 +72,110 @@ def _create_snapshot_disk(image_path, path):
                            image_path, path])
 
 
-def _make_pre_v41_args(attr):
-    return [
-        "-M", "q35",
-        "-nodefaults",
-        "-vga", "std",
-        "-rtc", "base=localtime,driftfix=slew",
-        "-realtime", "mlock=off",
-        "-m", f"{attr['ramsize']}",
-        "-smp", f"{attr['cpus']}",
-        "-netdev", f"type=bridge,br={attr['adapter']},id=net0",
-        "-device", f"rtl8139,netdev=net0,mac={attr['mac']},bus=pcie.0,addr=3",
-
-        "-device", "ich9-ahci,id=ahci",
-        "-device", "ide-drive,bus=ahci.0,unit=0,drive=disk,bootindex=2",
-        "-device", "ide-cd,bus=ahci.1,unit=0,drive=cdrom,bootindex=1",
-        "-device", "usb-ehci,id=ehci",
-        "-device", "usb-tablet,bus=ehci.0",
-        "-soundhw", "hda",
-        "--enable-kvm"
-    ]
-
-# From 4.1 the -realtime mlock=off and -device ide-drive
-# are deprecated and those are removed in higher versions.
-def _make_post_v41_args(attr):
-    return [
+def _machine_args(attr, caps):
+    """The machine and its devices. Options that were replaced or removed
+    in some QEMU version are chosen by what the binary supports."""
+    options = caps["options"]
+    args = [
         "-nodefaults",
         "-M", "q35",
         "-vga", "std",
         "-smp", f"{attr['cpus']}",
-        "-overcommit", "mem-lock=off",
+    ]
+    # -realtime mlock=off is -overcommit mem-lock=off since QEMU 4.1. If the
+    # options could not be listed, go by the version.
+    if options:
+        overcommit = "-overcommit" in options
+        realtime = "-realtime" in options
+    else:
+        overcommit = not caps["version"] or \
+            parse_version(caps["version"]) >= parse_version("4.1")
+        realtime = not overcommit
+    if overcommit:
+        args.extend(["-overcommit", "mem-lock=off"])
+    elif realtime:
+        args.extend(["-realtime", "mlock=off"])
+
+    # ide-drive was removed in favour of ide-hd, which exists in all QEMU
+    # versions VMCloak supports.
+    devices = caps["devices"]
+    disk_device = "ide-drive" \
+        if "ide-drive" in devices and "ide-hd" not in devices else "ide-hd"
+    args.extend([
         "-rtc", "base=localtime,driftfix=slew",
         "-m", f"{attr['ramsize']}",
         "-netdev", f"type=bridge,br={attr['adapter']},id=net0",
         "-device", f"rtl8139,netdev=net0,mac={attr['mac']},bus=pcie.0,addr=3",
 
         "-device", "ich9-ahci,id=ahci",
-        "-device", "ide-hd,bus=ahci.0,unit=0,drive=disk,bootindex=2",
+        "-device", f"{disk_device},bus=ahci.0,unit=0,drive=disk,bootindex=2",
 
         "-device", "ide-cd,bus=ahci.1,unit=0,drive=cdrom,bootindex=1",
         "-device", "usb-ehci,id=ehci",
         "-device", "usb-tablet,bus=ehci.0",
-        "-soundhw", "hda",
-        "-enable-kvm"
-    ]
+    ])
 
-def _make_args(attr, disk_placeholder=False, iso=None, display=None):
+    # -soundhw was removed in QEMU 7.1.
+    if "-soundhw" in options:
+        args.extend(["-soundhw", "hda"])
+    else:
+        args.extend(["-device", "intel-hda", "-device", "hda-duplex"])
 
-    if version() < parse_version("4.1"):
-        args = _make_pre_v41_args(attr)
+    if caps["accels"] and "kvm" not in caps["accels"]:
+        log.warning("This QEMU does not support KVM, the VM will be slow")
     else:
-        args = _make_post_v41_args(attr)
+        args.append("-enable-kvm")
+    return args
+
+def _disk_drive(attr, disk=None):
+    """The -drive of the disk of an image being built. With the fast-build
+    profile the host cache is used and flushes are ignored, as a crash
+    during a build means starting over anyway."""
+    disk = disk or attr["path"]
+    drive = f"file={disk},format=qcow2,if=none,id=disk"
+    if attr.get("fast_build"):
+        aio = "io_uring" if _supports_io_uring(disk) else "threads"
+        drive += f",cache=unsafe,aio={aio}"
+    if attr.get("compact"):
+        # The zeros written to free space before compacting are not stored.
+        drive += ",discard=unmap,detect-zeroes=unmap"
+    return drive
+
+def _make_args(attr, disk_placeholder=False, iso=None, display=None,
+               config_iso=None, qmp=None, serial=None, disk=None):
+
+    caps = capabilities()
+    args = _machine_args(attr, caps)
 
     if iso:
         args.extend(["-drive", f"{iso}if=none,id=cdrom,readonly=on"])
     else:
         args.extend(["-drive", "if=none,id=cdrom,readonly=on"])
 
+    # The per-image settings for an installer ISO shared by all images.
+    if config_iso:
+        args.extend([
+            "-drive",
+            f"file={config_iso},format=raw,if=none,id=config,readonly=on",
+            "-device", "ide-cd,bus=ahci.2,unit=0,drive=config",
+        ])
+
+    # Used to control the VM and to follow the progress of an installation.
+    if qmp:
+        if parse_version(caps["version"]) < parse_version("6.0"):
+            args.extend(["-qmp", f"unix:{qmp},server,nowait"])
+        else:
+            args.extend(["-qmp", f"unix:{qmp},server=on,wait=off"])
+    if serial:
+        args.extend(["-serial", f"file:{serial}"])
+
     if disk_placeholder:
         args.extend(
             ["-drive",
              "file=%DISPOSABLE_DISK_PATH%,format=qcow2,if=none,id=disk"]
         )
     else:
-        args.extend(
-            ["-drive",
-             f"file={attr['path']},format=qcow2,if=none,id=disk"]
-        )
+        args.extend(["-drive", _disk_drive(attr, disk)])
 
     if display:
         args.extend(["-display", "gtk"])
@@ -117,8 +185,15 @@ def _make_args(attr, disk_placeholder=False, iso=None, display=None):
     return args
 
 
-def _create_vm(name, attr, iso_path=None, is_snapshot=False):
+def _create_vm(name, attr, iso_path=None, is_snapshot=False, qmp=None,
+               serial=None):
     log.info("Create VM instance for %s", name)
+    if not qmp:
+        qmp = _qmp_path(name)
+        if os.path.exists(qmp):
+            os.remove(qmp)
+    qmp_paths[name] = qmp
+
     if not os.path.exists(attr["path"]):
         # We assume the caller has already checked if existing files are a
         # problem
@@ -127,6 +202,10 @@ def _create_vm(name, attr, iso_path=None, is_snapshot=False):
         else:
             _create_image_disk(attr["path"], "%sG" % attr["hddsize"])
 
+    disk = None
+    if attr.get("build_overlay") and not is_snapshot:
+        disk = _create_build_overlay(name, attr)
+
     net = attr["adapter"] or "br0"
     attr["adapter"] = net
     if iso_path:
@@ -151,7 +230,9 @@ def _create_vm(name, attr, iso_path=None, is_snapshot=False):
         confdumps[name].machinery = "qemu"
 
     args = QEMU_AMD64 + _make_args(
-        attr, disk_placeholder=False, iso=iso, display=attr.get("vm_visible")
+        attr, disk_placeholder=False, iso=iso, display=attr.get("vm_visible"),
+        config_iso=attr.get("config_iso") if iso_path else None,
+        qmp=qmp, serial=serial, disk=disk
     )
     if attr.get("vrde"):
         # Note that qemu will add 5900 to the port number
@@ -159,10 +240,61 @@ def _create_vm(name, attr, iso_path=None, is_snapshot=False):
         args.extend(["-vnc", "0.0.0.0:%s" % port])
 
     log.debug("Execute: %s", " ".join(args))
-    m = subprocess.Popen(args, stdin=subprocess.PIPE)
+    m = subprocess.Popen(args, stdin=subprocess.DEVNULL)
     machines[name] = m
     return m
 
+def _qmp_path(name):
+    return os.path.join(_get_vm_dir("qmp"), f"{name}.sock")
+
+def _qmp(name, timeout=30):
+    """The QMPClient of the running VM name. It connects on first use."""
+    client = qmp_clients.get(name)
+    if client:
+        return client
+
+    if name not in qmp_paths:
+        raise KeyError(f"No QMP socket for {name}. VM not started?")
+    client = QMPClient(qmp_paths[name])
+    client.connect(timeout=timeout, proc=machines.get(name))
+    qmp_clients[name] = client
+    return client
+
+def _close_qmp(name):
+    client = qmp_clients.pop(name, None)
+    if client:
+        client.close()
+    path = qmp_paths.pop(name, None)
+    if path and os.path.exists(path):
+        os.remove(path)
+
+def _create_build_overlay(name, attr):
+    """Let the VM write to an overlay in the build_overlay directory, such
+    as a tmpfs, instead of to the image. The overlay is committed to the
+    image by remove_vm_data() if the VM shut down cleanly."""
+    overlay = os.path.join(attr["build_overlay"], f"vmcloak-{name}.qcow2")
+    if os.path.exists(overlay):
+        os.remove(overlay)
+    _create_overlay_disk(attr["path"], overlay)
+    overlays[name] = overlay
+    return overlay
+
+def _remove_build_overlay(name, m):
+    overlay = overlays.pop(name, None)
+    if not overlay:
+        return
+
+    try:
+        if m and m.wait() == 0:
+            log.info("Committing build overlay %s", overlay)
+            subprocess.check_call(["qemu-img", "commit", "-d", overlay])
+        else:
+            log.warning(
+                f"{name} did not shut down cleanly, discarding its changes"
+            )
+    finally:
+        os.remove(overlay)
+
 #
 # Platform API
 #
@@ -182,61 +314,222 @@ def prepare_snapshot(name, attr):
 
     return vm_dir
 
+def _install_paths(name):
+    """The QMP socket and serial port log used while installing an
+    image."""
+    dirpath = _get_vm_dir(os.path.join("install", name))
+    return (os.path.join(dirpath, "qmp.sock"),
+            os.path.join(dirpath, "serial.log"))
+
 def create_new_image(name, _, iso_path, attr):
     if os.path.exists(attr["path"]):
         raise ValueError("Image %s already exists" % attr["path"])
 
-    m = _create_vm(name, attr, iso_path=iso_path)
-    m.wait()
-    if m.returncode != 0:
-        raise ValueError(m.returncode)
+    qmp, serial = _install_paths(name)
+    m = _create_vm(name, attr, iso_path=iso_path, qmp=qmp, serial=serial)
+    timeout = attr.get("install_timeout")
+    monitor = InstallMonitor(
+        m, qmp, serial,
+        stall_timeout=(attr.get("stall_timeout") or 10) * 60,
+        timeout=timeout * 60 if timeout else None
+    )
+    try:
+        monitor.wait()
+    except ValueError:
+        log.error(f"Installation of {name} failed, see {serial}")
+        raise
+    finally:
+        monitor.close()
 
 def create_snapshot_vm(image, name, attr):
     if os.path.exists(attr["path"]):
         raise ValueError("Snapshot %s already exists" % attr["path"])
 
+    snapshot_formats[name] = check_snapshot_format(
+        attr.get("snapshot_format"), attr.get("snapshot_codec")
+    )
+    snapshot_codecs[name] = find_snapshot_codec(
+        "none" if snapshot_formats[name] == "mapped-ram"
+        else attr.get("snapshot_codec"), attr.get("snapshot_level")
+    )
     _create_vm(name, attr, is_snapshot=True)
 
-_DECOMPRESS_BINARIES = {
-    "lz4": shutil.which("lz4"),
-    "gzip": shutil.which("gzip")
+# The compressors a memory snapshot can be written with. Each has the
+# binaries to use, the first one found is used, the arguments to compress
+# stdin to stdout with and the default level. pigz and zstd -T0 compress
+# on all CPUs.
+SNAPSHOT_CODECS = {
+    "zstd": (("zstd",), "-q -T0 -%d -c", 3),
+    "lz4": (("lz4",), "-q -z -%d -c", 1),
+    "gzip": (("pigz", "gzip"), "-c -%d", 3),
+    "none": (("cat",), "", None),
 }
-
-_DECOMPRESS_COMMANDS = {
-    "lz4": "-z > %SNAPSHOT_PATH%",
-    "gzip": "-c -3 > %SNAPSHOT_PATH%"
+# The arguments to decompress stdin to stdout with.
+_DECOMPRESS_ARGS = {
+    "zstd": "-q -d -c", "lz4": "-q -d -c", "gzip": "-d -c", "none": "",
 }
-
-def _get_exec_args(memsnapshot_path):
-    for tool in ("lz4", "gzip"):
-        binary = _DECOMPRESS_BINARIES.get(tool)
-        if binary:
-            args = _DECOMPRESS_COMMANDS[tool].replace(
-                "%SNAPSHOT_PATH%", memsnapshot_path
-            )
-            return f"{binary} {args}"
-
-    return f"/bin/cat > {memsnapshot_path}"
+# The first bytes of the files each codec writes.
+_CODEC_MAGIC = {
+    "zstd": b"\x28\xb5\x2f\xfd", "lz4": b"\x04\x22\x4d\x18",
+    "gzip": b"\x1f\x8b",
+}
+# Used when no codec is chosen. zstd is not in here, so consumers that
+# expect lz4 or gzip keep working.
+_DEFAULT_CODECS = ("lz4", "gzip", "none")
+# Codec of each snapshot VM, see find_snapshot_codec().
+snapshot_codecs = {}
+
+def find_snapshot_codec(codec=None, level=None):
+    """Returns (codec, binary, level) for the given codec, or for the
+    first default codec that is installed if codec is None."""
+    for name in (codec,) if codec else _DEFAULT_CODECS:
+        if name not in SNAPSHOT_CODECS:
+            raise ValueError(f"Unknown snapshot codec: {name}")
+
+        binaries, _, default_level = SNAPSHOT_CODECS[name]
+        for binary in binaries:
+            path = shutil.which(binary)
+            if path:
+                if default_level is None:
+                    level = None
+                return name, path, level or default_level
+
+    raise ValueError(f"Snapshot codec {codec} is not installed")
+
+def detect_snapshot_codec(path):
+    """The codec of the memory snapshot at path, for snapshots made
+    before the codec was stored in machineinfo.json."""
+    with open(path, "rb") as fp:
+        magic = fp.read(4)
+    for codec, codec_magic in _CODEC_MAGIC.items():
+        if magic.startswith(codec_magic):
+            return codec
+    return "none"
+
+def restore_exec_args(memsnapshot_path, codec):
+    """The command that writes the memory snapshot at memsnapshot_path,
+    written with codec, uncompressed to stdout."""
+    _, binary, _ = find_snapshot_codec(codec)
+    return " ".join(filter(None, (
+        binary, _DECOMPRESS_ARGS[codec], "<", memsnapshot_path
+    )))
+
+# Memory snapshot formats. A stream can only be restored by reading it
+# from start to end. mapped-ram (QEMU 9.0 and newer) writes each page of
+# RAM at a fixed offset in the file. Restores read it with several
+# threads and can use the page cache, but it cannot be compressed.
+SNAPSHOT_FORMATS = ("stream", "mapped-ram")
+# Migration capabilities of each format. Restores must enable the same.
+SNAPSHOT_CAPABILITIES = {
+    "stream": [],
+    "mapped-ram": ["mapped-ram", "multifd"],
+}
+# Format of each snapshot VM, see check_snapshot_format().
+snapshot_formats = {}
+MAX_MULTIFD_CHANNELS = 8
+
+def check_snapshot_format(snapshot_format=None, codec=None):
+    """Returns the given memory snapshot format, stream if it is None.
+    Raises ValueError if the format cannot be used."""
+    if not snapshot_format or snapshot_format == "stream":
+        return "stream"
+    if snapshot_format not in SNAPSHOT_FORMATS:
+        raise ValueError(f"Unknown snapshot format: {snapshot_format}")
+    if codec and codec != "none":
+        raise ValueError(f"{snapshot_format} snapshots cannot be compressed")
+
+    caps = capabilities()
+    if caps["qmp_commands"]:
+        supported = set(SNAPSHOT_CAPABILITIES[snapshot_format]) <= \
+            set(caps["migration_capabilities"])
+    else:
+        # QEMU could not be asked, mapped-ram was added in 9.0.
+        supported = version() >= parse_version("9.0")
+    if not supported:
+        raise ValueError(
+            f"{snapshot_format} snapshots are not supported by this QEMU, "
+            f"they need QEMU 9.0 or newer"
+        )
+    return snapshot_format
+
+def snapshot_parameters(snapshot_format):
+    """The migration parameters to write and restore a memory snapshot of
+    snapshot_format with."""
+    if snapshot_format == "mapped-ram":
+        return {
+            "multifd-channels":
+                min(os.cpu_count() or 1, MAX_MULTIFD_CHANNELS)
+        }
+    return {}
+
+def _get_exec_args(memsnapshot_path, codec):
+    name, binary, level = codec
+    args = SNAPSHOT_CODECS[name][1]
+    if level is not None:
+        args = args % level
+    return " ".join(filter(None, (binary, args, ">", memsnapshot_path)))
 
 
 MEMORY_SNAPSHOT_NAME = "memory.snapshot"
-def create_snapshot(name):
+def create_snapshot(name, timeout=None):
+    """Write the memory of VM name to a memory snapshot and stop it. The
+    format, codec and sizes are added to the machineinfo dump."""
     m = machines[name]
     snapshot_path = os.path.join(_get_vm_dir(name), MEMORY_SNAPSHOT_NAME)
-    confdumps[name].add_machine_field("memory_snapshot", MEMORY_SNAPSHOT_NAME)
-    # Stop the machine so the memory does not change while making the
-    # memory snapshot.
-    m.stdin.write(b"stop\n")
-    m.stdin.write(b"migrate_set_speed 1G\n")
-    # Send the actual memory snapshot command. The args helper tries to find
-    # lz4 of gzip binaries so we can compress the dump.
-    m.stdin.write(
-        f"migrate \"exec:{_get_exec_args(snapshot_path)}\"\n".encode()
+    snapshot_format = snapshot_formats.pop(name, "stream")
+    codec = snapshot_codecs.pop(name, None) or find_snapshot_codec()
+    capabilities = SNAPSHOT_CAPABILITIES[snapshot_format]
+    parameters = snapshot_parameters(snapshot_format)
+    confdump = confdumps[name]
+    confdump.add_machine_field("memory_snapshot", MEMORY_SNAPSHOT_NAME)
+    try:
+        qmp = _qmp(name)
+        # Stop the machine so the memory does not change while making the
+        # memory snapshot.
+        qmp.execute("stop")
+        # The stream goes into a local pipe or file, only the compressor
+        # or disk should limit its speed.
+        qmp.execute("migrate-set-parameters", **{"max-bandwidth": 1024**4})
+        if capabilities:
+            qmp.execute("migrate-set-capabilities", capabilities=[
+                {"capability": cap, "state": True} for cap in capabilities
+            ])
+        if parameters:
+            qmp.execute("migrate-set-parameters", **parameters)
+        if snapshot_format == "mapped-ram":
+            uri = f"file:{snapshot_path}"
+        else:
+            uri = f"exec:{_get_exec_args(snapshot_path, codec)}"
+
+        start = time.monotonic()
+        status = qmp.migrate(uri, timeout=timeout)
+        seconds = time.monotonic() - start
+        qmp.quit()
+    except QMPError as e:
+        m.kill()
+        raise ValueError(f"Failed to create memory snapshot: {e}")
+    finally:
+        m.wait()
+        _close_qmp(name)
+
+    size = status.get("ram", {}).get("transferred")
+    st = os.stat(snapshot_path)
+    # Pages that were never written are holes in a mapped-ram file.
+    compressed_size = st.st_blocks * 512 if capabilities else st.st_size
+    # Restores must enable the same capabilities and parameters.
+    confdump.add_machine_field("memory_snapshot_format", snapshot_format)
+    confdump.add_machine_field("memory_snapshot_capabilities", capabilities)
+    confdump.add_machine_field("memory_snapshot_parameters", parameters)
+    confdump.add_machine_field("memory_snapshot_codec", codec[0])
+    confdump.add_machine_field("memory_snapshot_size", size)
+    confdump.add_machine_field(
+        "memory_snapshot_compressed_size", compressed_size
+    )
+    confdump.add_machine_field("memory_snapshot_seconds", round(seconds, 2))
+    log.info(
+        "Memory snapshot of %s written with %s in %.1fs (%s to %d bytes)",
+        name, codec[0], seconds, size, compressed_size
     )
-    m.stdin.write(b"quit\n")
-    log.debug("Flushing snapshot commands to qemu.")
-    m.stdin.flush()
-    m.wait()
 
 def create_machineinfo_dump(name, image):
     confdump = confdumps[name]
@@ -252,7 +545,8 @@ def start_image_vm(image, user_attr=None):
     _create_vm(image.name, attr)
 
 def remove_vm_data(name):
-    """Remove VM definitions and snapshots but keep disk image intact"""
+    """Remove VM definitions and snapshots but keep disk image intact. A
+    build overlay is committed to the image if the VM shut down cleanly."""
     m = machines.get(name)
     if m:
         log.info("Cleanup VM %s", name)
@@ -263,25 +557,54 @@ def remove_vm_data(name):
             pass
     else:
         log.info("Not running: %s", name)
+    _close_qmp(name)
+    _remove_build_overlay(name, m)
     path = os.path.join(vms_path, "%s.%s" % (name, disk_format))
     if os.path.exists(path):
         os.remove(path)
 
 def wait_for_shutdown(name, timeout=None):
-    # TODO: timeout
+    """Wait for the SHUTDOWN event of VM name and for QEMU to exit."""
     m = machines.get(name)
     end = None
     if timeout:
-        end = time.time() + timeout
-    while True:
-        m.poll()
-        if m.returncode is not None:
-            if m.returncode == 0:
-                return True
-            raise ValueError(f"Non-zero exit code: {m.returncode}")
-        if end and time.time() > end:
+        end = time.monotonic() + timeout
+    try:
+        # The connection closes when QEMU exits without a SHUTDOWN
+        # event, for example when it is killed.
+        if not _qmp(name).wait_event(("SHUTDOWN",), timeout=timeout):
             raise ValueError("Timeout")
-        time.sleep(1)
+    except (KeyError, QMPError) as e:
+        log.debug("Waiting for %s without QMP. %s", name, e)
+
+    try:
+        m.wait(timeout=max(end - time.monotonic(), 1) if end else None)
+    except subprocess.TimeoutExpired:
+        raise ValueError("Timeout")
+    if m.returncode != 0:
+        raise ValueError(f"Non-zero exit code: {m.returncode}")
+    return True
+
+def compact_disk(path, compress=False):
+    """Rewrite the image at path without its unused and zeroed clusters
+    and replace it. Returns the size before and after in bytes."""
+    tmppath = f"{path}.compact"
+    args = ["qemu-img", "convert", "-O", "qcow2", "-S", "4k",
+            "-o", "lazy_refcounts=on,cluster_size=2M"]
+    if compress:
+        args.append("-c")
+    args.extend([path, tmppath])
+
+    before = os.path.getsize(path)
+    log.info("Compacting %s", path)
+    try:
+        subprocess.check_call(args)
+        os.replace(tmppath, path)
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+    return before, os.path.getsize(path)
 
 def clone_disk(image, target):
     log.info("Cloning disk %s to %s", image.path, target)
@@ -298,24 +621,16 @@ def remove_hd(path):
     os.remove(path)
 
 
+def capabilities():
+    """What the qemu in PATH supports, see vmcloak.qemucaps.probe()."""
+    return qemucaps.capabilities(QEMU_AMD64[0])
+
 def version():
     """Get the QEMU version qemu in PATH. Returns a
     version object from pkg_resources.parse_version if a version is found.
     passes empty string to parse_version if no version could be determined and
     returns result"""
-    vdata = subprocess.check_output(["qemu-system-x86_64", "--version"])
-    # Read QEMU version as if it were semver. It is not, but looks similar.
-    version_r = (
-        br"(0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)(?:-((?:0|[1-9]\d*|\d*"
-        br"[a-zA-Z-][0-9a-zA-Z-]*)(?:\.(?:0|[1-9]\d*|\d*[a-zA-Z-]"
-        br"[0-9a-zA-Z-]*))*))?(?:\+([0-9a-zA-Z-]+(?:\.[0-9a-zA-Z-]+)*))?"
-    )
-
-    match = search(version_r, vdata)
-    if not match:
-        return parse_version("")
-
-    return parse_version(match.group().strip().decode())
+    return parse_version(capabilities()["version"])
 
 #
 # Helper class for dependencies
@@ -323,20 +638,25 @@ def version():
 
 class VM(Machinery):
     def attach_iso(self, iso_path):
-        m = machines.get(self.name)
-        if not m:
+        if self.name not in machines:
             raise KeyError(
                 "Cannot attach ISO to machine. Process handle not available."
             )
 
-        m.stdin.write(f"change cdrom {iso_path}\n".encode())
-        m.stdin.flush()
+        # Returns when the new medium is inserted and the tray closed.
+        _qmp(self.name).execute(
+            "blockdev-change-medium", device="cdrom", filename=iso_path,
+            format="raw"
+        )
 
     def detach_iso(self):
-        m = machines.get(self.name)
-        if not m:
+        if self.name not in machines:
             raise KeyError(
                 "Cannot attach ISO to machine. Process handle not available."
             )
-        m.stdin.write(b"eject cdrom\n")
-        m.stdin.flush()
+
+        qmp = _qmp(self.name)
+        qmp.execute("eject", device="cdrom", force=True)
+        # The guest may have locked the tray, it is opened when it lets go.
+        if not qmp.wait_event(("DEVICE_TRAY_MOVED",), timeout=10):
+            log.warning("The tray of %s did not open", self.name)
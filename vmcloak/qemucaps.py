@@ -0,0 +1,177 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+from vmcloak.repository import conf_path
+
+log = logging.getLogger(__name__)
+
+CACHE_PATH = os.path.join(conf_path, "qemu-capabilities.json")
+# Increase when probe() returns other information, so cached results are
+# probed again.
+PROBE_VERSION = 2
+
+# Read QEMU version as if it were semver. It is not, but looks similar.
+_version_r = re.compile(
+    r"(0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)(?:-((?:0|[1-9]\d*|\d*"
+    r"[a-zA-Z-][0-9a-zA-Z-]*)(?:\.(?:0|[1-9]\d*|\d*[a-zA-Z-]"
+    r"[0-9a-zA-Z-]*))*))?(?:\+([0-9a-zA-Z-]+(?:\.[0-9a-zA-Z-]+)*))?"
+)
+
+# Capabilities of the binaries probed by this process.
+_probed = {}
+
+def _run(binary, *args, stdin=None):
+    """Returns the output of the binary, or an empty string if it fails,
+    for example because an option does not exist in this version."""
+    try:
+        proc = subprocess.run(
+            [binary, *args], input=stdin, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, timeout=60
+        )
+    except subprocess.TimeoutExpired:
+        log.warning(f"{binary} {' '.join(args)} did not finish")
+        return ""
+    if proc.returncode != 0:
+        return ""
+    return proc.stdout.decode("utf8", "replace")
+
+def parse_version(output):
+    match = _version_r.search(output)
+    return match.group().strip() if match else ""
+
+def parse_options(output):
+    """The command line options listed by -help."""
+    return sorted(set(re.findall(r"^(-[\w-]+)", output, re.M)))
+
+def parse_machines(output):
+    """The machine types and aliases listed by -machine help."""
+    return sorted(set(
+        line.split()[0] for line in output.splitlines()[1:] if line.strip()
+    ))
+
+def parse_devices(output):
+    return sorted(set(re.findall(r'^name "([^"]+)"', output, re.M)))
+
+def parse_accels(output):
+    return [line.strip() for line in output.splitlines()[1:] if line.strip()]
+
+def _qmp_lists(output):
+    """The replies of a QMP session that return a list."""
+    for line in output.splitlines():
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(msg.get("return"), list):
+            yield msg["return"]
+
+def parse_qmp_commands(output):
+    """The command names in the reply to query-commands."""
+    for reply in _qmp_lists(output):
+        if reply and "name" in reply[0]:
+            return sorted(cmd["name"] for cmd in reply)
+    return []
+
+def parse_migration_capabilities(output):
+    """The capability names in the reply to query-migrate-capabilities."""
+    for reply in _qmp_lists(output):
+        if reply and "capability" in reply[0]:
+            return sorted(cap["capability"] for cap in reply)
+    return []
+
+def probe(binary):
+    """Ask the QEMU binary what it supports. Returns a dict with its
+    version, command line options, machine types, devices, accelerators,
+    QMP commands and migration capabilities."""
+    options = parse_options(_run(binary, "-help"))
+    qmp = _run(
+        binary, "-machine", "none", "-nodefaults", "-display", "none",
+        "-qmp", "stdio",
+        stdin=b'{"execute": "qmp_capabilities"}\n'
+              b'{"execute": "query-commands"}\n'
+              b'{"execute": "query-migrate-capabilities"}\n'
+              b'{"execute": "quit"}\n'
+    )
+    return {
+        "version": parse_version(_run(binary, "--version")),
+        "options": options,
+        "machines": parse_machines(_run(binary, "-machine", "help")),
+        "devices": parse_devices(_run(binary, "-device", "help")),
+        "accels": parse_accels(_run(binary, "-accel", "help"))
+        if "-accel" in options else [],
+        "qmp_commands": parse_qmp_commands(qmp),
+        "migration_capabilities": parse_migration_capabilities(qmp),
+    }
+
+def _load():
+    try:
+        with open(CACHE_PATH, "r") as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        log.warning(f"Ignoring unreadable {CACHE_PATH}. {e}")
+        return {}
+
+def _write(entries):
+    dirpath = os.path.dirname(CACHE_PATH)
+    os.makedirs(dirpath, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(
+        dir=dirpath, prefix=os.path.basename(CACHE_PATH)
+    )
+    try:
+        with os.fdopen(fd, "w") as fp:
+            json.dump(entries, fp)
+        os.replace(tmppath, CACHE_PATH)
+    except Exception:
+        os.remove(tmppath)
+        raise
+
+def capabilities(binary):
+    """The capabilities of the QEMU binary, see probe(). The binary is
+    only probed again when its path, size or mtime changes. Results are
+    kept in CACHE_PATH."""
+    path = shutil.which(binary)
+    if not path:
+        raise FileNotFoundError(f"QEMU binary {binary} not found")
+
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    signature = [st.st_size, st.st_mtime_ns, PROBE_VERSION]
+    probed = _probed.get(path)
+    if probed and probed[0] == signature:
+        return probed[1]
+
+    entries = _load()
+    entry = entries.get(path)
+    if entry and entry["signature"] == signature:
+        caps = entry["capabilities"]
+    else:
+        log.info(f"Probing the capabilities of {path}")
+        caps = probe(path)
+        # A binary that fails to run would otherwise be remembered as
+        # supporting nothing until it changes.
+        if not caps["options"] or not caps["devices"]:
+            log.warning(
+                f"Could not list the options and devices of {path}. It is "
+                f"probed again next time, options are chosen by version."
+            )
+            return caps
+
+        entries[path] = {"signature": signature, "capabilities": caps}
+        try:
+            _write(entries)
+        except OSError as e:
+            log.warning(f"Cannot store QEMU capabilities. {e}")
+
+    _probed[path] = (signature, caps)
+    return caps
@@ -0,0 +1,341 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import collections
+import json
+import logging
+import os
+import socket
+import subprocess
+import time
+
+from vmcloak.exceptions import QMPError
+
+log = logging.getLogger(__name__)
+
+# bootstrap.bat writes lines starting with this to COM1 when it reaches a
+# step of the installation.
+MILESTONE_PREFIX = "vmcloak:"
+
+# Seconds between samples of the disk write statistics.
+SAMPLE_INTERVAL = 10
+
+class QMPClient(object):
+    """A minimal client for the QEMU Machine Protocol on a unix socket.
+    Events that arrive while waiting for the reply to a command are kept
+    and returned by events() and wait_event()."""
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self._buf = b""
+        self._events = collections.deque()
+        self._id = 0
+
+    def connect(self, timeout=30, proc=None, retry_interval=0.2):
+        """Connect and leave capabilities negotiation mode. QEMU creates
+        the socket shortly after it starts, so this retries every
+        retry_interval seconds until timeout. Gives up early if proc, the
+        QEMU process, exits."""
+        end = time.monotonic() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                break
+            except OSError as e:
+                sock.close()
+                if proc and proc.poll() is not None:
+                    raise QMPError(
+                        f"QEMU exited with {proc.returncode} before QMP "
+                        f"was available"
+                    )
+                if time.monotonic() > end:
+                    raise QMPError(f"Cannot connect to {self.path}: {e}")
+                time.sleep(retry_interval)
+
+        self.sock = sock
+        greeting = self._read(timeout)
+        if not greeting or "QMP" not in greeting:
+            raise QMPError(f"No QMP greeting on {self.path}")
+        self.execute("qmp_capabilities")
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _read(self, timeout):
+        """Returns the next message, or None if there is none within
+        timeout seconds."""
+        end = time.monotonic() + timeout
+        while b"\n" not in self._buf:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                return None
+            if not data:
+                raise QMPError("QMP connection closed")
+            self._buf += data
+
+        line, self._buf = self._buf.split(b"\n", 1)
+        try:
+            return json.loads(line)
+        except ValueError as e:
+            raise QMPError(f"Invalid QMP message: {e}")
+
+    def execute(self, command, timeout=30, **arguments):
+        """Run a command and return its result. Commands such as migrate
+        return before they are done, see wait_event()."""
+        self._id += 1
+        msg = {"execute": command, "id": self._id}
+        if arguments:
+            msg["arguments"] = arguments
+        try:
+            self.sock.sendall(json.dumps(msg).encode() + b"\n")
+        except OSError as e:
+            raise QMPError(f"Cannot send {command}: {e}")
+
+        while True:
+            reply = self._read(timeout)
+            if reply is None:
+                raise QMPError(f"No reply to {command}")
+            if "event" in reply:
+                self._events.append(reply)
+            elif reply.get("id", self._id) != self._id:
+                # The reply to an earlier command that timed out.
+                continue
+            elif "error" in reply:
+                raise QMPError(
+                    f"{command} failed: {reply['error'].get('desc')}"
+                )
+            elif "return" in reply:
+                return reply["return"]
+
+    def quit(self, timeout=10):
+        """Ask QEMU to exit. QEMU may close the connection before it
+        replies, which is not an error."""
+        try:
+            self.execute("quit", timeout=timeout)
+        except QMPError as e:
+            log.debug(f"QEMU quit without a reply: {e}")
+
+    def events(self, timeout=0):
+        """Returns the events received so far, waiting up to timeout
+        seconds for one if there are none yet."""
+        if not self._events and timeout:
+            msg = self._read(timeout)
+            if msg and "event" in msg:
+                self._events.append(msg)
+        while True:
+            msg = self._read(0.001)
+            if msg is None:
+                break
+            if "event" in msg:
+                self._events.append(msg)
+
+        events = list(self._events)
+        self._events.clear()
+        return events
+
+    def wait_event(self, names, timeout=None):
+        """Returns the first event with one of the given names, or None if
+        there is none within timeout seconds. Other events are kept."""
+        for event in self._events:
+            if event["event"] in names:
+                self._events.remove(event)
+                return event
+
+        end = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            remaining = end - time.monotonic() if end else 60
+            if remaining <= 0:
+                return None
+            msg = self._read(remaining)
+            if msg is None or "event" not in msg:
+                continue
+            if msg["event"] in names:
+                return msg
+            self._events.append(msg)
+
+    def migrate(self, uri, timeout=None, interval=1, incoming=False):
+        """Migrate the VM state to uri, such as exec:command, and wait for
+        it to complete. With incoming, the state is loaded from uri into a
+        QEMU started with -incoming defer. Returns the final query-migrate
+        status."""
+        try:
+            # MIGRATION events tell when the status changes.
+            self.execute("migrate-set-capabilities", capabilities=[
+                {"capability": "events", "state": True}
+            ])
+        except QMPError as e:
+            log.debug(f"No migration events, polling instead. {e}")
+
+        self.execute("migrate-incoming" if incoming else "migrate", uri=uri)
+        end = time.monotonic() + timeout if timeout else None
+        while True:
+            status = self.execute("query-migrate")
+            state = status.get("status")
+            if state == "completed":
+                return status
+            if state in ("failed", "cancelled"):
+                raise QMPError(
+                    f"Migration {state}: {status.get('error-desc', '')}"
+                )
+            if end and time.monotonic() > end:
+                raise QMPError(
+                    f"Migration did not complete in {timeout} seconds"
+                )
+            self.wait_event(("MIGRATION",), timeout=interval)
+
+def _bytes_written(blockstats):
+    return sum(dev.get("stats", {}).get("wr_bytes", 0) for dev in blockstats)
+
+class InstallMonitor(object):
+    """Waits for the QEMU process proc that installs an image to shut
+    down. Installation progress is tracked through QMP events, the disk
+    write statistics and the milestones bootstrap.bat writes to the
+    serial port log. The installation fails on a disk I/O error, when
+    there is no progress for stall_timeout seconds, or when it takes
+    longer than timeout seconds."""
+
+    def __init__(self, proc, qmp_path, serial_path=None, stall_timeout=600,
+                 timeout=None, interval=SAMPLE_INTERVAL):
+        self.proc = proc
+        self.qmp = QMPClient(qmp_path)
+        self.serial_path = serial_path
+        self.stall_timeout = stall_timeout
+        self.timeout = timeout
+        self.interval = interval
+        self.milestones = []
+        self.resets = 0
+        self.written = 0
+        self._serial_pos = 0
+        self._serial_buf = b""
+
+    def _read_serial(self):
+        if not self.serial_path:
+            return []
+        try:
+            with open(self.serial_path, "rb") as fp:
+                fp.seek(self._serial_pos)
+                data = fp.read()
+        except FileNotFoundError:
+            return []
+
+        self._serial_pos += len(data)
+        self._serial_buf += data
+        *lines, self._serial_buf = self._serial_buf.split(b"\n")
+        milestones = []
+        for line in lines:
+            line = line.decode("latin1").strip()
+            if line.lower().startswith(MILESTONE_PREFIX):
+                milestones.append(line[len(MILESTONE_PREFIX):].strip())
+        return milestones
+
+    def _handle_event(self, event):
+        name = event["event"]
+        data = event.get("data", {})
+        if name == "SHUTDOWN":
+            log.info(
+                f"Guest shut down (by "
+                f"{'guest' if data.get('guest', True) else 'host'})"
+            )
+        elif name == "RESET":
+            self.resets += 1
+            log.info(f"Guest rebooted ({self.resets})")
+            return True
+        elif name == "BLOCK_IO_ERROR":
+            device = data.get("device") or data.get("node-name")
+            reason = data.get("reason") or (
+                "no space left" if data.get("nospace") else "unknown"
+            )
+            self.proc.kill()
+            raise ValueError(
+                f"Disk I/O error on {device} during "
+                f"{data.get('operation')}: {reason}"
+            )
+        return False
+
+    def _progress(self):
+        """Handles what happened since the last call. Returns True if the
+        installation made progress."""
+        progress = False
+        for event in self.qmp.events(timeout=self.interval):
+            progress |= self._handle_event(event)
+
+        for milestone in self._read_serial():
+            log.info(f"Install milestone: {milestone}")
+            self.milestones.append(milestone)
+            progress = True
+
+        try:
+            written = _bytes_written(self.qmp.execute("query-blockstats"))
+        except QMPError:
+            # QEMU is shutting down.
+            return progress
+        if written > self.written:
+            self.written = written
+            progress = True
+        return progress
+
+    def wait(self):
+        """Returns when QEMU exits cleanly, raises ValueError otherwise."""
+        start = last_progress = time.monotonic()
+        try:
+            self.qmp.connect(proc=self.proc)
+        except QMPError as e:
+            if self.proc.poll() is not None:
+                raise ValueError(e)
+            log.warning(f"Installing without progress monitoring: {e}")
+            return self._wait_plain()
+
+        while self.proc.poll() is None:
+            try:
+                progress = self._progress()
+            except QMPError:
+                progress = False
+                if self.proc.poll() is None:
+                    time.sleep(self.interval)
+
+            now = time.monotonic()
+            if progress:
+                last_progress = now
+            elif now - last_progress > self.stall_timeout:
+                self.proc.kill()
+                raise ValueError(
+                    f"Installation stalled: no disk writes or milestones for "
+                    f"{int(now - last_progress)} seconds. Last milestone: "
+                    f"{self.milestones[-1] if self.milestones else 'none'}"
+                )
+            if self.timeout and now - start > self.timeout:
+                self.proc.kill()
+                raise ValueError(
+                    f"Installation did not finish in {self.timeout} seconds"
+                )
+
+        for milestone in self._read_serial():
+            self.milestones.append(milestone)
+        if self.proc.returncode != 0:
+            raise ValueError(self.proc.returncode)
+
+    def _wait_plain(self):
+        try:
+            self.proc.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            raise ValueError(
+                f"Installation did not finish in {self.timeout} seconds"
+            )
+        if self.proc.returncode != 0:
+            raise ValueError(self.proc.returncode)
+
+    def close(self):
+        self.qmp.close()
+        if os.path.exists(self.qmp.path):
+            os.remove(self.qmp.path)
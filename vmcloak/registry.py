@@ -0,0 +1,120 @@
+# Copyright (C) 2021 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import struct
+
+HIVES = {
+    "HKLM": "HKEY_LOCAL_MACHINE",
+    "HKCU": "HKEY_CURRENT_USER",
+    "HKCR": "HKEY_CLASSES_ROOT",
+    "HKU": "HKEY_USERS",
+    "HKCC": "HKEY_CURRENT_CONFIG",
+}
+
+REG_HEADER = "Windows Registry Editor Version 5.00"
+
+def _quote(s):
+    return '"%s"' % s.replace("\\", "\\\\").replace('"', '\\"')
+
+def _hex(type_id, buf):
+    prefix = "hex" if type_id is None else "hex(%x)" % type_id
+    return "%s:%s" % (prefix, ",".join("%02x" % c for c in buf))
+
+def _int(data):
+    if isinstance(data, str):
+        data = data.strip()
+        if data.lower().startswith("0x"):
+            return int(data, 16)
+        return int(data, 10)
+    return int(data)
+
+def _render_data(regtype, data):
+    if regtype is None:
+        return "-"
+    if regtype == "REG_SZ":
+        return _quote(str(data))
+    if regtype == "REG_DWORD":
+        return "dword:%08x" % (_int(data) & 0xffffffff)
+    if regtype == "REG_QWORD":
+        return _hex(0xb, struct.pack("<Q", _int(data)))
+    if regtype == "REG_BINARY":
+        if isinstance(data, str):
+            data = bytes.fromhex(data)
+        return _hex(None, data)
+    if regtype == "REG_EXPAND_SZ":
+        return _hex(0x2, (str(data) + "\0").encode("utf-16-le"))
+    if regtype == "REG_MULTI_SZ":
+        if isinstance(data, str):
+            data = [data]
+        buf = "".join(s + "\0" for s in data) + "\0"
+        return _hex(0x7, buf.encode("utf-16-le"))
+
+    raise ValueError(f"Unsupported registry value type: {regtype}")
+
+def normalize_hive(hive):
+    hive = hive.upper()
+    hive = HIVES.get(hive, hive)
+    if hive not in HIVES.values():
+        raise ValueError(f"Unknown registry hive: {hive}")
+    return hive
+
+class RegistryTweaks(object):
+    """A set of registry values that is compiled into a single .reg file.
+    Entries are (hive, key, value, type, data) tuples. A value of None is
+    the default value of the key and a type of None deletes the value.
+    Duplicate values are removed (the last one wins) and values are
+    grouped per key, both compared case-insensitively like Windows does."""
+
+    def __init__(self, entries=()):
+        self._keys = {}
+        self.extend(entries)
+
+    def add(self, hive, key, value, regtype="REG_SZ", data=""):
+        hive = normalize_hive(hive)
+        key = key.strip("\\")
+        # Validate the data now rather than when it is rendered.
+        _render_data(regtype, data)
+
+        _, _, values = self._keys.setdefault(
+            (hive, key.lower()), (hive, key, {})
+        )
+        name = (value or "").lower()
+        values.pop(name, None)
+        values[name] = (value, regtype, data)
+
+    def delete(self, hive, key, value):
+        self.add(hive, key, value, None, None)
+
+    def extend(self, entries):
+        for entry in entries:
+            self.add(*entry)
+
+    @property
+    def key_count(self):
+        return len(self._keys)
+
+    def __len__(self):
+        return sum(len(values) for _, _, values in self._keys.values())
+
+    def __iter__(self):
+        for hive, key, values in self._keys.values():
+            for value, regtype, data in values.values():
+                yield hive, key, value, regtype, data
+
+    def render(self):
+        """Return the contents of the .reg file."""
+        lines = [REG_HEADER, ""]
+        for hive, key, values in self._keys.values():
+            lines.append(f"[{hive}\\{key}]")
+            for value, regtype, data in values.values():
+                name = _quote(value) if value else "@"
+                lines.append(f"{name}={_render_data(regtype, data)}")
+            lines.append("")
+
+        return "\r\n".join(lines) + "\r\n"
+
+    def encode(self):
+        """Return the .reg file as UTF-16 (with byte order mark) as
+        expected by reg import."""
+        return ("\ufeff" + self.render()).encode("utf-16-le")
@@ -15,13 +15,14 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import sessionmaker, relationship, reconstructor
 
-SCHEMA_VERSION = "d6c5bf858df1"
+SCHEMA_VERSION = "8e1f0b3c27a4"
 
 conf_path = os.path.join(os.getenv("HOME"), ".vmcloak")
 image_path = os.path.join(conf_path, "image")
 vms_path = os.path.join(conf_path, "vms")
 deps_path = os.path.join(conf_path, "deps")
 iso_dst_path = os.path.join(conf_path, "iso")
+layers_path = os.path.join(conf_path, "layers")
 
 repository = join(conf_path, "repository.db")
 engine = create_engine("sqlite:///%s" % repository)
@@ -65,6 +66,9 @@ class Image(Base):
     paravirtprovider = Column(String(32), default="default")
     mac = Column(String(32))
     _installed = Column(Text)
+    # Disk size in bytes before and after the last 'vmcloak compact'.
+    precompact_size = Column(Integer)
+    compact_size = Column(Integer)
 
     @reconstructor
     def _init(self):
@@ -412,6 +416,12 @@ class IPNet:
                 f"bridge in network {self.network}"
             )
 
+    def reserve_ip(self, ip):
+        """Check if the given IP is usable and mark it as used, so get_ips
+        does not hand it out."""
+        self.check_ip_usable(ip)
+        self._used.add(ip_address(ip))
+
     def set_bridge_ip(self, ip):
         bridge_ip = ip_address(ip)
         if bridge_ip not in self.network:
@@ -25,6 +25,9 @@ class WindowsXP(OperatingSystem):
         "-relaxed-filenames",
     ]
     interface = "Local Area Connection"
+    isofiles_copy = [os.path.join("i386", "winnt.sif")]
+    # Setup only reads winnt.sif from the CD-ROM it boots from.
+    config_medium = False
 
     def _winnt_sif(self):
         values = {